@@ -0,0 +1,245 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+from sqlalchemy import text
+from utils.logging_config import logger
+from utils.query_counter import QueryCounter
+from utils.queries import load_queries
+from utils.engine_registry import get_engine, dispose_engines
+from src.generate_report import dataframe_summary
+from src.get_owners_report import get_owner_report
+from src.report_comparison import compare_dataframes
+from src.export_report import export_report_to_csv, new_run_id
+from benchmarks.synthetic import create_table, create_owner_table
+
+BENCH_SCHEMA = 'veritas_bench'
+
+# The templates creating the synthetic tables are kept apart from the tool's own, in the queries.json file next to this module
+BENCH_QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries.json')
+
+# Synthetic tables of every suite: width, row count, null density, cardinality and skew
+SUITES = {
+    'smoke': [
+        {'name': 'narrow_1k', 'columns': 10, 'rows': 10**3, 'null_pct': 0.1, 'cardinality': 100, 'skew': 1.0},
+        {'name': 'wide_1k', 'columns': 200, 'rows': 10**3, 'null_pct': 0.1, 'cardinality': 100, 'skew': 1.0}
+    ],
+    'default': [
+        {'name': 'narrow_100k', 'columns': 10, 'rows': 10**5, 'null_pct': 0.1, 'cardinality': 1000, 'skew': 1.0},
+        {'name': 'skewed_100k', 'columns': 10, 'rows': 10**5, 'null_pct': 0.1, 'cardinality': 10**5, 'skew': 4.0},
+        {'name': 'sparse_100k', 'columns': 10, 'rows': 10**5, 'null_pct': 0.9, 'cardinality': 1000, 'skew': 1.0},
+        {'name': 'unique_100k', 'columns': 10, 'rows': 10**5, 'null_pct': 0.0, 'cardinality': 10**9, 'skew': 1.0},
+        {'name': 'medium_1m', 'columns': 100, 'rows': 10**6, 'null_pct': 0.1, 'cardinality': 10**4, 'skew': 2.0},
+        {'name': 'widest_1k', 'columns': 1600, 'rows': 10**3, 'null_pct': 0.1, 'cardinality': 100, 'skew': 1.0}
+    ],
+    'large': [
+        {'name': 'narrow_10m', 'columns': 10, 'rows': 10**7, 'null_pct': 0.1, 'cardinality': 10**6, 'skew': 2.0},
+        {'name': 'narrow_100m', 'columns': 10, 'rows': 10**8, 'null_pct': 0.1, 'cardinality': 10**6, 'skew': 2.0},
+        {'name': 'widest_100k', 'columns': 1600, 'rows': 10**5, 'null_pct': 0.1, 'cardinality': 1000, 'skew': 1.0}
+    ]
+}
+
+STAGES = ['profile', 'owner_fetch', 'compare', 'export']
+
+def measure(function, repeat: int=3, memory: bool=True) -> dict:
+
+    '''
+    Runs a function `repeat` times and measures its latency, then once more under tracemalloc for its peak memory,
+    so that tracing does not slow down the timed runs. Only the memory allocated by Python is traced, not libpq's buffers.
+
+    Parameters:
+    function (callable): The function to run, without arguments. It returns its result and the number of queries it issued, or None.
+    repeat (int): Number of timed runs (default is 3).
+    memory (bool): Measure the peak memory in an extra run (default is True).
+
+    Returns:
+    dict: The median seconds, the seconds of every run, the peak_mb and the queries of the last run, and the result of the last run.
+    '''
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result, queries = function()
+        seconds.append(round(time.perf_counter()-start, 6))
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            result, queries = function()
+            peak_mb = round(tracemalloc.get_traced_memory()[1]/2**20, 3)
+        finally:
+            tracemalloc.stop()
+    return {'seconds': statistics.median(seconds), 'seconds_runs': seconds, 'peak_mb': peak_mb, 'queries': queries, 'result': result}
+
+
+def counted(db, function, *args, **kwargs):
+
+    '''
+    Returns a function running function(*args, **kwargs) and counting the queries it sends through the engine.
+    '''
+
+    def run():
+        counter = QueryCounter().attach(db)
+        try:
+            return function(*args, **kwargs), counter.count
+        finally:
+            counter.detach(db)
+    return run
+
+
+def run_scenario(db, queries: dict, scenario: dict, repeat: int=3, memory: bool=True, mode: str='exact', workers: int=1,
+                 force: bool=False) -> list:
+
+    '''
+    Benchmarks the profiling, owner fetch, comparison and export of one synthetic table.
+    The table is created first if needed and a first, untimed, profile provides the owner's report table and warms the caches.
+    The user's report is compared with the owner's report as fetched from that table, whose parameters are text, so that the
+    comparison goes through the coercion of the owner's values.
+
+    Returns:
+    list: One result per stage, with the scenario's specification, the mode, the stage and its measures, see measure.
+    '''
+
+    table_name = f"{BENCH_SCHEMA}.{scenario['name']}"
+    owner_table = f"{BENCH_SCHEMA}.{scenario['name']}_owner"
+    create_table(db, queries, table_name, scenario['columns'], scenario['rows'], scenario['null_pct'], scenario['cardinality'],
+                 scenario['skew'], force=force)
+
+    def profile():
+        report = dataframe_summary(db.connect(), table_name, db, workers=workers, mode=mode, dispose=False)
+        if report is None:
+            raise RuntimeError(f'Profiling {table_name} failed')
+        return report, report.attrs['query_count']
+
+    logger.info(f'Warming up {table_name}')
+    user_report, _ = profile()
+    create_owner_table(db, user_report, owner_table)
+    owner_report = get_owner_report(db.connect(), db, owner_table, dispose=False)
+
+    run_id = new_run_id()
+    stages = {
+        'profile': profile,
+        'owner_fetch': counted(db, lambda: get_owner_report(db.connect(), db, owner_table, dispose=False)),
+        'compare': counted(db, compare_dataframes, user_report, owner_report),
+        'export': counted(db, export_report_to_csv, user_report, prefix=f"Benchmark_{scenario['name']}", run_id=run_id)
+    }
+    results = []
+    for stage in STAGES:
+        logger.info(f'Benchmarking the {stage} of {table_name}')
+        measures = measure(stages[stage], repeat, memory)
+        measures.pop('result')
+        results.append({**scenario, 'mode': mode, 'stage': stage, **measures})
+        logger.info(f"{table_name} {stage}: {measures['seconds']}s, {measures['peak_mb']} MiB, {measures['queries']} queries")
+    for filename in glob.glob(f"./reports/Benchmark_{scenario['name']}_{run_id}*.csv"):
+        os.remove(filename)
+    return results
+
+
+def check_regressions(results: list, baseline: dict, time_tolerance: float=0.25, min_seconds: float=0.05) -> list:
+
+    '''
+    Compares the results with a baseline benchmark file. Any extra query is a regression, and so is a stage slower than the baseline
+    by more than time_tolerance, relatively, and by more than min_seconds, so that the noise of very short stages is ignored.
+
+    Parameters:
+    results (list): The results of the current run
+    baseline (dict): The content of a previous benchmark JSON file
+    time_tolerance (float): Relative slowdown allowed (default is 0.25).
+    min_seconds (float): Absolute slowdown always allowed (default is 0.05).
+
+    Returns:
+    list: One message per regression, empty if there is none.
+    '''
+
+    expected = {(result['name'], result['mode'], result['stage']): result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        before = expected.get((result['name'], result['mode'], result['stage']))
+        if before is None:
+            continue
+        label = f"{result['name']} {result['mode']} {result['stage']}"
+        if before['queries'] is not None and result['queries'] is not None and result['queries']>before['queries']:
+            regressions.append(f"{label}: {result['queries']} queries instead of {before['queries']}")
+        if result['seconds']>before['seconds']*(1+time_tolerance) and result['seconds']-before['seconds']>min_seconds:
+            regressions.append(f"{label}: {result['seconds']}s instead of {before['seconds']}s")
+    return regressions
+
+
+def embedded_dsn(data_dir: str) -> str:
+
+    '''
+    Starts an embedded PostgreSQL server in data_dir with pgserver and returns its DSN.
+    '''
+
+    try:
+        import pgserver
+    except ImportError:
+        logger.error('pgserver is required to run the benchmarks on an embedded PostgreSQL. Install it with pip install pgserver')
+        raise
+    return pgserver.get_server(data_dir).get_uri().replace('postgresql://', 'postgresql+psycopg2://', 1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the profiling, owner fetch, comparison and export of synthetic tables.')
+    parser.add_argument('--dsn', default=os.environ.get('VERITAS_BENCH_DSN'),
+                        help='DSN of the PostgreSQL database the synthetic tables are created in (default is $VERITAS_BENCH_DSN).')
+    parser.add_argument('--embedded', default=None, help='Run on an embedded PostgreSQL stored in this folder instead of --dsn, requires pgserver.')
+    parser.add_argument('--suite', choices=list(SUITES), default='smoke', help="Synthetic tables to benchmark (default is 'smoke').")
+    parser.add_argument('--scenarios', nargs='+', default=None, help='Only benchmark these tables of the suite.')
+    parser.add_argument('--mode', default='exact', help="Profile mode, see dataframe_summary (default is 'exact').")
+    parser.add_argument('--workers', type=int, default=1, help='Number of profiling workers (default is 1).')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per stage, the median is reported (default is 3).')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the extra traced run measuring the peak memory of every stage.')
+    parser.add_argument('--force', action='store_true', help='Recreate the synthetic tables even if they already exist.')
+    parser.add_argument('--output', default=None, help='Path of the JSON results (default is ./reports/Benchmark_<run_id>.json).')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run, exit with 1 on any query count or time regression.')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='Relative slowdown allowed against the baseline (default is 0.25).')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.embedded is not None:
+        dsn = embedded_dsn(args.embedded)
+    elif args.dsn is not None:
+        dsn = args.dsn
+    else:
+        logger.error('No database to benchmark on. Pass --dsn, set VERITAS_BENCH_DSN or use --embedded.')
+        print('No database to benchmark on. Pass --dsn, set VERITAS_BENCH_DSN or use --embedded.')
+        exit(2)
+
+    queries = load_queries(BENCH_QUERIES_PATH)
+    db = get_engine(dsn, pool_size=max(5, args.workers+1))
+    with db.connect() as conn:
+        server_version = conn.execute(text(queries['version_query'])).scalar()
+
+    scenarios = [scenario for scenario in SUITES[args.suite] if args.scenarios is None or scenario['name'] in args.scenarios]
+    results = []
+    for scenario in scenarios:
+        results.extend(run_scenario(db, queries, scenario, args.repeat, not args.no_memory, args.mode, args.workers, args.force))
+    dispose_engines()
+
+    benchmark = {'suite': args.suite, 'created_at': datetime.now().isoformat(timespec='seconds'), 'postgres': server_version,
+                 'python': platform.python_version(), 'platform': platform.platform(), 'repeat': args.repeat, 'results': results}
+    output = args.output or f'./reports/Benchmark_{new_run_id()}.json'
+    with open(output, 'w') as f:
+        json.dump(benchmark, f, indent=4)
+    print(f'Benchmark results written to {output}')
+    for result in results:
+        print(f"{result['name']:<16} {result['stage']:<12} {result['seconds']:>10.4f}s {result['peak_mb'] or 0:>10.2f} MiB {result['queries']:>6} queries")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = check_regressions(results, baseline, args.time_tolerance)
+        for regression in regressions:
+            logger.error(f'Regression: {regression}')
+            print(f'REGRESSION {regression}')
+        exit(1 if len(regressions)>0 else 0)
+
+if __name__=="__main__":
+    main()
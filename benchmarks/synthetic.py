@@ -0,0 +1,91 @@
+from utils.logging_config import logger
+from sqlalchemy import text
+import json
+
+# PostgreSQL tables have at most 1600 columns
+MAX_COLUMNS = 1600
+
+# The synthetic columns cycle through these types, each rendering the column's random bigint value v
+COLUMN_TYPES = [
+    ('integer', '({v})::integer'),
+    ('text', "'v' || ({v})"),
+    ('numeric', '(({v}) / 10.0)::numeric'),
+    ('date', "DATE '2020-01-01' + (({v}) % 3650)::integer"),
+    ('boolean', '({v}) % 2 = 0')
+]
+
+def build_create_query(queries: dict, table_name: str, columns: int, rows: int, null_pct: float, cardinality: int, skew: float) -> str:
+
+    '''
+    Builds the query creating a synthetic table in the database from generate_series, so that no row goes through Python.
+    Every column takes floor(cardinality * random()^skew): a skew of 1 spreads the values uniformly over the cardinality
+    and a larger skew piles them up on the smallest values. A null_pct share of every column's values are nulls.
+
+    Parameters:
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The table to create
+    columns (int): Number of columns, named c0, c1, ... and cycling through COLUMN_TYPES
+    rows (int): Number of rows
+    null_pct (float): Share of null values of every column, between 0 and 1
+    cardinality (int): Number of distinct values of every column, besides null
+    skew (float): Exponent applied to the uniform random values, 1 for uniform columns
+
+    Returns:
+    str: The CREATE TABLE AS query.
+    '''
+
+    value = queries['bench_value_expr'].format(cardinality=cardinality, skew=skew)
+    col_exprs = []
+    for idx in range(columns):
+        _, expression = COLUMN_TYPES[idx%len(COLUMN_TYPES)]
+        col_exprs.append(queries['bench_column_expr'].format(null_pct=null_pct, value=expression.format(v=value), col_name=f'c{idx}'))
+    return queries['bench_create_query'].format(table_name=table_name, col_exprs=', '.join(col_exprs), rows=rows)
+
+
+def create_table(db, queries: dict, table_name: str, columns: int, rows: int, null_pct: float=0.1, cardinality: int=1000,
+                 skew: float=1.0, seed: float=0.42, force: bool=False) -> bool:
+
+    '''
+    Creates and analyzes a synthetic table, see build_create_query. The random values are seeded, so a table is the same on every run.
+    Its specification is stored in the table's comment, and a table already matching it is kept, so large tables are only built once.
+
+    Parameters:
+    db : The connection engine
+    force (bool): Recreate the table even if it already matches the specification (default is False).
+
+    Returns:
+    bool: True if the table was created, False if it was kept.
+    Raises ValueError if columns is larger than MAX_COLUMNS.
+    '''
+
+    if columns>MAX_COLUMNS:
+        logger.error(f'{table_name} cannot have {columns} columns, PostgreSQL tables have at most {MAX_COLUMNS}')
+        raise ValueError(f'At most {MAX_COLUMNS} columns are supported')
+    spec = json.dumps({'columns': columns, 'rows': rows, 'null_pct': null_pct, 'cardinality': cardinality, 'skew': skew, 'seed': seed},
+                      sort_keys=True)
+    schema = table_name.split(".")[0]
+    with db.begin() as conn:
+        conn.execute(text(queries['bench_schema_query'].format(schema=schema)))
+        if not force and conn.execute(text(queries['bench_spec_query'].format(table_name=table_name))).scalar()==spec:
+            logger.info(f'{table_name} already matches {spec}, keeping it')
+            return False
+        logger.info(f'Creating {table_name} with {spec}')
+        conn.execute(text(queries['bench_drop_query'].format(table_name=table_name)))
+        # The seed applies to the random() calls of the next queries of this session
+        conn.execute(text(queries['bench_seed_query'].format(seed=seed)))
+        conn.execute(text(build_create_query(queries, table_name, columns, rows, null_pct, cardinality, skew)))
+        conn.execute(text(queries['bench_comment_query'].format(table_name=table_name, comment=spec)))
+    with db.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(text(queries['bench_analyze_query'].format(table_name=table_name)))
+    return True
+
+
+def create_owner_table(db, report, table_name: str):
+
+    '''
+    Stores a report as the data owner's report table of a benchmark, every parameter as text as owners usually provide them.
+    '''
+
+    schema, table = table_name.split(".")
+    owner_report = report.astype(str)
+    owner_report.to_sql(name=table, con=db, schema=schema, if_exists='replace', index=False)
@@ -1,45 +1,174 @@
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.logging_config import logger 
+from utils.query_profiler import QueryProfiler
 from src.get_input_config import input_configuration
-from src.generate_report import dataframe_summary
+from src.generate_report import dataframe_summary, refine_catalog_report
 from src.get_owners_report import get_owner_report
-from src.report_comparison import compare_dataframes
-from src.export_report import export_report_to_csv
+from src.report_comparison import compare_dataframes, diff_reports
+from src.export_report import export_report, append_to_results_store, export_timing_profile, new_run_id
+from src.batch_run import run_batch
+from src.row_diff import row_level_diff
+from src.file_profile import file_summary
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compares the summary of a table with the summary provided by its data owner.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of concurrent connections used to profile the user table (default is 1).')
+    parser.add_argument('--mode', choices=['exact', 'fast', 'catalog', 'incremental', 'partition', 'planned'], default='exact',
+                        help="'fast' estimates the statistics from a sample with error bounds, 'catalog' reads them from pg_stats, "
+                             "'incremental' reuses the statistics of the previous run, "
+                             "'partition' profiles ranges of the table in --workers processes, "
+                             "'planned' picks the exact, sampled or catalog strategy of every statistic to fit --time-budget (default is 'exact').")
+    parser.add_argument('--sample-pct', type=float, default=1.0, help='Percentage of the table sampled in fast and planned mode (default is 1).')
+    parser.add_argument('--sample-method', choices=['SYSTEM', 'BERNOULLI'], default='SYSTEM',
+                        help="TABLESAMPLE method used in fast and planned mode (default is 'SYSTEM').")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='In planned mode, seconds the profile of every table should take, degrading the costliest statistics to fit.')
+    parser.add_argument('--statement-timeout', type=float, default=None,
+                        help='In planned mode, maximum seconds of any single query, a statistic timing out falls back to a cheaper strategy.')
+    parser.add_argument('--top-k', type=int, default=1, help='Number of most occurring values listed per column (default is 1).')
+    parser.add_argument('--sketch-threshold', type=int, default=None,
+                        help='Unique count above which the most occurring values are found with a bounded memory heavy hitters sketch.')
+    parser.add_argument('--watermark-column', default=None,
+                        help='In incremental mode, an ever increasing column (e.g. a serial id) so that only the appended rows are profiled.')
+    parser.add_argument('--state-dir', default='./state', help='In incremental mode, folder storing the statistics between runs (default is ./state).')
+    parser.add_argument('--partitions', type=int, default=None, help='In partition mode, number of ranges unpartitioned tables are split into.')
+    parser.add_argument('--partition-column', default=None,
+                        help='In partition mode, numeric column to split unpartitioned tables by instead of their pages.')
+    parser.add_argument('--approx-distinct', action='store_true',
+                        help='In partition mode, merge the distinct values of the ranges with sketches instead of exactly.')
+    parser.add_argument('--rescan-tolerance', type=float, default=None,
+                        help='In catalog mode, rescan exactly the columns whose estimates differ from the owner\'s report by more than this relative tolerance.')
+    parser.add_argument('--owner-table-column', default='Table_Name',
+                        help="Column of the owner's table naming the table each row describes, when it holds the reports of many tables (default is 'Table_Name').")
+    parser.add_argument('--owner-key', default=None,
+                        help="Value of --owner-table-column identifying the user table's rows (default is the user table's schema_name.table_name).")
+    parser.add_argument('--owner-file', default=None,
+                        help="Compare with the owner's CSV or Parquet extract of the table, profiled locally, instead of the owner's report table.")
+    parser.add_argument('--row-diff-key', nargs='+', default=None,
+                        help='Also reconcile the rows of the user table with --reference-table, matching them by these key columns.')
+    parser.add_argument('--reference-table', default=None,
+                        help="With --row-diff-key, schema_name.table_name of the reference data in the owner's database.")
+    parser.add_argument('--export', nargs='+', choices=['csv', 'parquet', 'arrow', 'copy'], default=['csv'],
+                        help="Formats the reports are exported in: CSV, zstd compressed Parquet or Arrow IPC files, "
+                             "or 'copy' to append them to --results-table in the user's database (default is csv).")
+    parser.add_argument('--results-table', default='public.veritas_results',
+                        help="With --export copy, schema_name.table_name of the results table (default is public.veritas_results).")
+    parser.add_argument('--results-store', default='./reports/results',
+                        help='Folder of the Parquet dataset, partitioned by date and table, every diff is appended to (default is ./reports/results).')
+    parser.add_argument('--timings', action='store_true',
+                        help='Record the time, rows, columns and statistic of every profiling query, export them as JSON next to the report '
+                             'and print the slowest columns.')
+    parser.add_argument('--explain-top', type=int, default=0,
+                        help='With --timings, run EXPLAIN (ANALYZE, BUFFERS) on this many of the slowest queries, which runs them again (default is 0).')
+    parser.add_argument('--manifest', default=None,
+                        help='Validate every table pair listed in this JSON, YAML or CSV manifest without any prompt.')
+    parser.add_argument('--concurrency', type=int, default=8, help='With --manifest, maximum number of tables validated at the same time (default is 8).')
+    parser.add_argument('--per-db-limit', type=int, default=4, help='With --manifest, maximum number of tables run at the same time per database (default is 4).')
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    run_id = new_run_id()
+
+    if args.manifest is not None:
+        logger.info(f'RUNNING THE BATCH FROM {args.manifest}')
+        summary = run_batch(args.manifest, args.concurrency, args.per_db_limit, workers=args.workers, mode=args.mode,
+                            sample_pct=args.sample_pct, sample_method=args.sample_method, top_k=args.top_k,
+                            sketch_threshold=args.sketch_threshold, watermark_column=args.watermark_column, state_dir=args.state_dir,
+                            partitions=args.partitions, partition_column=args.partition_column, exact_distinct=not args.approx_distinct,
+                            time_budget=args.time_budget, statement_timeout=args.statement_timeout, run_id=run_id, export_formats=args.export, results_store=args.results_store,
+                            results_table=args.results_table, timings=args.timings)
+        print(summary.to_string(index=False))
+        exit(0 if (summary['status']!='FAILED').all() else 1)
+
     logger.info('FETCHING USER TABLE DETAILS')
-    res = input_configuration(table_owner='user')
+    res = input_configuration(table_owner='user', pool_size=max(5, args.workers))
     if res is None:
         logger.error("Failed to retrieve user table details. Exiting...")
         exit(1)  
     else:
         conn, table, db = res
+        user_table, user_db = table, db
         print('_______________________________________________')
 
-    logger.info('GENERATING USER REPORT')
-    user_report = dataframe_summary(conn, table, db)
-    if user_report is None:
-        logger.error("USER REPORT GENERATION FAILED. EXITING...")
-        exit(1)
-    logger.info(f'USER REPORT GENERATED SUCCESFULLY! {user_report.shape}')
+    owner_db = None
+    if args.owner_file is None:
+        # The owner's details are entered before the profiling starts, so that a typo exits at once instead of after the profile
+        logger.info('GETTING OWNER\'S CONNECTION DETAILS')
+        res = input_configuration(table_owner='owner')
+        if res is None:
+            logger.error("Failed to retrieve owner's table details. Exiting...")
+            exit(1)
+        else:
+            owner_conn, owner_table, owner_db = res
+            print('_______________________________________________')
 
-    logger.info('GETTING OWNER\'S CONNECTION DETAILS')
-    res = input_configuration(table_owner='owner')
-    if res is None:
-        logger.error("Failed to retrieve owner's table details. Exiting...")
-        exit(1)  
-    else:
-        conn, table, db = res
-        print('_______________________________________________')
+    profiler = QueryProfiler() if args.timings else None
+    stop_event = threading.Event()
 
+    # The user table is profiled in the background while the owner's report is fetched
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='pipeline')
+    logger.info('GENERATING USER REPORT')
+    user_future = executor.submit(dataframe_summary, conn, table, db, workers=args.workers, mode=args.mode,
+                                  sample_pct=args.sample_pct, sample_method=args.sample_method, top_k=args.top_k,
+                                  sketch_threshold=args.sketch_threshold, watermark_column=args.watermark_column, state_dir=args.state_dir,
+                                  partitions=args.partitions, partition_column=args.partition_column,
+                                  exact_distinct=not args.approx_distinct, time_budget=args.time_budget,
+                                  statement_timeout=args.statement_timeout, profiler=profiler, stop_event=stop_event)
+    if args.owner_file is not None:
+        logger.info(f"PROFILING THE OWNER'S EXTRACT {args.owner_file}")
+        owner_future = executor.submit(file_summary, args.owner_file, top_k=args.top_k, stop_event=stop_event)
+    else:
+        logger.info("FETCHING OWNER'S REPORT")
+        owner_future = executor.submit(get_owner_report, owner_conn, owner_db, owner_table, target_table=args.owner_key or user_table,
+                                       table_column=args.owner_table_column)
 
-    logger.info("FETCHING OWNER'S REPORT")
-    owner_report = get_owner_report(conn, db, table)
-    if owner_report is None:
-        logger.error("FAILED TO FETCH OWNER'S REPORT. EXITING...")
+    def abort(message):
+        # The other side is stopped instead of waited for, as the interpreter joins the pipeline threads before exiting:
+        # the profiles before their next query or batch, and the queries they run on the server
+        logger.error(message)
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        pending = [(user_future, conn, 'the profiling query')]
+        if args.owner_file is None:
+            pending.append((owner_future, owner_conn, "the owner's report query"))
+        for future, future_conn, name in pending:
+            if not future.done():
+                try:
+                    future_conn.connection.dbapi_connection.cancel()
+                except Exception as e:
+                    logger.warning(f'Could not cancel {name}: {e}')
         exit(1)
-    logger.info(f"OWNER'S REPORT RETRIEVED SUCCESSFULLY! {owner_report.shape}")
+
+    # Whichever report is ready first is checked first, so that a failure of either side exits without waiting for the other
+    for future in as_completed([user_future, owner_future]):
+        if future is user_future:
+            try:
+                user_report = user_future.result()
+            except Exception:
+                logger.exception('An error occured while generating the user report')
+                user_report = None
+            if user_report is None:
+                abort("USER REPORT GENERATION FAILED. EXITING...")
+            logger.info(f'USER REPORT GENERATED SUCCESFULLY! {user_report.shape}')
+        else:
+            try:
+                owner_report = owner_future.result()
+            except Exception:
+                logger.exception("An error occured while getting the owner's report")
+                owner_report = None
+            if owner_report is None:
+                abort("FAILED TO FETCH OWNER'S REPORT. EXITING...")
+            logger.info(f"OWNER'S REPORT RETRIEVED SUCCESSFULLY! {owner_report.shape}")
+    executor.shutdown()
     print('_______________________________________________')
 
+    if args.mode=='catalog' and args.rescan_tolerance is not None:
+        logger.info('RESCANNING THE COLUMNS WHOSE CATALOG ESTIMATES DISAGREE WITH THE OWNER\'S REPORT')
+        user_report = refine_catalog_report(user_db, user_table, user_report, owner_report, args.rescan_tolerance)
+
     logger.info(f"COMPARING THE REPORTS {user_report.shape}, {owner_report.shape}")
     report = compare_dataframes(user_report, owner_report)
     if report is None:
@@ -47,11 +176,38 @@ def main():
         exit(1)
         
     logger.info("EXPORTING REPORT")
-    res = export_report_to_csv(report)
+    res = export_report(report, args.export, run_id=run_id, db=user_db, results_table=args.results_table, table_name=user_table)
     if res==1:
         logger.info('EXPORTED REPORT SUCCESSFULLY!')
     else:
         logger.info(f'EXPORT FAILED. PLEASE TRY AGAIN LATER!')
 
+    diff = diff_reports(user_report, owner_report)
+    if diff is not None and append_to_results_store(diff, user_table, run_id, args.results_store)==1:
+        logger.info(f'APPENDED THE DIFF TO THE RESULTS STORE {args.results_store}')
+
+    if args.row_diff_key is not None and args.reference_table is not None and owner_db is None:
+        logger.warning("--row-diff-key needs the owner's database, rows are not reconciled with --owner-file")
+    elif args.row_diff_key is not None and args.reference_table is not None:
+        logger.info(f'RECONCILING THE ROWS OF {user_table} WITH {args.reference_table}')
+        with user_db.connect() as user_conn, owner_db.connect() as ref_conn:
+            row_diff = row_level_diff(user_conn, user_table, ref_conn, args.reference_table, args.row_diff_key)
+        print(f'{row_diff.shape[0]} rows differ from {args.reference_table}')
+        export_report(row_diff, [x for x in args.export if x!='copy'] or ['csv'], prefix='Row_Diff', run_id=run_id)
+
+    if profiler is not None:
+        if args.explain_top>0:
+            logger.info(f'EXPLAINING THE {args.explain_top} SLOWEST QUERIES')
+            profiler.explain_slowest(user_db, args.explain_top)
+        export_timing_profile(profiler, run_id=run_id)
+        # A query computing a batch of columns cannot be timed per column, its time is split evenly between them
+        print('Slowest columns (seconds). The time of a query computing a batch of columns is split evenly between them, '
+              'Measured is the share of a column\'s time spent on queries of its own:')
+        print(profiler.slowest_columns(10).to_string(index=False))
+
+    query_count = user_report.attrs.get('query_count')
+    logger.info(f'QUERIES ISSUED TO PROFILE THE USER TABLE: {query_count}')
+    print(f'Queries issued to profile the user table: {query_count}')
+
 if __name__=="__main__":
     main()
\ No newline at end of file
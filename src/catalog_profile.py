@@ -0,0 +1,108 @@
+from utils.logging_config import logger
+import pandas as pd
+from sqlalchemy import text
+
+# Report column holding the time the planner statistics of the table were last refreshed
+FRESHNESS_COLUMN = 'Last_Analyzed'
+
+FLOAT_TYPES = ('double precision', 'real', 'numeric')
+
+def catalog_value(value, datatype: str):
+
+    '''
+    Converts a value decoded from the JSON form of pg_stats to the type a query on the table would have returned through pandas,
+    so that it is written to the report the same way as in the exact profile mode.
+
+    Parameters:
+    value : The decoded JSON value
+    datatype (str): The column's datatype from information_schema
+
+    Returns:
+    The converted value.
+    '''
+
+    if value is None:
+        return None
+    if datatype in FLOAT_TYPES:
+        return float(value)
+    if datatype.startswith('timestamp'):
+        return pd.Timestamp(value)
+    return value
+
+
+def catalog_profile(conn, queries: dict, table_name: str, col_names: list, datatypes: dict) -> dict:
+
+    '''
+    Builds the statistics of every column from the planner statistics PostgreSQL keeps in pg_class and pg_stats.
+    Only two catalog queries are issued whatever the size of the table, but the values are estimates
+    as fresh as the last ANALYZE of the table.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+
+    Returns:
+    dict: Mapping of column name to a dictionary with its num_rows, datatype, null, non_null, unique, duplicates and top values
+          and last_analyzed, the time of the last analyze of the table.
+          The values of a column without statistics are None.
+    '''
+
+    schema, table = table_name.split(".")
+    catalog_table_query = queries['catalog_table_query'].format(schema=schema, table=table)
+    logger.info(catalog_table_query)
+    table_stats = conn.execute(text(catalog_table_query)).mappings().first()
+    reltuples = table_stats['reltuples'] if table_stats is not None else None
+    last_analyzed = table_stats['last_analyzed'] if table_stats is not None else None
+    if reltuples is None or reltuples<0:
+        logger.warning(f'{table_name} has never been analyzed, run ANALYZE {table_name} before using the catalog mode.')
+        reltuples = None
+    else:
+        logger.info(f'{table_name} has about {reltuples} rows, last analyzed at {last_analyzed}')
+
+    catalog_stats_query = queries['catalog_stats_query'].format(schema=schema, table=table)
+    logger.info(catalog_stats_query)
+    col_stats = {row['column_name']: row for row in conn.execute(text(catalog_stats_query)).mappings()}
+
+    stats = {}
+    for col_name in col_names:
+        row = col_stats.get(col_name)
+        if row is None or reltuples is None:
+            logger.warning(f'No planner statistics found for {col_name}')
+            stats[col_name] = {'num_rows': None, 'datatype': datatypes[col_name], 'null': None, 'non_null': None,
+                               'unique': None, 'duplicates': None, 'top': None, 'last_analyzed': last_analyzed}
+            continue
+
+        row_count = round(reltuples)
+        non_null_count = round((1-row['null_frac'])*reltuples)
+        n_distinct = row['n_distinct']
+        # A negative n_distinct is the number of distinct values divided by the number of rows
+        unique_count = round(n_distinct) if n_distinct>=0 else round(-n_distinct*reltuples)
+        unique_count = min(unique_count, non_null_count)
+
+        common_vals = row['most_common_vals'] or []
+        common_freqs = row['most_common_freqs'] or []
+        if len(common_vals)>0:
+            top_freq = max(common_freqs)
+            top_vals = [catalog_value(val, datatypes[col_name]) for val, freq in zip(common_vals, common_freqs) if freq==top_freq]
+            if len(top_vals)>1:
+                top_vals.sort()
+            top = top_vals[0]
+        else:
+            # Without common values every value occurs about once and the smallest one is reported, as in the exact mode
+            top = catalog_value(row['min_val'], datatypes[col_name])
+
+        stats[col_name] = {
+            'num_rows': row_count,
+            'datatype': datatypes[col_name],
+            'null': row_count-non_null_count,
+            'non_null': non_null_count,
+            'unique': unique_count,
+            'duplicates': non_null_count-unique_count,
+            'top': top,
+            'last_analyzed': last_analyzed
+        }
+        logger.info(f"Done for {col_name}")
+    return stats
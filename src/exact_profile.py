@@ -0,0 +1,172 @@
+from utils.logging_config import logger
+from utils.query_counter import QueryCounter
+from utils.query_profiler import QueryProfiler, query_label
+from src.top_values import most_occurring_values
+import pandas as pd
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def build_profile_query(queries: dict, table_name: str, col_names: list) -> str:
+
+    '''
+    Builds a single aggregate query which computes the row count along with the non null and unique value counts
+    of every column in col_names, so that all of them are computed in one scan of the table.
+
+    Parameters:
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile in this query
+
+    Returns:
+    str: The aggregate query. The i-th column's values are aliased non_null_i and unique_i.
+    '''
+
+    aggregates = []
+    for idx, col_name in enumerate(col_names):
+        aggregates.append(queries['non_null_agg'].format(col_name=col_name, idx=idx))
+        aggregates.append(queries['unique_agg'].format(col_name=col_name, idx=idx))
+    return queries['profile_query'].format(table_name=table_name, aggregates=', '.join(aggregates))
+
+
+def profile_batch(conn, queries: dict, table_name: str, batch: list, datatypes: dict, stop_event=None, top_k: int=1,
+                  sketch_threshold: int=None, sketch_capacity: int=1000) -> dict:
+
+    '''
+    Profiles a batch of columns on the given connection using one aggregate query for the counts
+    and one query for the most occurring values of all the columns, see most_occurring_values.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    batch (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    stop_event (threading.Event): Optional event, profiling stops before the next query once it is set.
+    top_k (int): Number of most occurring values computed per column (default is 1).
+    sketch_threshold (int): Unique count above which the most occurring values are found with a heavy hitters sketch (default is None, never).
+    sketch_capacity (int): Number of counters of the heavy hitters sketches (default is 1000).
+
+    Returns:
+    dict: Mapping of column name to a dictionary with its num_rows, datatype, null, non_null, unique, duplicates, top and top_k values,
+          and top_error, the count error bound of the sketch, for sketched columns.
+    Raises the underlying exception if a query fails.
+    '''
+
+    logger.info(f"Generating the aggregate query for {batch}")
+    try:
+        profile_query = build_profile_query(queries, table_name, batch)
+        logger.info("Query generated successfully")
+    except Exception as e:
+        logger.error(f"An error occured while generating the aggregate query for {batch}: {e}")
+        raise e
+
+    logger.info(f"Executing the aggregate query for {batch}")
+    stats = {}
+    try:
+        if stop_event is not None and stop_event.is_set():
+            raise RuntimeError(f'Profiling of {batch} was cancelled')
+        logger.info(profile_query)
+        with query_label(batch, 'counts'):
+            counts = pd.read_sql_query(profile_query,conn).iloc[0]
+        row_count = int(counts['num_rows'])
+        col_counts = {col_name: (int(counts[f'non_null_{idx}']), int(counts[f'unique_{idx}'])) for idx, col_name in enumerate(batch)}
+
+        if stop_event is not None and stop_event.is_set():
+            raise RuntimeError(f'Profiling of {batch} was cancelled')
+        logger.info(f"Computing the most occurring values for {batch}")
+        with query_label(batch, 'top_values'):
+            top_vals, sketch_errors = most_occurring_values(conn, queries, table_name, col_counts, datatypes, top_k,
+                                                            sketch_threshold, sketch_capacity)
+
+        for col_name, (non_null_count, unique_count) in col_counts.items():
+            logger.info(f'Number of duplicates = num of non null - number of unique values')
+            stats[col_name] = {
+                'num_rows': row_count,
+                'datatype': datatypes[col_name],
+                'null': row_count-non_null_count,
+                'non_null': non_null_count,
+                'unique': unique_count,
+                'duplicates': non_null_count-unique_count,
+                'top': top_vals[col_name][0] if len(top_vals[col_name])>0 else None,
+                'top_k': top_vals[col_name]
+            }
+            if col_name in sketch_errors:
+                stats[col_name]['top_error'] = sketch_errors[col_name]
+            logger.info(f"Done for {col_name}")
+    except Exception as e:
+        logger.error(f"An error occured while generating the values for {batch}: {e}")
+        raise e
+    return stats
+
+
+def profile_batches_parallel(db, queries: dict, table_name: str, batches: list, datatypes: dict, workers: int, counter: QueryCounter=None,
+                             profiler: QueryProfiler=None, stop_event=None, **profile_options) -> dict:
+
+    '''
+    Profiles the batches of columns concurrently, every worker running on its own connection checked out from the engine's pool.
+    If a worker fails, the pending batches are cancelled, the queries still running on the other workers are cancelled on the server,
+    and every connection is returned to the pool before the error is raised.
+
+    Parameters:
+    db : The connection engine. Its pool should allow at least `workers` connections besides the caller's own.
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    batches (list): List of lists of columns, each profiled by a single worker
+    datatypes (dict): Mapping of column name to its datatype
+    workers (int): Maximum number of batches profiled at the same time
+    counter (QueryCounter): Optional counter of the queries issued by the workers
+    profiler (QueryProfiler): Optional profiler recording the queries issued by the workers
+    stop_event (threading.Event): Optional event cancelling the profile from outside, the workers stop before their next query once it is set
+    profile_options : Keyword arguments passed on to profile_batch, e.g. top_k
+
+    Returns:
+    dict: Mapping of column name to its statistics, see profile_batch.
+    Raises the first exception encountered by a worker.
+    '''
+
+    if stop_event is None:
+        stop_event = threading.Event()
+    active = {}
+    active_lock = threading.Lock()
+
+    def run(batch_id, batch):
+        if stop_event.is_set():
+            raise RuntimeError(f'Profiling of {batch} was cancelled')
+        with db.connect() as worker_conn:
+            for listener in (counter, profiler):
+                if listener is not None:
+                    listener.attach(worker_conn)
+            with active_lock:
+                active[batch_id] = worker_conn.connection.dbapi_connection
+            try:
+                return profile_batch(worker_conn, queries, table_name, batch, datatypes, stop_event, **profile_options)
+            finally:
+                with active_lock:
+                    active.pop(batch_id, None)
+                for listener in (counter, profiler):
+                    if listener is not None:
+                        listener.detach(worker_conn)
+
+    logger.info(f'Profiling {len(batches)} batches of columns with {workers} workers')
+    stats = {}
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='profile')
+    futures = [executor.submit(run, batch_id, batch) for batch_id, batch in enumerate(batches)]
+    try:
+        for future in as_completed(futures):
+            stats.update(future.result())
+    except Exception as e:
+        logger.error(f'A profiling worker failed, cancelling the remaining workers: {e}')
+        stop_event.set()
+        for future in futures:
+            future.cancel()
+        with active_lock:
+            running = list(active.values())
+        for dbapi_conn in running:
+            try:
+                dbapi_conn.cancel()
+            except Exception as cancel_error:
+                logger.warning(f'Could not cancel a running query: {cancel_error}')
+        raise e
+    finally:
+        executor.shutdown(wait=True)
+    return stats
@@ -1,9 +1,28 @@
+import io
 import os
-import random 
+import math
+import uuid
+import random
 import string
-import pandas as pd 
+import pandas as pd
 from datetime import datetime
 from utils.logging_config import logger
+from utils.queries import QUERIES
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Columns added to every row of the results store and the results table, the store is partitioned by the last two
+RUN_ID_COLUMN = 'Run_Id'
+RUN_DATE_COLUMN = 'Run_Date'
+TABLE_NAME_COLUMN = 'Table_Name'
+
+# Columns of the results store always written as text, as they hold the values of parameters of every type
+STORE_TEXT_COLUMNS = ['Expected', 'Actual']
 
 def id_generator(size: int=6, chars: str=string.ascii_uppercase + string.digits) -> str:
     '''
@@ -20,41 +39,327 @@ def id_generator(size: int=6, chars: str=string.ascii_uppercase + string.digits)
 
     return ''.join(random.choice(chars) for _ in range(size))
 
-def export_report_to_csv(report_df: pd.DataFrame) -> int:
+def new_run_id() -> str:
     '''
-    Exports the generated report as a CSV file with a unique filename.
-    It attempts to generate a unique filename with up to 3 retries if a file with the same name already exists.
+    Generates the ID of a run, its start time followed by a random part, e.g. 20240131_120000_1a2b3c4d.
+    Every file exported by a run is named after it, so two runs started in the same second do not collide
+    and the files of a run sort and group together.
+
+    Returns:
+    str: The run ID.
+    '''
+
+    return f'{datetime.now().strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:8]}'
+
+def report_to_arrow(report_df: pd.DataFrame):
+    '''
+    Converts a report to an Arrow table. Numeric, boolean and datetime columns keep their types and every other column is
+    written as text, as in the CSV export, since its values mix types (e.g. a count or MISMATCH) or are lists (Top_K_Vals).
+
+    Parameters:
+    report_df (pd.DataFrame): A Pandas DataFrame containing the report.
+
+    Returns:
+    pyarrow.Table: The report as an Arrow table.
+    '''
+
+    columns = {}
+    for col_name in report_df.columns:
+        values = report_df[col_name]
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            columns[str(col_name)] = pa.array(values)
+        else:
+            columns[str(col_name)] = pa.array([None if value is None or value is pd.NA or (isinstance(value, float) and math.isnan(value))
+                                               else str(value) for value in values], pa.string())
+    return pa.table(columns)
+
+def write_csv(report_df: pd.DataFrame, f):
+    '''
+    Writes a report to a binary file as CSV.
+    '''
+
+    report_df.to_csv(f, index=False)
+
+def write_parquet(report_df: pd.DataFrame, f):
+    '''
+    Writes a report to a binary file as zstd compressed Parquet.
+    '''
+
+    pq.write_table(report_to_arrow(report_df), f, compression='zstd')
+
+def write_arrow(report_df: pd.DataFrame, f):
+    '''
+    Writes a report to a binary file in the Arrow IPC file format, with zstd compressed buffers.
+    '''
+
+    table = report_to_arrow(report_df)
+    with pa.ipc.new_file(f, table.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+        writer.write_table(table)
+
+# Mapping of export format to its file extension, the function writing a report to a binary file and whether it needs pyarrow
+EXPORTERS = {
+    'csv': ('csv', write_csv, False),
+    'parquet': ('parquet', write_parquet, True),
+    'arrow': ('arrow', write_arrow, True)
+}
+
+def export_report_to_file(report_df: pd.DataFrame, file_format: str='csv', prefix: str='Report', run_id: str=None) -> int:
+    '''
+    Exports the generated report under the reports folder as a CSV file, a zstd compressed Parquet file or a zstd compressed Arrow IPC file
+    named <prefix>_<run_id>.<extension>. The file is created exclusively, and if a file with the same name already exists
+    a random suffix is added, with up to 3 retries.
 
     Parameters:
     report_df (pd.DataFrame): A Pandas DataFrame containing the generated report.
+    file_format (str): 'csv', 'parquet' or 'arrow' (default is 'csv').
+    prefix (str): The start of the filename (default is 'Report').
+    run_id (str): The ID of the run, see new_run_id (default is None, a new one).
 
     Returns:
     int: 1 if the export is successful, 0 if the export fails.
     '''
 
+    if file_format not in EXPORTERS:
+        logger.error(f'Unsupported export format {file_format}. Use one of {list(EXPORTERS)}.')
+        return 0
+    extension, write, needs_arrow = EXPORTERS[file_format]
+    if needs_arrow and pa is None:
+        logger.error(f'pyarrow is required to export {file_format} files. Install it with pip install pyarrow')
+        return 0
+
+    run_id = run_id or new_run_id()
+    filename = f'{prefix}_{run_id}.{extension}'
     max_retries = 3
-    filename = 'Report_' + (datetime.now().strftime("%Y%m%d_%H%M%S")) + '.csv'
-    logger.info(f'Checking if filename already exists')
+    while max_retries>0:
+        try:
+            with open(f'./reports/{filename}', 'xb') as f:
+                write(report_df, f)
+            logger.info(f'The report was successfully generated. Filename is {filename}.')
+            print(f'The report was successfully generated. Filename is {filename}.')
+            return 1
+        except FileExistsError:
+            logger.error(f'A file named {filename} already exists. Retrying...')
+            filename = f'{prefix}_{run_id}_{id_generator()}.{extension}'
+            max_retries -= 1
+        except Exception as e:
+            logger.error(f'An unknown error occured. Please retry later. {e}')
+            print('Export failed due to an issue. Please check the logs and retry later!')
+            if os.path.isfile(f'./reports/{filename}'):
+                os.remove(f'./reports/{filename}')
+            return 0
+    logger.error('Max retry attempt reached. Please try generating the report later.')
+    print('Max retry attempt reached. Please try generating the report later.')
+    return 0
+
+def export_report_to_csv(report_df: pd.DataFrame, prefix: str='Report', run_id: str=None) -> int:
+    '''
+    Exports the generated report as a CSV file named after the run, see export_report_to_file.
+
+    Returns:
+    int: 1 if the export is successful, 0 if the export fails.
+    '''
+
+    return export_report_to_file(report_df, 'csv', prefix, run_id)
+
+def export_timing_profile(profiler, prefix: str='Timing', run_id: str=None) -> int:
+    '''
+    Exports the timing profile of a QueryProfiler as a JSON file named after the run under the reports folder, next to its report.
+
+    Parameters:
+    profiler (QueryProfiler): The profiler of the run
+    prefix (str): The start of the filename (default is 'Timing').
+    run_id (str): The ID of the run, see new_run_id (default is None, a new one).
+
+    Returns:
+    int: 1 if the export is successful, 0 if the export fails.
+    '''
+
+    run_id = run_id or new_run_id()
+    filename = f'{prefix}_{run_id}.json'
+    max_retries = 3
+    while max_retries>0:
+        try:
+            profiler.write(f'./reports/{filename}')
+            logger.info(f'The timing profile was successfully generated. Filename is {filename}.')
+            print(f'The timing profile was successfully generated. Filename is {filename}.')
+            return 1
+        except FileExistsError:
+            logger.error(f'A file named {filename} already exists. Retrying...')
+            filename = f'{prefix}_{run_id}_{id_generator()}.json'
+            max_retries -= 1
+        except Exception as e:
+            logger.error(f'An error occured while exporting the timing profile {filename}. {e}')
+            return 0
+    logger.error('Max retry attempt reached. Please try generating the timing profile later.')
+    return 0
+
+def export_report_to_postgres(report_df: pd.DataFrame, db, results_table: str, table_name: str=None, run_id: str=None) -> int:
+    '''
+    Appends the generated report to a results table with a single COPY, creating the table if it does not exist
+    and adding the report's columns it lacks, so that reports of any shape share it.
+    Every row gets the Run_Id, Run_Date and Table_Name columns, the report's own columns are stored as text
+    and the table is indexed on (Run_Date, Table_Name), so that the history of a table or of the last days is read from the index.
+    The table is created and altered under a transaction-level advisory lock on its name, so that concurrent runs do not race
+    on its definition, and committed before the COPY, so that they still copy their rows concurrently.
+
+    Parameters:
+    report_df (pd.DataFrame): A Pandas DataFrame containing the generated report.
+    db (engine object): The engine of the database storing the results
+    results_table (schema_name.table_name): The results table
+    table_name (str): The table the report describes (default is None).
+    run_id (str): The ID of the run, see new_run_id (default is None, a new one).
+
+    Returns:
+    int: 1 if the export is successful, 0 if the export fails.
+    '''
+
+    queries = QUERIES
+    run_id = run_id or new_run_id()
+    schema, table = results_table.split(".")
+    report_cols = [str(col_name) for col_name in report_df.columns]
+    result_cols = [RUN_ID_COLUMN, RUN_DATE_COLUMN, TABLE_NAME_COLUMN]+report_cols
+    col_defs = ', '.join(f'ADD COLUMN IF NOT EXISTS "{col_name}" text' for col_name in report_cols)
+    rows = report_df.copy()
+    rows.columns = report_cols
+    rows.insert(0, TABLE_NAME_COLUMN, table_name)
+    rows.insert(0, RUN_DATE_COLUMN, datetime.now().strftime('%Y-%m-%d'))
+    rows.insert(0, RUN_ID_COLUMN, run_id)
+    buffer = io.StringIO()
+    rows.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    raw_conn = db.raw_connection()
     try:
-        report_df.to_csv(f'./reports/{filename}', mode='x', index=False)
-        logger.info(f'The report was successfully generated. Filename is {filename}.')
-        print(f'The report was successfully generated. Filename is {filename}.')
+        cursor = raw_conn.cursor()
+        cursor.execute(queries['results_lock_query'], (results_table,))
+        for query in (queries['results_table_query'].format(schema=schema, table=table),
+                      queries['results_columns_query'].format(schema=schema, table=table, col_defs=col_defs),
+                      queries['results_index_query'].format(schema=schema, table=table)):
+            logger.info(query)
+            cursor.execute(query)
+        raw_conn.commit()
+        copy_query = queries['copy_results_query'].format(schema=schema, table=table, col_list=', '.join(f'"{col_name}"' for col_name in result_cols))
+        logger.info(copy_query)
+        cursor.copy_expert(copy_query, buffer)
+        raw_conn.commit()
+        logger.info(f'{rows.shape[0]} rows of run {run_id} were copied to {results_table}.')
+        print(f'The report was successfully copied to {results_table}.')
         return 1
-    except FileExistsError:
-        while max_retries>0:
-            filename = 'Report_' + id_generator() + '.csv'
-            if os.path.isfile(filename)==True:
-                logger.error(f'A file with the same name already exists. Retrying...')
-                max_retries -= 1
-            else:
-                logger.info(f'The report was successfully generated. Filename is {filename}.')
-                print(f'The report was successfully generated. Filename is {filename}.')
-                report_df.to_csv(f'./reports/{filename}', mode='x', index=False)
-                return 1
     except Exception as e:
-        logger.error(f'An unknown error occured. Please retry later. {e}')
+        raw_conn.rollback()
+        logger.error(f'An error occured while copying the report to {results_table}. {e}')
         print('Export failed due to an issue. Please check the logs and retry later!')
         return 0
-    logger.error('Max retry attempt reached. Please try generating the report later.')
-    print('Max retry attempt reached. Please try generating the report later.')
-    return 0
\ No newline at end of file
+    finally:
+        raw_conn.close()
+
+def export_report(report_df: pd.DataFrame, formats: list=('csv',), prefix: str='Report', run_id: str=None, db=None,
+                  results_table: str=None, table_name: str=None) -> int:
+    '''
+    Exports the generated report in every requested format: 'csv', 'parquet' and 'arrow' files under the reports folder,
+    see export_report_to_file, and 'copy' to a PostgreSQL results table, see export_report_to_postgres.
+
+    Parameters:
+    report_df (pd.DataFrame): A Pandas DataFrame containing the generated report.
+    formats (list): The export formats (default is csv only).
+    prefix (str): The start of the filenames (default is 'Report').
+    run_id (str): The ID of the run, shared by all the exports (default is None, a new one).
+    db (engine object): With 'copy', the engine of the database storing the results
+    results_table (schema_name.table_name): With 'copy', the results table
+    table_name (str): With 'copy', the table the report describes (default is None).
+
+    Returns:
+    int: 1 if every export is successful, 0 if any fails.
+    '''
+
+    run_id = run_id or new_run_id()
+    res = 1
+    for file_format in formats:
+        if file_format=='copy':
+            if db is None or results_table is None:
+                logger.error('A database and a results table are required to copy the report.')
+                res = 0
+            else:
+                res = min(res, export_report_to_postgres(report_df, db, results_table, table_name, run_id))
+        else:
+            res = min(res, export_report_to_file(report_df, file_format, prefix, run_id))
+    return res
+
+def append_to_results_store(report_df: pd.DataFrame, table_name: str, run_id: str=None, store_dir: str='./reports/results') -> int:
+    '''
+    Appends the generated report to the results store, a Parquet dataset partitioned by run date and table
+    (<store_dir>/Run_Date=<date>/Table_Name=<table>/<run_id>-<random part>-0.parquet), so that history queries only read the partitions they select.
+    The store is meant for the diffs of diff_reports, whose columns are the same for every run, see read_results_store.
+    The STORE_TEXT_COLUMNS are written as text whatever their dtype, so that the files of all the runs share one schema.
+    A report without rows, e.g. the diff of matching reports, writes no file.
+
+    Parameters:
+    report_df (pd.DataFrame): A Pandas DataFrame containing the generated report.
+    table_name (str): The table the report describes
+    run_id (str): The ID of the run, see new_run_id (default is None, a new one).
+    store_dir (str): Root folder of the store (default is ./reports/results).
+
+    Returns:
+    int: 1 if the report is appended, 0 if it fails.
+    '''
+
+    if pa is None:
+        logger.error('pyarrow is required to append to the results store. Install it with pip install pyarrow')
+        return 0
+
+    run_id = run_id or new_run_id()
+    rows = report_df.copy()
+    rows.insert(0, RUN_ID_COLUMN, run_id)
+    rows[RUN_DATE_COLUMN] = datetime.now().strftime('%Y-%m-%d')
+    rows[TABLE_NAME_COLUMN] = table_name
+    for col_name in STORE_TEXT_COLUMNS:
+        if col_name in rows.columns:
+            rows[col_name] = rows[col_name].astype(object)
+    try:
+        ds.write_dataset(report_to_arrow(rows), store_dir, format='parquet', partitioning=[RUN_DATE_COLUMN, TABLE_NAME_COLUMN],
+                         partitioning_flavor='hive', basename_template=f'{run_id}-{uuid.uuid4().hex[:8]}-{{i}}.parquet',
+                         existing_data_behavior='overwrite_or_ignore', file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'))
+    except Exception as e:
+        logger.error(f'An error occured while appending the report of {table_name} to {store_dir}. {e}')
+        return 0
+    logger.info(f'{rows.shape[0]} rows of run {run_id} were appended to the results store {store_dir}.')
+    return 1
+
+def read_results_store(store_dir: str='./reports/results', table_name: str=None, since: str=None, status: str=None) -> pd.DataFrame:
+    '''
+    Reads the reports appended to the results store. The table and date filters prune the partitions,
+    so that e.g. all the mismatches of the last 30 days only read the files of those days:
+    read_results_store(since=(datetime.now()-timedelta(days=30)).strftime('%Y-%m-%d'), status='MISMATCH')
+
+    Parameters:
+    store_dir (str): Root folder of the store (default is ./reports/results).
+    table_name (str): Only read the reports of this table (default is None, every table).
+    since (str): Only read the reports of this date, formatted as YYYY-MM-DD, and later (default is None, every date).
+    status (str): Only read the rows with this Status, e.g. MISMATCH (default is None, every row).
+
+    Returns:
+    pd.DataFrame: The rows read, with the Run_Id, Run_Date and Table_Name columns. Returns None if any error is encountered.
+    '''
+
+    if pa is None:
+        logger.error('pyarrow is required to read the results store. Install it with pip install pyarrow')
+        return None
+
+    partitioning = ds.partitioning(pa.schema([(RUN_DATE_COLUMN, pa.string()), (TABLE_NAME_COLUMN, pa.string())]), flavor='hive')
+    conditions = []
+    if table_name is not None:
+        conditions.append(ds.field(TABLE_NAME_COLUMN)==table_name)
+    if since is not None:
+        conditions.append(ds.field(RUN_DATE_COLUMN)>=since)
+    if status is not None:
+        conditions.append(ds.field('Status')==status)
+    row_filter = None
+    for condition in conditions:
+        row_filter = condition if row_filter is None else row_filter & condition
+    try:
+        results = ds.dataset(store_dir, format='parquet', partitioning=partitioning).to_table(filter=row_filter).to_pandas()
+    except Exception as e:
+        logger.error(f'An error occured while reading the results store {store_dir}. {e}')
+        return None
+    logger.info(f'{results.shape[0]} rows read from the results store {store_dir}')
+    return results
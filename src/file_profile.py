@@ -0,0 +1,278 @@
+from utils.logging_config import logger
+from src.generate_report import build_report
+from src.sampled_profile import Z_SCORE
+from src.sketches import HyperLogLog, MisraGries
+from src.top_values import as_report_value
+import pandas as pd
+import numpy as np
+import math
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pcsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# PostgreSQL's names of the Arrow types, as information_schema.columns reports them, so that file reports compare with table reports
+ARROW_TYPE_NAMES = [
+    ('is_boolean', 'boolean'), ('is_int8', 'smallint'), ('is_int16', 'smallint'), ('is_int32', 'integer'), ('is_int64', 'bigint'),
+    ('is_uint8', 'smallint'), ('is_uint16', 'integer'), ('is_uint32', 'bigint'), ('is_uint64', 'numeric'),
+    ('is_float16', 'real'), ('is_float32', 'real'), ('is_float64', 'double precision'), ('is_decimal', 'numeric'),
+    ('is_string', 'text'), ('is_large_string', 'text'), ('is_binary', 'bytea'), ('is_large_binary', 'bytea'), ('is_date', 'date'),
+    ('is_time', 'time without time zone'), ('is_duration', 'interval'), ('is_null', 'text')
+]
+
+# Families of the PostgreSQL datatypes a file can tell apart. A file does not keep the width of a table's integers, the precision of its numbers
+# or the string types of its text, e.g. an integer column is written as int64 by pandas and a uuid column as a string in a CSV
+DATATYPE_FAMILIES = {
+    'smallint': 'number', 'integer': 'number', 'bigint': 'number', 'real': 'number', 'double precision': 'number', 'numeric': 'number',
+    'text': 'text', 'character varying': 'text', 'character': 'text', 'uuid': 'text', 'json': 'text', 'jsonb': 'text', 'xml': 'text',
+    'inet': 'text', 'cidr': 'text', 'macaddr': 'text', 'USER-DEFINED': 'text',
+    'timestamp with time zone': 'timestamp', 'timestamp without time zone': 'timestamp',
+    'time with time zone': 'time', 'time without time zone': 'time'
+}
+
+def datatype_family(datatype):
+
+    '''
+    Returns the family of a PostgreSQL datatype name, see DATATYPE_FAMILIES, or the name itself if it has none.
+    '''
+
+    return DATATYPE_FAMILIES.get(datatype, datatype)
+
+
+def postgres_type(arrow_type) -> str:
+
+    '''
+    Returns the PostgreSQL datatype name of an Arrow type, e.g. 'bigint' for int64 or 'timestamp with time zone' for a timestamp with a time zone.
+    '''
+
+    if pa.types.is_dictionary(arrow_type):
+        return postgres_type(arrow_type.value_type)
+    if pa.types.is_timestamp(arrow_type):
+        return 'timestamp with time zone' if arrow_type.tz is not None else 'timestamp without time zone'
+    for check, name in ARROW_TYPE_NAMES:
+        if getattr(pa.types, check)(arrow_type):
+            return name
+    return str(arrow_type)
+
+
+def record_batches(path: str, file_format: str, batch_size: int=1000000, block_size: int=64<<20, column_types: dict=None):
+
+    '''
+    Streams the record batches of a CSV or Parquet file, so that only one batch is held in memory at a time.
+    CSV column types are inferred from the first block, empty fields are read as nulls and t and f as booleans.
+
+    Parameters:
+    path (str): Path of the file
+    file_format (str): 'csv' or 'parquet'
+    batch_size (int): Number of rows per Parquet batch (default is 1000000).
+    block_size (int): Number of bytes per CSV block (default is 64 MiB).
+    column_types (dict): Optional mapping of CSV column name to its pyarrow type, for columns the first block does not tell the type of
+
+    Yields:
+    pyarrow.RecordBatch: The batches of the file.
+    '''
+
+    if file_format=='parquet':
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+    else:
+        read_options = pcsv.ReadOptions(block_size=block_size)
+        # PostgreSQL's COPY writes booleans as t and f
+        convert_options = pcsv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True,
+                                              true_values=['t', 'true', 'True', 'TRUE', '1'], false_values=['f', 'false', 'False', 'FALSE', '0'])
+        yield from pcsv.open_csv(path, read_options=read_options, convert_options=convert_options)
+
+
+def hash_values(values) -> np.ndarray:
+
+    '''
+    Returns the 64 bit hashes of the values of an Arrow array.
+    '''
+
+    return pd.util.hash_array(values.to_numpy(zero_copy_only=False))
+
+
+def update_hll(sketch: HyperLogLog, hashes: np.ndarray):
+
+    '''
+    Adds 64 bit hashes to a HyperLogLog sketch, with the register and rank conventions of hll_query in utils/queries.json:
+    the low p bits pick the register and the rank is the position of the first 1 bit of the remaining ones, from the most significant.
+    '''
+
+    rest_bits = sketch.hash_bits-sketch.p
+    indexes = (hashes & np.uint64(sketch.num_registers-1)).astype(np.int64)
+    rest = hashes >> np.uint64(sketch.p)
+    # frexp is exact on 32 bit halves, the exponent it returns is their bit length
+    high_length = np.frexp((rest >> np.uint64(32)).astype(np.float64))[1]
+    low_length = np.frexp((rest & np.uint64(0xFFFFFFFF)).astype(np.float64))[1]
+    bit_length = np.where(high_length>0, high_length+32, low_length)
+    sketch.update_registers(indexes, rest_bits-bit_length+1)
+
+
+def batch_heavy_hitters(value_counts, capacity: int) -> MisraGries:
+
+    '''
+    Builds the Misra-Gries sketch of a batch from its exact value counts, keeping the capacity largest counts
+    minus the next largest one, which is the sketch the batch would have produced value by value and can be merged.
+    '''
+
+    sketch = MisraGries(capacity)
+    sketch.total = pc.sum(value_counts['counts']).as_py() or 0
+    if value_counts.num_rows>capacity:
+        value_counts = value_counts.take(pc.select_k_unstable(value_counts, capacity+1, [('counts', 'descending')]))
+        value_counts = value_counts.sort_by([('counts', 'descending')])
+        sketch.error = value_counts['counts'][capacity].as_py()
+        value_counts = value_counts.slice(0, capacity)
+    for value, count in zip(value_counts['values'].to_pylist(), value_counts['counts'].to_pylist()):
+        if count>sketch.error:
+            sketch.counters[as_report_value(value)] = count-sketch.error
+    return sketch
+
+
+def update_column(state: dict, array, exact_limit: int, sketch_capacity: int, hll_precision: int):
+
+    '''
+    Adds a batch of a column's values to its state. The distinct values are counted exactly in an Arrow table merged batch by batch,
+    until there are more than exact_limit of them, after which they are counted by a HyperLogLog and a Misra-Gries sketch.
+    '''
+
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    state['num_rows'] += len(array)
+    state['non_null'] += len(array)-array.null_count
+    values = pc.drop_null(array)
+    if len(values)==0:
+        return
+    counted = pc.value_counts(values)
+    value_counts = pa.table({'values': counted.field('values'), 'counts': counted.field('counts')})
+
+    if state['counts'] is not None:
+        merged = pa.concat_tables([state['counts'], value_counts]).group_by('values').aggregate([('counts', 'sum')])
+        state['counts'] = pa.table({'values': merged['values'], 'counts': merged['counts_sum']})
+        if state['counts'].num_rows<=exact_limit:
+            return
+        logger.info(f"{state['name']} has more than {exact_limit} distinct values, counting them with sketches")
+        value_counts = state['counts']
+        state['counts'] = None
+        state['hll'] = HyperLogLog(hll_precision, hash_bits=64)
+        state['mg'] = MisraGries(sketch_capacity)
+
+    update_hll(state['hll'], hash_values(value_counts['values']))
+    state['mg'].merge(batch_heavy_hitters(value_counts, sketch_capacity))
+    smallest = as_report_value(pc.min(value_counts['values']).as_py())
+    state['min'] = smallest if state['min'] is None else min(state['min'], smallest)
+
+
+def column_stats(state: dict, top_k: int=1) -> dict:
+
+    '''
+    Derives a column's statistics from its state, in the format of profile_batch.
+    Sketched columns also get the unique_error, duplicates_error and top_error bounds.
+    '''
+
+    non_null_count = state['non_null']
+    col_stats = {}
+    if state['counts'] is not None:
+        unique_count = state['counts'].num_rows
+        ranked = state['counts'].sort_by([('counts', 'descending'), ('values', 'ascending')]).slice(0, top_k)
+        top = [as_report_value(value) for value in ranked['values'].to_pylist()]
+    elif state['hll'] is not None:
+        estimate = state['hll'].estimate()
+        unique_count = min(round(estimate), non_null_count)
+        top = [value for value, _ in state['mg'].top(top_k)]
+        if len(top)==0:
+            # Every tracked count was pruned, so no value stands out and exact mode would report the smallest one
+            top = [state['min']]
+        error = math.ceil(Z_SCORE*state['hll'].relative_error()*estimate)
+        col_stats = {'unique_error': error, 'duplicates_error': error, 'top_error': state['mg'].error}
+    else:
+        unique_count, top = 0, []
+    if len(top)==0:
+        top = [None]
+    return {
+        'num_rows': state['num_rows'],
+        'datatype': state['datatype'],
+        'null': state['num_rows']-non_null_count,
+        'non_null': non_null_count,
+        'unique': unique_count,
+        'duplicates': non_null_count-unique_count,
+        'top': top[0],
+        'top_k': top,
+        **col_stats
+    }
+
+
+def file_summary(path: str, file_format: str=None, top_k: int=1, exact_limit: int=100000, sketch_capacity: int=1000,
+                 hll_precision: int=14, batch_size: int=1000000, block_size: int=64<<20, column_types: dict=None,
+                 stop_event=None) -> pd.DataFrame:
+
+    '''
+    Generates the summary report of a CSV or Parquet extract, with the same columns as dataframe_summary so that it can be compared
+    with compare_dataframes. The file is read in a single streaming pass, one record batch at a time, and every statistic
+    is computed with Arrow's vectorized kernels, so memory is bounded by the batch size and exact_limit, not by the size of the file.
+    Columns with more than exact_limit distinct values are counted with HyperLogLog and Misra-Gries sketches,
+    and the Num_Unique_Vals_Error and Num_Of_Duplicates_Error columns are then added.
+
+    Parameters:
+    path (str): Path of the file, ending with .csv, .csv.gz, .parquet or .pq unless file_format is given
+    file_format (str): 'csv' or 'parquet' (default is None, from the extension).
+    top_k (int): Number of most occurring values computed per column (default is 1).
+    exact_limit (int): Number of distinct values per column counted exactly before switching to sketches (default is 100000).
+    sketch_capacity (int): Number of counters of the Misra-Gries sketches (default is 1000).
+    hll_precision (int): Register index bits of the HyperLogLog sketches (default is 14, a ~0.8% standard error).
+    batch_size (int): Number of rows per Parquet batch (default is 1000000).
+    block_size (int): Number of bytes per CSV block (default is 64 MiB).
+    column_types (dict): Optional mapping of CSV column name to its pyarrow type, when the first block cannot tell it
+    stop_event (threading.Event): Optional event cancelling the profile from outside, it stops before the next batch once it is set.
+
+    Returns:
+    pd.DataFrame: The report. Datatypes are named after PostgreSQL's types, e.g. bigint, double precision or text,
+    and compare_dataframes compares them with a table's datatypes by family, see datatype_family.
+    Raises ImportError if pyarrow is not installed, ValueError if the format is not supported and RuntimeError if it is cancelled.
+    '''
+
+    if pa is None:
+        logger.error('pyarrow is required to profile files. Install it with pip install pyarrow')
+        raise ImportError('pyarrow is required to profile files')
+    if file_format is None:
+        name = path.lower()[:-3] if path.lower().endswith('.gz') else path.lower()
+        file_format = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet'}.get(os.path.splitext(name)[1])
+    if file_format not in ('csv', 'parquet'):
+        logger.error(f'Cannot profile {path}, only CSV and Parquet files are supported')
+        raise ValueError(f'Unsupported file format for {path}')
+
+    logger.info(f'Profiling the {file_format} file {path}')
+    states = {}
+    num_batches = 0
+    try:
+        for batch in record_batches(path, file_format, batch_size, block_size, column_types):
+            if stop_event is not None and stop_event.is_set():
+                raise RuntimeError(f'Profiling of {path} was cancelled')
+            num_batches += 1
+            for col_name, array in zip(batch.schema.names, batch.columns):
+                if col_name not in states:
+                    value_type = array.type.value_type if pa.types.is_dictionary(array.type) else array.type
+                    states[col_name] = {'name': col_name, 'datatype': postgres_type(array.type), 'num_rows': 0, 'non_null': 0,
+                                        'counts': pa.table({'values': pa.array([], value_type), 'counts': pa.array([], pa.int64())}),
+                                        'hll': None, 'mg': None, 'min': None}
+                update_column(states[col_name], array, exact_limit, sketch_capacity, hll_precision)
+    except Exception as e:
+        logger.error(f'An error occured while reading batch {num_batches} of {path}: {e}')
+        raise e
+
+    col_names_list = sorted(states)
+    stats = {col_name: column_stats(states[col_name], top_k) for col_name in col_names_list}
+    if any('unique_error' in col_stats for col_stats in stats.values()):
+        for col_stats in stats.values():
+            col_stats.setdefault('unique_error', 0)
+            col_stats.setdefault('duplicates_error', 0)
+
+    report = build_report(stats, col_names_list, 'file', top_k)
+    report.attrs['mode'] = 'file'
+    report.attrs['batches'] = num_batches
+    logger.info(f'Report generated successfully for {path} with shape {report.shape} from {num_batches} batches!')
+    return report
@@ -1,26 +1,170 @@
 from utils.logging_config import logger
+from utils.query_counter import QueryCounter
+from utils.query_profiler import QueryProfiler, query_label
+from utils.queries import QUERIES
+from utils.schema_cache import get_columns, SCHEMA_CACHE_DIR
+from src.sampled_profile import sampled_profile, ERROR_SUFFIX
+from src.catalog_profile import catalog_profile, FRESHNESS_COLUMN
+from src.top_values import TOP_K_COLUMN
+from src.exact_profile import profile_batch, profile_batches_parallel
+from src.incremental_profile import incremental_profile
+from src.partition_profile import partition_profile
+from src.planned_profile import planned_profile, PLAN_COLUMN, DEGRADED_COLUMN
 import pandas as pd
 from sqlalchemy import text
-import json
+import math
+import random
 
-def dataframe_summary(conn, table_name: str, db):
+def build_report(stats: dict, col_names_list: list, mode: str='exact', top_k: int=1) -> pd.DataFrame:
+
+    '''
+    Builds the summary report from the statistics of every column, adding the columns specific to the profile mode:
+    the error bounds of estimated parameters, the freshness of catalog statistics and the top k values.
+
+    Parameters:
+    stats (dict): Mapping of column name to its num_rows, datatype, null, non_null, unique, duplicates and top values
+    col_names_list (list): The columns of the report, in order
+    mode (str): The profile mode the statistics were computed with (default is 'exact').
+    top_k (int): Number of most occurring values computed per column (default is 1).
+
+    Returns:
+    pd.DataFrame: The report. The count error bounds of the columns whose most occurring values were sketched are stored in
+                  report.attrs['sketched_columns'], and the statistics of a planned mode report which fell back to a cheaper strategy
+                  after a timeout in report.attrs['degraded_columns'].
+    '''
+
+    num_rows = []
+    datatype = []
+    null = []
+    non_null = []
+    unique = []
+    duplicates = []
+    top = []
+
+    for col_name in col_names_list:
+        col_stats = stats[col_name]
+        num_rows.append(col_stats['num_rows'])
+        datatype.append(col_stats['datatype'])
+        null.append(col_stats['null'])
+        non_null.append(col_stats['non_null'])
+        unique.append(col_stats['unique'])
+        duplicates.append(col_stats['duplicates'])
+        top.append(col_stats['top'])
+    
+    report = pd.DataFrame({
+        'Column':col_names_list,
+        'Num_Of_Rows':num_rows,
+        'Datatype':datatype,
+        'Num_Of_Nulls':null,
+        'Num_Of_Non_Nulls':non_null,
+        'Num_Unique_Vals':unique,
+        'Num_Of_Duplicates':duplicates,
+        'Most_Occurring_Vals':top
+    })
+    if mode in ('fast', 'planned'):
+        for param, key in [('Num_Of_Rows', 'num_rows_error'), ('Num_Of_Nulls', 'null_error'), ('Num_Of_Non_Nulls', 'non_null_error'),
+                           ('Num_Unique_Vals', 'unique_error'), ('Num_Of_Duplicates', 'duplicates_error'),
+                           ('Most_Occurring_Vals', 'top_vals_error')]:
+            report[param+ERROR_SUFFIX] = [stats[col_name].get(key) for col_name in col_names_list]
+    elif any('unique_error' in stats[col_name] for col_name in col_names_list):
+        report['Num_Unique_Vals'+ERROR_SUFFIX] = [stats[col_name]['unique_error'] for col_name in col_names_list]
+        report['Num_Of_Duplicates'+ERROR_SUFFIX] = [stats[col_name]['duplicates_error'] for col_name in col_names_list]
+    elif mode=='catalog':
+        report[FRESHNESS_COLUMN] = [stats[col_name]['last_analyzed'] for col_name in col_names_list]
+    if mode=='planned':
+        report[PLAN_COLUMN] = [stats[col_name]['plan'] for col_name in col_names_list]
+        report[DEGRADED_COLUMN] = [stats[col_name]['degraded'] for col_name in col_names_list]
+        degraded = {col_name: stats[col_name]['degraded'] for col_name in col_names_list if stats[col_name]['degraded']!=''}
+        if len(degraded)>0:
+            logger.warning(f'Statistics of {len(degraded)} columns fell back to a cheaper strategy after a timeout: {degraded}')
+            report.attrs['degraded_columns'] = degraded
+    if top_k>1 and mode not in ('catalog', 'incremental'):
+        report[TOP_K_COLUMN] = [stats[col_name]['top_k'] for col_name in col_names_list]
+    sketch_errors = {col_name: stats[col_name]['top_error'] for col_name in col_names_list if 'top_error' in stats[col_name]}
+    if len(sketch_errors)>0:
+        logger.warning(f'The most occurring values of {list(sketch_errors)} come from heavy hitters sketches, their count error bounds are {sketch_errors}')
+        report.attrs['sketched_columns'] = sketch_errors
+    return report
+
+
+def dataframe_summary(conn, table_name: str, db, batch_size: int=100, workers: int=1, mode: str='exact',
+                      sample_pct: float=1.0, sample_method: str='SYSTEM', top_k: int=1, sketch_threshold: int=None,
+                      sketch_capacity: int=1000, watermark_column: str=None, state_dir: str='./state', partitions: int=None,
+                      partition_column: str=None, exact_distinct: bool=True, dispose: bool=True, profiler: QueryProfiler=None,
+                      cache_dir: str=SCHEMA_CACHE_DIR, time_budget: float=None, statement_timeout: float=None, stop_event=None):
 
     '''
     Generates a summary report for the table. 
     This code assumes multiple schemas with the same table name does not exist.
+    The counts for all the columns are computed with one aggregate query per batch of columns instead of one query per statistic per column.
 
     Parameters:
     conn (connection object): The connection object to a database
     table_name (schema_name.table_name): The schema and table name to generate the report for
     db : The connection engine
+    batch_size (int): Maximum number of columns profiled by a single aggregate query (default is 100).
+                      Lower it for very wide tables if the database struggles with the number of aggregates.
+    workers (int): Number of batches profiled concurrently, each on its own pooled connection from db (default is 1, i.e. sequential on conn).
+                   The engine's pool_size should be at least this large. Only the exact and partition modes use it.
+    mode (str): 'exact' computes every statistic exactly (default).
+                'fast' estimates the counts and the most occurring value from a TABLESAMPLE and the unique counts with HyperLogLog,
+                and adds a <parameter>_Error column with the 95% error bound of every estimated parameter. The HyperLogLog sketches
+                still read the whole table once, see hll_sketches, it is the GROUP BY of the most occurring values this mode saves.
+                The error of Most_Occurring_Vals is empty when the sample cannot tell the most occurring value apart from the runner-up.
+                'catalog' builds the report from the planner statistics in pg_class and pg_stats without scanning the table,
+                and adds a Last_Analyzed column. See refine_catalog_report to rescan the columns the owner disagrees with.
+                'incremental' reuses the statistics stored by the previous run of the table in state_dir, only profiling the rows
+                appended past watermark_column, see incremental_profile. It adds the Num_Unique_Vals_Error and Num_Of_Duplicates_Error
+                columns, 0 while the unique counts are exact.
+                'partition' splits the scan into the table's partitions or into ranges of its pages or of partition_column,
+                profiled in parallel by `workers` processes whose partial results are merged, see partition_profile.
+                'planned' picks per column and statistic between the exact, sampled and catalog strategies so that the profile fits
+                time_budget, and falls back to a cheaper strategy when a query times out, see planned_profile. Like the fast mode it adds
+                the <parameter>_Error columns, empty for catalog estimates, along with the Profile_Plan and Degraded columns.
+    sample_pct (float): Percentage of the table sampled in fast and planned mode (default is 1).
+    sample_method (str): TABLESAMPLE method used in fast and planned mode, 'SYSTEM' or 'BERNOULLI' (default is 'SYSTEM').
+    top_k (int): Number of most occurring values computed per column in exact, fast and planned mode (default is 1).
+                 When larger than 1 they are listed, most occurring first, in a Top_K_Vals column.
+    sketch_threshold (int): In exact mode, unique count above which a column's most occurring values are found with a bounded memory
+                            heavy hitters sketch instead of an exact GROUP BY (default is None, never).
+    sketch_capacity (int): Number of counters of the heavy hitters sketches (default is 1000).
+    watermark_column (str): In incremental mode, an ever increasing column enabling append-only runs (default is None, full runs on changes).
+    state_dir (str): In incremental mode, folder storing the statistics between runs (default is ./state).
+    partitions (int): In partition mode, number of ranges unpartitioned tables are split into (default is 4 per worker).
+    partition_column (str): In partition mode, numeric column to split unpartitioned tables by instead of their pages (default is None).
+    exact_distinct (bool): In partition mode, merge the distinct values exactly, spilling them to disk when needed (default is True).
+                           When False they are merged as sketches and the Num_Unique_Vals_Error and Num_Of_Duplicates_Error columns are added.
+    dispose (bool): Dispose of the engine once the report is generated (default is True). Pass False when the engine is shared.
+    profiler (QueryProfiler): Optional profiler recording the time, rows, columns and statistic of every query issued on conn
+                              and on the exact mode workers' connections. The ranges of the partition mode are profiled by other processes
+                              whose queries are not recorded.
+    cache_dir (str): Folder of the schema cache the table's columns are read from while the table is unchanged, see get_columns
+                     (default is ./state/schema).
+    time_budget (float): In planned mode, seconds the profile of the table should take (default is None, no budget).
+    statement_timeout (float): In planned mode, maximum seconds of any single query (default is None, only limited by the budget).
+    stop_event (threading.Event): Optional event, an exact mode profile stops before its next query once it is set (default is None).
 
     Returns:
     pd.DataFrame: A DataFrame containing a summary of the original DataFrame including shape, null counts,
                   non null counts, duplicate counts, data types, and unique value counts for every column.
+                  The number of queries issued is stored in report.attrs['query_count'].
                   Returns None if some error occurs.
 
     '''
     
+    mode = mode.strip().lower()
+    if mode not in ('exact', 'fast', 'catalog', 'incremental', 'partition', 'planned'):
+        logger.error(f"Unexpected profile mode {mode}. Use 'exact', 'fast', 'catalog', 'incremental', 'partition' or 'planned'.")
+        return None
+    if workers>1 and mode not in ('exact', 'partition'):
+        logger.warning(f'The {mode} mode profiles the table on a single connection, workers={workers} is ignored')
+
+    counter = QueryCounter().attach(conn)
+    listeners = [counter] if profiler is None else [counter, profiler.attach(conn)]
+    def detach():
+        for listener in listeners:
+            listener.detach(conn)
+
     # Test connection
     logger.info(f"Checking if {table_name} is accessible...")
     test_query = f'SELECT * FROM {table_name} LIMIT 1;'
@@ -29,103 +173,135 @@ def dataframe_summary(conn, table_name: str, db):
         logger.info(f'{table_name} is accessible')
     except Exception as e:
         logger.error(f'Table is not accessible: {e}')
+        detach()
         return None
     
-    # Fetching queries json, make additions to queries in this template file and add it in the code
-    logger.info("Retrieving query template")
-    with open(f'./utils/queries.json', 'r') as f:
-        queries = json.load(f)
-        
-    logger.info("Retrieving column names")
-    schema, table = table_name.split(".")
-    col_names_query = queries['col_names_query'].format(schema=schema,table=table)
-    col_names_list = list(pd.read_sql_query(col_names_query,conn)['column_name'])
-    col_names_list.sort()
-    logger.info(f'Column Names are {col_names_list}')
+    # The query templates of utils/queries.json are loaded once per process, make additions to queries in this template file
+    queries = QUERIES
 
-    num_rows = []
-    datatype = []
-    null = []
-    non_null = []
-    unique = []
-    duplicates = []
-    top = []
+    logger.info("Retrieving column names and datatypes")
+    with query_label([], 'columns'):
+        datatypes = get_columns(conn, table_name, cache_dir)
+    col_names_list = sorted(datatypes)
+    logger.info(f'Column Names are {col_names_list}')
 
-    for col_name in col_names_list:
-        logger.info(f"Generating queries for {col_name}")
-        try:
-            num_rows_query = queries['num_rows_query'].format(table_name=table_name)
-            datatype_query = queries['datatype_query'].format(table=table,col_name=col_name)
-            num_null_query = queries['num_null_query'].format(table_name=table_name,col_name=col_name)
-            num_non_null_query = queries['num_non_null_query'].format(table_name=table_name,col_name=col_name)
-            num_unique_query = queries['num_unique_query'].format(table_name=table_name,col_name=col_name)
-            top_query = queries['top_query'].format(table_name=table_name,col_name=col_name)
-            logger.info("Queries generated successfully")
-        except Exception as e:
-            conn.close()
+    if workers>1 and mode=='exact':
+        # Splitting the columns so that every worker gets a share of them
+        batch_size = max(1, min(batch_size, math.ceil(len(col_names_list)/workers)))
+    batches = [col_names_list[start:start+batch_size] for start in range(0, len(col_names_list), batch_size)]
+    try:
+        if mode=='fast':
+            seed = random.randint(0, 2**31-1)
+            stats = {}
+            for batch in batches:
+                with query_label(batch, 'sample'):
+                    stats.update(sampled_profile(conn, queries, table_name, batch, datatypes, sample_pct, sample_method, seed, top_k=top_k))
+        elif mode=='catalog':
+            with query_label(col_names_list, 'catalog'):
+                stats = catalog_profile(conn, queries, table_name, col_names_list, datatypes)
+        elif mode=='incremental':
+            with query_label(col_names_list, 'incremental'):
+                stats = incremental_profile(conn, queries, table_name, col_names_list, datatypes, watermark_column, state_dir,
+                                            batch_size, sketch_capacity)
+        elif mode=='partition':
+            with query_label(col_names_list, 'partition'):
+                stats = partition_profile(db, queries, table_name, col_names_list, datatypes, max(1, workers), partitions, partition_column,
+                                          batch_size, top_k, exact_distinct, sketch_capacity=sketch_capacity, counter=counter)
+        elif mode=='planned':
+            stats = planned_profile(conn, queries, table_name, col_names_list, datatypes, time_budget, statement_timeout, sample_pct,
+                                    sample_method, batch_size=batch_size, top_k=top_k)
+        elif workers>1:
+            stats = profile_batches_parallel(db, queries, table_name, batches, datatypes, workers, counter, profiler, stop_event, top_k=top_k,
+                                             sketch_threshold=sketch_threshold, sketch_capacity=sketch_capacity)
+        else:
+            stats = {}
+            for batch in batches:
+                stats.update(profile_batch(conn, queries, table_name, batch, datatypes, stop_event, top_k=top_k,
+                                           sketch_threshold=sketch_threshold, sketch_capacity=sketch_capacity))
+    except Exception as e:
+        detach()
+        conn.close()
+        if dispose:
             db.dispose()
-            logger.error(f"An error occured while generating the queries for {col_name}: {e}")
-            raise e
-        
-        logger.info(f"Executing queries for {col_name}")
-        try:
-            logger.info(num_rows_query)
-            row_count = pd.read_sql_query(num_rows_query,conn)['count'][0]
-            num_rows.append(int(row_count))
+        raise e
 
-            logger.info(datatype_query)
-            datatype.append(pd.read_sql_query(datatype_query,conn)['data_type'][0])
+    detach()
+    conn.close()
+    if dispose:
+        db.dispose()
 
-            logger.info(num_null_query)
-            null_count = pd.read_sql_query(num_null_query,conn)['count'][0]
-            null.append(int(null_count))
+    logger.info("Generating report")
+    report = build_report(stats, col_names_list, mode, top_k)
+    report.attrs['query_count'] = counter.count
+    report.attrs['mode'] = mode
+    logger.info(f"Report generated successfully for {table_name} with shape {report.shape} using {counter.count} queries!")
+    logger.debug('Report of %s:\n%s', table_name, report)
+    return report
 
-            logger.info(num_non_null_query)
-            non_null_count = pd.read_sql_query(num_non_null_query,conn)['count'][0]
-            non_null.append(int(non_null_count))
 
-            logger.info(num_unique_query)
-            unique_count = pd.read_sql_query(num_unique_query,conn)['count'][0]
-            unique.append(int(unique_count))
 
-            logger.info(f'Number of duplicates = num of non null - number of unique values')
-            duplicates.append(int(non_null_count)-int(unique_count))
+def refine_catalog_report(db, table_name: str, catalog_report: pd.DataFrame, owner_report: pd.DataFrame,
+                          tolerance: float=0.05, batch_size: int=100) -> pd.DataFrame:
 
-            logger.info(top_query)
-            top_vals = list(pd.read_sql_query(top_query,conn)['val'])
-            if len(top_vals)>1:
-                top_vals.sort()
-            top.append(top_vals[0])
+    '''
+    Rescans exactly the columns of a catalog mode report whose estimates disagree with the data owner's report,
+    so that only those columns pay for a scan of the table.
 
-            logger.info(f"Done for {col_name}")
-        except Exception as e:
-            conn.close()
-            db.dispose()
-            logger.error(f"An error occured while generating the values for {col_name}: {e}")
-            raise e
+    Parameters:
+    db : The connection engine of the user's table
+    table_name (schema_name.table_name): The schema and table name the report was generated for
+    catalog_report (pd.DataFrame): The report generated by dataframe_summary with mode='catalog'
+    owner_report (pd.DataFrame): The data owner's report
+    tolerance (float): Relative difference between an estimated count and the owner's count above which the column is rescanned (default is 0.05).
+                       A different most occurring value or a missing estimate always triggers a rescan.
+    batch_size (int): Maximum number of columns profiled by a single aggregate query (default is 100).
 
-    conn.close()
-    db.dispose()        
-    
-    logger.info("Generating report")
-    report = pd.DataFrame({
-        'Column':col_names_list,
-        'Num_Of_Rows':num_rows,
-        'Datatype':datatype,
-        'Num_Of_Nulls':null,
-        'Num_Of_Non_Nulls':non_null,
-        'Num_Unique_Vals':unique,
-        'Num_Of_Duplicates':duplicates,
-        'Most_Occurring_Vals':top
-    })
-    logger.info(f"Report generated successfully for {table_name} with shape {report.shape}!")
-    logger.info(report)
+    Returns:
+    pd.DataFrame: The report with the exact values of the rescanned columns. Their Last_Analyzed is the time of the rescan.
     '''
-    make changes to testing report for ad-hocs tests here, comment out line 107 and 108.
 
-    test_df = pd.DataFrame({'Column':col_names_list})
-    test_df.to_sql(name='report_table', con=db, schema=schema, if_exists='replace', index=False)
-    conn.close()
-    db.dispose()
-    '''
-    return report
\ No newline at end of file
+    count_params = ['Num_Of_Rows', 'Num_Of_Nulls', 'Num_Of_Non_Nulls', 'Num_Unique_Vals', 'Num_Of_Duplicates']
+    merged = catalog_report.merge(owner_report, on='Column', how='inner', suffixes=('', '_owner'))
+
+    disagree = pd.Series(False, index=merged.index)
+    for param in count_params:
+        if param not in owner_report.columns:
+            continue
+        estimate = pd.to_numeric(merged[param], errors='coerce')
+        expected = pd.to_numeric(merged[param+'_owner'], errors='coerce')
+        disagree |= estimate.isna() | ((estimate-expected).abs() > tolerance*expected.abs().clip(lower=1))
+    if 'Most_Occurring_Vals' in owner_report.columns:
+        disagree |= merged['Most_Occurring_Vals'].astype(str) != merged['Most_Occurring_Vals_owner'].astype(str)
+
+    rescan_cols = sorted(merged.loc[disagree, 'Column'])
+    report = catalog_report.copy()
+    report.attrs = dict(catalog_report.attrs)
+    report.attrs['rescanned_columns'] = rescan_cols
+    if len(rescan_cols)==0:
+        logger.info(f'The catalog estimates of {table_name} agree with the owner\'s report within {tolerance}')
+        return report
+    logger.info(f'Rescanning {len(rescan_cols)} columns of {table_name} whose estimates disagree with the owner\'s report: {rescan_cols}')
+
+    queries = QUERIES
+    datatypes = dict(zip(report['Column'], report['Datatype']))
+
+    counter = QueryCounter()
+    stats = {}
+    with db.connect() as conn:
+        counter.attach(conn)
+        try:
+            for start in range(0, len(rescan_cols), batch_size):
+                stats.update(profile_batch(conn, queries, table_name, rescan_cols[start:start+batch_size], datatypes))
+        finally:
+            counter.detach(conn)
+
+    scanned_at = pd.Timestamp.now(tz='UTC')
+    for col_name, col_stats in stats.items():
+        row = report.index[report['Column']==col_name]
+        report.loc[row, ['Num_Of_Rows', 'Num_Of_Nulls', 'Num_Of_Non_Nulls', 'Num_Unique_Vals', 'Num_Of_Duplicates']] = [
+            col_stats['num_rows'], col_stats['null'], col_stats['non_null'], col_stats['unique'], col_stats['duplicates']]
+        report.loc[row, 'Most_Occurring_Vals'] = pd.Series([col_stats['top']]*len(row), index=row, dtype=object)
+        report.loc[row, FRESHNESS_COLUMN] = scanned_at
+    report.attrs['query_count'] = report.attrs.get('query_count', 0) + counter.count
+    logger.info(f'Rescanned {len(stats)} columns of {table_name} using {counter.count} queries')
+    return report
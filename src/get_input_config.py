@@ -1,14 +1,15 @@
 from utils.logging_config import logger
-from sqlalchemy import create_engine
+from utils.engine_registry import get_engine
 import getpass
 
-def input_configuration(table_owner: str) -> tuple:
+def input_configuration(table_owner: str, pool_size: int=5) -> tuple:
 
     '''
     Prompts the user for database connection details and returns a connection object.
     Parameters:
     table_owner(str) : 'user' if you want to connect to the database to generate reports,
                        'owner' if you want to extract data upstream data owner's report.
+    pool_size(int) : Number of connections kept in the engine's pool (default is 5). Raise it to the number of profiling workers.
 
     Returns:
     conn: A SQLAlchemy connection object to the specified database if successful, or None if failed.
@@ -40,7 +41,8 @@ def input_configuration(table_owner: str) -> tuple:
 
     # creating connection
     logger.info(f'Trying to establish connection...')
-    db = create_engine(f'postgresql+psycopg2://{db_user}:{passkey}@{host}:{port}/{db}')
+    # Engines are shared by every run of the process connecting to the same database with the same credentials
+    db = get_engine(f'postgresql+psycopg2://{db_user}:{passkey}@{host}:{port}/{db}', pool_size=pool_size)
     try:
         conn = db.connect()
         logger.info("Connection successful!")
@@ -1,9 +1,36 @@
 from utils.logging_config import logger
+from src.report_comparison import REPORT_PARAMETERS
+from utils.queries import QUERIES
+from utils.schema_cache import get_columns
+from sqlalchemy import text
 import pandas as pd
 
-def get_owner_report(conn, db, table_name):
+def quote_identifier(name: str) -> str:
+    '''
+    Double quotes a column name, so that mixed case and reserved names such as Column can be selected.
+    '''
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_owner_report(conn, db, table_name, dispose: bool=True, target_table: str=None, table_column: str='Table_Name',
+                     columns: list=None, chunksize: int=10000):
     '''
     Gets the connection details for the data owner's report and extracts it from the specified table.
+    Only the columns compared with the generated report are selected, and when the owner's table holds the reports of many tables,
+    only the rows of target_table, so the database does the filtering and only the target table's slice is sent back.
+    The owner's other columns are not fetched but kept as empty columns, so that compare_dataframes still reports them as missing parameters.
+    Rows are fetched through a server side cursor and appended to the report chunksize rows at a time.
+
+    Parameters:
+    conn (connection object): The connection object to the owner's database
+    db : The connection engine
+    table_name (schema_name.table_name): The table storing the owner's report
+    dispose (bool): Dispose of the engine once the report is fetched (default is True). Pass False when the engine is shared.
+    target_table (str): Value of table_column identifying the rows of the report to compare with (default is None, every row).
+    table_column (str): Column of the owner's table naming the table every row describes (default is Table_Name).
+                        If the owner's table has no such column, it is assumed to hold a single table's report.
+    columns (list): Columns to fetch, without any empty column (default is None, Column and the parameters compared by compare_dataframes).
+    chunksize (int): Number of rows fetched from the cursor at a time (default is 10000).
 
     Returns:
     report_dataframe(pd.DataFrame): A Pandas DataFrame with the data owner's reports for the specified columns.
@@ -13,17 +40,54 @@ def get_owner_report(conn, db, table_name):
 
     logger.info("Getting data owner's report")
     try:
-        report_dataframe = pd.read_sql_table(table_name=table, con=conn, schema=schema)
+        queries = QUERIES
+        available = list(get_columns(conn, table_name))
+        if len(available)==0:
+            raise ValueError(f'{table_name} does not exist or has no columns')
+
+        wanted = columns if columns is not None else ['Column'] + REPORT_PARAMETERS
+        selected = [col_name for col_name in available if col_name in wanted]
+        if len(selected)==0:
+            raise ValueError(f'{table_name} has none of the columns {wanted}')
+        logger.info(f'Fetching the columns {selected} of {table_name}')
+
+        where = ''
+        params = {}
+        filtered = target_table is not None and table_column in available
+        if filtered:
+            where = queries['owner_filter'].format(table_column=quote_identifier(table_column))
+            params['target_table'] = target_table
+            logger.info(f'Fetching the rows of {table_name} where {table_column} is {target_table}')
+        elif target_table is not None:
+            logger.info(f'{table_name} has no {table_column} column, fetching all of its rows')
+        owner_report_query = queries['owner_report_query'].format(table_name=table_name, where=where,
+                                                                  col_list=', '.join(quote_identifier(col_name) for col_name in selected))
+        logger.info(owner_report_query)
+
+        chunks = []
+        fetched = 0
+        for chunk in pd.read_sql_query(text(owner_report_query), conn.execution_options(stream_results=True), params=params, chunksize=chunksize):
+            chunks.append(chunk)
+            fetched += len(chunk)
+            logger.info(f'{fetched} rows of {table_name} fetched')
+        report_dataframe = pd.concat(chunks, ignore_index=True)
+        if columns is None:
+            # The owner's parameters the generated report does not have, except the column naming the table of every row
+            others = [col_name for col_name in available if col_name not in selected and not (filtered and col_name==table_column)]
+            for col_name in others:
+                report_dataframe[col_name] = None
+            if len(others)>0:
+                logger.info(f'Not fetching the values of {others}, which are not compared')
         if report_dataframe.shape[0]>1 and report_dataframe.shape[1]>1:
             logger.info(f'{table_name} with shape {report_dataframe.shape} extracted succesfully!')
         else:
             logger.warning(f'{table_name} has insufficient rows or columns.')
-        logger.info(report_dataframe)
+        logger.info(f'Owner\'s report columns: {list(report_dataframe.columns)}')
         return report_dataframe
     except Exception as e:
         logger.error(f'Uh-oh! Could not fetch the table: {e}')
         raise e
     finally:
         conn.close()
-        db.dispose()
-
+        if dispose:
+            db.dispose()
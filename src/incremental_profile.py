@@ -0,0 +1,351 @@
+from utils.logging_config import logger
+from src.sampled_profile import hll_sketches, Z_SCORE
+from src.sketches import MisraGries
+from src.top_values import top_values, most_occurring_values, collation, as_report_value, portable_value, MIN_TYPES
+from utils.engine_registry import database_key
+import os
+import math
+import hashlib
+import pickle
+from collections import Counter
+from sqlalchemy import text
+
+STATE_VERSION = 2
+
+def state_path(state_dir: str, db_key: str, table_name: str) -> str:
+
+    '''
+    Returns the path of the file storing the statistics of a table between incremental runs.
+    It is keyed by the table's database too, see database_key, as tables of the same name in two databases are different tables.
+    '''
+
+    return os.path.join(state_dir, f"{hashlib.sha1(db_key.encode()).hexdigest()[:16]}_{table_name}.pkl")
+
+
+def sql_literal(value) -> str:
+
+    '''
+    Renders a watermark value read from the table as a quoted SQL literal, which PostgreSQL casts to the watermark column's type.
+    '''
+
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def read_change_markers(conn, queries: dict, table_name: str, watermark_column: str=None) -> dict:
+
+    '''
+    Reads the markers telling whether a table changed since the last run: its relfilenode, which changes on TRUNCATE or VACUUM FULL,
+    the pg_stat_all_tables insert, update and delete counters and, if a watermark column is given, its maximum value
+    and the number of rows without a watermark, which appends past the watermark cannot account for.
+    Both are read with an index on the watermark column when there is one.
+
+    Returns:
+    dict: The markers relfilenode, n_tup_ins, n_tup_upd, n_tup_del, watermark and null_watermarks.
+    '''
+
+    schema, table = table_name.split(".")
+    change_markers_query = queries['change_markers_query'].format(schema=schema, table=table)
+    logger.info(change_markers_query)
+    markers = dict(conn.execute(text(change_markers_query)).mappings().first() or {})
+    markers['watermark'] = None
+    markers['null_watermarks'] = None
+    if watermark_column is not None:
+        max_watermark_query = queries['max_watermark_query'].format(table_name=table_name, watermark_column=watermark_column)
+        logger.info(max_watermark_query)
+        watermark = conn.execute(text(max_watermark_query)).mappings().first()
+        markers['watermark'] = watermark['watermark']
+        markers['null_watermarks'] = int(watermark['null_watermarks'])
+    return markers
+
+
+def load_state(state_dir: str, db_key: str, table_name: str):
+
+    '''
+    Loads the statistics stored by the last incremental run of a table. Returns None if there are none or they cannot be read.
+    '''
+
+    path = state_path(state_dir, db_key, table_name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception as e:
+        logger.warning(f'Could not read the stored statistics of {table_name}, running a full profile: {e}')
+        return None
+    if state.get('version')!=STATE_VERSION:
+        return None
+    return state
+
+
+def save_state(state_dir: str, db_key: str, table_name: str, state: dict):
+
+    '''
+    Stores the statistics of a table for the next incremental run. The file is replaced atomically.
+    '''
+
+    os.makedirs(state_dir, exist_ok=True)
+    path = state_path(state_dir, db_key, table_name)
+    with open(path+'.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path+'.tmp', path)
+    logger.info(f'Statistics of {table_name} stored in {path}')
+
+
+def is_append_only(state: dict, markers: dict) -> bool:
+
+    '''
+    Tells whether the only changes since the stored run are inserts past the watermark.
+    Rows inserted without a watermark are not past it, so a change of their number rules the delta out.
+    '''
+
+    old = state['markers']
+    if markers['watermark'] is None or old['watermark'] is None or markers['watermark']<=old['watermark']:
+        return False
+    if markers['null_watermarks']!=old['null_watermarks']:
+        logger.info(f"Rows without a watermark changed from {old['null_watermarks']} to {markers['null_watermarks']}")
+        return False
+    if any(markers[key] is None or old[key] is None for key in ('n_tup_ins', 'n_tup_upd', 'n_tup_del')):
+        return False
+    return (markers['relfilenode']==old['relfilenode'] and markers['n_tup_upd']==old['n_tup_upd']
+            and markers['n_tup_del']==old['n_tup_del'] and markers['n_tup_ins']>=old['n_tup_ins'])
+
+
+def covers_inserts(conn, queries: dict, table_name: str, state: dict, markers: dict, watermark_column: str) -> bool:
+
+    '''
+    Tells whether the rows past the stored watermark are all the rows inserted since the stored run, as counted by n_tup_ins.
+    Rows inserted below the watermark, e.g. a backfill or keys which are not monotonic, would otherwise be missed by the delta.
+    Inserts rolled back are counted by n_tup_ins too, so they only make the next run a full profile.
+    '''
+
+    delta = queries['delta_clause'].format(table_name=table_name, watermark_column=watermark_column,
+                                           low=sql_literal(state['markers']['watermark']), high=sql_literal(markers['watermark']))
+    delta_count_query = queries['aggregate_query'].format(table_name=delta, aggregates='COUNT(*) AS num_rows')
+    logger.info(delta_count_query)
+    appended = int(conn.execute(text(delta_count_query)).scalar())
+    inserted = markers['n_tup_ins']-state['markers']['n_tup_ins']
+    if appended!=inserted:
+        logger.info(f'{inserted} rows were inserted in {table_name} but {appended} are past the watermark')
+    return appended==inserted
+
+
+def report_stats(state: dict) -> dict:
+
+    '''
+    Derives the statistics of every column from the stored, mergeable state.
+    Unique counts come from the HyperLogLog sketches unless the last full run counted them exactly,
+    and most occurring values from the Misra-Gries sketches, which are exact while no count was pruned,
+    or for the untracked columns (see tracked) from the value stored by the last run, see refresh_untracked.
+
+    Returns:
+    dict: Mapping of column name to its num_rows, datatype, null, non_null, unique, duplicates, top values
+          and the unique_error and duplicates_error bounds.
+    '''
+
+    stats = {}
+    for col_name, col_state in state['columns'].items():
+        non_null_count = col_state['non_null']
+        if col_state['unique_exact'] is not None:
+            unique_count, unique_error = col_state['unique_exact'], 0
+        else:
+            sketch = col_state['hll']
+            estimate = sketch.estimate()
+            unique_count = min(max(round(estimate), col_state['unique_floor']), non_null_count)
+            unique_error = math.ceil(Z_SCORE*sketch.relative_error()*estimate)
+        if col_state['mg'] is None:
+            top = [(col_state['top'], 0)] if non_null_count>0 else []
+        else:
+            top = col_state['mg'].top(1)
+        if len(top)==0 and non_null_count>0:
+            # Every tracked count was pruned, so no value stands out and exact mode would report the smallest one
+            top = [(col_state['min'], 0)]
+        stats[col_name] = {
+            'num_rows': state['num_rows'],
+            'datatype': state['datatypes'][col_name],
+            'null': state['num_rows']-non_null_count,
+            'non_null': non_null_count,
+            'unique': unique_count,
+            'duplicates': non_null_count-unique_count,
+            'top': top[0][0] if len(top)>0 else None,
+            'unique_error': unique_error,
+            'duplicates_error': unique_error
+        }
+    return stats
+
+
+def tracked(datatype: str) -> bool:
+
+    '''
+    Tells whether the most occurring value of a column is tracked in the mergeable state. Only the datatypes with a MIN aggregate
+    are (see MIN_TYPES): the smallest value of the others cannot be aggregated and some, e.g. jsonb, cannot be counted in Python,
+    so their most occurring value is computed again by every run that scans the table, see refresh_untracked.
+    '''
+
+    return datatype in MIN_TYPES
+
+
+def refresh_untracked(conn, queries: dict, table_name: str, state: dict):
+
+    '''
+    Computes the most occurring value of the untracked columns of the state exactly, see tracked, and stores it in the state.
+    '''
+
+    col_counts = {col_name: (col_state['non_null'], -1 if col_state['unique_exact'] is None else col_state['unique_exact'])
+                  for col_name, col_state in state['columns'].items() if col_state['mg'] is None}
+    if len(col_counts)==0:
+        return
+    logger.info(f'Computing the most occurring values of the untracked columns {list(col_counts)}')
+    top, _ = most_occurring_values(conn, queries, table_name, col_counts, state['datatypes'])
+    for col_name in col_counts:
+        state['columns'][col_name]['top'] = portable_value(top[col_name][0])
+
+
+def full_profile_state(conn, queries: dict, table_name: str, col_names: list, datatypes: dict, watermark_column: str,
+                       high, batch_size: int, sketch_capacity: int, hll_precision: int) -> dict:
+
+    '''
+    Profiles the whole table exactly, up to the watermark, and builds the mergeable state of every column:
+    its non null count, exact unique count, smallest value, HyperLogLog sketch and a Misra-Gries sketch seeded with its most occurring values.
+    The untracked columns (see tracked) keep their most occurring value instead of the sketch and smallest value.
+    Every batch of columns is read three times: one aggregate query for the counts, unique counts and smallest values,
+    one for the HyperLogLog registers and one GROUPING SETS query for the most occurring values.
+    '''
+
+    source = table_name
+    if watermark_column is not None and high is not None:
+        source = queries['bounded_clause'].format(table_name=table_name, watermark_column=watermark_column, high=sql_literal(high))
+
+    columns = {}
+    num_rows = 0
+    for start in range(0, len(col_names), batch_size):
+        batch = col_names[start:start+batch_size]
+        aggregates = []
+        for idx, col_name in enumerate(batch):
+            aggregates.append(queries['non_null_agg'].format(col_name=col_name, idx=idx))
+            aggregates.append(queries['unique_agg'].format(col_name=col_name, idx=idx))
+            if tracked(datatypes[col_name]):
+                aggregates.append(queries['min_agg'].format(col_name=col_name, idx=idx, collation=collation(datatypes[col_name])))
+        aggregates = ', '.join(aggregates)
+        counts_query = queries['profile_query'].format(table_name=source, aggregates=aggregates)
+        logger.info(counts_query)
+        counts = conn.execute(text(counts_query)).mappings().first()
+        num_rows = int(counts['num_rows'])
+        sketches = hll_sketches(conn, queries, source, batch, hll_precision)
+        # One more value than the sketch capacity tells whether the tracked counts cover every value
+        ranked = top_values(conn, queries, source, batch, datatypes, sketch_capacity+1)
+        for idx, col_name in enumerate(batch):
+            non_null_count, unique_count = int(counts[f'non_null_{idx}']), int(counts[f'unique_{idx}'])
+            if not tracked(datatypes[col_name]):
+                top = portable_value(ranked[col_name][0][0]) if len(ranked[col_name])>0 else None
+                columns[col_name] = {'non_null': non_null_count, 'unique_exact': unique_count, 'unique_floor': unique_count,
+                                     'hll': sketches[col_name], 'mg': None, 'min': None, 'top': top}
+                continue
+            mg = MisraGries(sketch_capacity)
+            values = [(val, count) for val, count in ranked[col_name] if val is not None]
+            mg.update_counts(dict(values[:sketch_capacity]))
+            mg.total = non_null_count
+            mg.error = values[sketch_capacity][1] if len(values)>sketch_capacity else 0
+            columns[col_name] = {'non_null': non_null_count, 'unique_exact': unique_count, 'unique_floor': unique_count,
+                                 'hll': sketches[col_name], 'mg': mg, 'min': as_report_value(counts[f'min_{idx}'])}
+    return {'num_rows': num_rows, 'columns': columns}
+
+
+def merge_delta(conn, queries: dict, table_name: str, col_names: list, state: dict, watermark_column: str, low, high,
+                batch_size: int, hll_precision: int, chunksize: int=100000):
+
+    '''
+    Profiles only the rows past the stored watermark and merges their statistics into the stored state:
+    the counts are added, the HyperLogLog registers maxed, the minimums compared and the delta's value counts merged into the Misra-Gries sketches.
+    Only the tracked columns are streamed, see tracked, the caller refreshes the others with refresh_untracked.
+    '''
+
+    delta = queries['delta_clause'].format(table_name=table_name, watermark_column=watermark_column, low=sql_literal(low), high=sql_literal(high))
+    for start in range(0, len(col_names), batch_size):
+        batch = col_names[start:start+batch_size]
+        aggregates = ', '.join(queries['non_null_agg'].format(col_name=col_name, idx=idx) for idx, col_name in enumerate(batch))
+        delta_query = queries['profile_query'].format(table_name=delta, aggregates=aggregates)
+        logger.info(delta_query)
+        counts = conn.execute(text(delta_query)).mappings().first()
+        delta_rows = int(counts['num_rows'])
+        logger.info(f'{delta_rows} new rows found in {table_name} past {low}')
+
+        sketches = hll_sketches(conn, queries, delta, batch, hll_precision)
+
+        streamed = [col_name for col_name in batch if state['columns'][col_name]['mg'] is not None]
+        stream_query = queries['stream_rows_query'].format(table_name=delta, col_list=', '.join(streamed))
+        logger.info(stream_query)
+        result = conn.execution_options(stream_results=True, yield_per=chunksize).execute(text(stream_query)) if len(streamed)>0 else None
+        for chunk in (result.partitions() if result is not None else []):
+            for col_name, values in zip(streamed, zip(*chunk)):
+                col_state = state['columns'][col_name]
+                counts_chunk = Counter(as_report_value(val) for val in values if val is not None)
+                col_state['mg'].update_counts(counts_chunk)
+                if len(counts_chunk)>0:
+                    col_state['min'] = min(counts_chunk) if col_state['min'] is None else min(col_state['min'], min(counts_chunk))
+
+        for idx, col_name in enumerate(batch):
+            col_state = state['columns'][col_name]
+            col_state['non_null'] += int(counts[f'non_null_{idx}'])
+            col_state['hll'].merge(sketches[col_name])
+            # Distinct values can only grow with appends, the last exact count stays a lower bound
+            col_state['unique_floor'] = max(col_state['unique_floor'], col_state['unique_exact'] or 0)
+            col_state['unique_exact'] = None
+    state['num_rows'] += delta_rows
+
+
+def incremental_profile(conn, queries: dict, table_name: str, col_names: list, datatypes: dict, watermark_column: str=None,
+                        state_dir: str='./state', batch_size: int=100, sketch_capacity: int=1000, hll_precision: int=12) -> dict:
+
+    '''
+    Profiles a table reusing the statistics stored by its previous run:
+    - if the table did not change, nothing is scanned and the stored statistics are returned,
+    - if rows were only appended past the watermark column, only those rows are scanned and merged into the stored statistics,
+      as long as they account for every insert since the stored run (see covers_inserts),
+    - otherwise, or on the first run, the whole table is profiled exactly.
+    Changes are detected with the table's relfilenode, its pg_stat_all_tables counters, the maximum of the watermark column
+    and the number of rows without a watermark. The statistics are stored per database and table, see state_path.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    watermark_column (str): An ever increasing column, e.g. an insert timestamp or a serial id, enabling append-only runs (default is None).
+    state_dir (str): Folder storing the statistics between runs (default is ./state).
+    batch_size (int): Maximum number of columns profiled by a single query (default is 100).
+    sketch_capacity (int): Number of counters of the Misra-Gries sketches (default is 1000).
+    hll_precision (int): Register index bits of the HyperLogLog sketches (default is 12, a ~1.6% standard error).
+
+    Returns:
+    dict: Mapping of column name to its num_rows, datatype, null, non_null, unique, duplicates and top values
+          and the unique_error and duplicates_error bounds, 0 while the unique counts are exact.
+    '''
+
+    db_key = database_key(conn.engine)
+    markers = read_change_markers(conn, queries, table_name, watermark_column)
+    state = load_state(state_dir, db_key, table_name)
+    if state is not None and (state['datatypes']!=datatypes or state['watermark_column']!=watermark_column):
+        logger.info(f'The columns or the watermark of {table_name} changed since the stored run')
+        state = None
+
+    if state is not None and markers==state['markers']:
+        logger.info(f'{table_name} did not change since the stored run, reusing its statistics')
+        return report_stats(state)
+
+    if (state is not None and watermark_column is not None and is_append_only(state, markers)
+            and covers_inserts(conn, queries, table_name, state, markers, watermark_column)):
+        logger.info(f"Only appends found in {table_name}, profiling the rows past {state['markers']['watermark']}")
+        merge_delta(conn, queries, table_name, col_names, state, watermark_column, state['markers']['watermark'],
+                    markers['watermark'], batch_size, hll_precision)
+        refresh_untracked(conn, queries, table_name, state)
+    else:
+        logger.info(f'Profiling {table_name} fully')
+        state = full_profile_state(conn, queries, table_name, col_names, datatypes, watermark_column, markers['watermark'],
+                                   batch_size, sketch_capacity, hll_precision)
+        state.update({'version': STATE_VERSION, 'database': db_key, 'table': table_name, 'datatypes': datatypes, 'watermark_column': watermark_column})
+
+    state['markers'] = markers
+    save_state(state_dir, db_key, table_name, state)
+    return report_stats(state)
@@ -0,0 +1,390 @@
+from utils.logging_config import logger, worker_logging, log_to_queue
+from utils.query_counter import QueryCounter
+from src.sampled_profile import hll_sketches, Z_SCORE
+from src.sketches import DistinctCounts, MisraGries
+from src.top_values import top_values, min_values, as_report_value, portable_value
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from decimal import Decimal
+import multiprocessing
+import functools
+import itertools
+import heapq
+import tempfile
+import shutil
+import math
+import uuid
+
+def build_grouped_counts_query(queries: dict, table_name: str, col_names: list) -> str:
+
+    '''
+    Builds a single GROUPING SETS query returning every distinct value of every column in col_names along with its count.
+
+    Returns:
+    str: The query. Its rows are (col_idx, one column per col_name, cnt), nulls are counted as 0.
+    '''
+
+    col_list = ', '.join(col_names)
+    col_idx_case = ' '.join(queries['grouping_col_idx'].format(col_name=col_name, idx=idx) for idx, col_name in enumerate(col_names))
+    count_case = ' '.join(queries['grouping_count'].format(col_name=col_name) for col_name in col_names)
+    grouping_sets = ', '.join(f'({col_name})' for col_name in col_names)
+    return queries['grouped_counts_query'].format(table_name=table_name, col_list=col_list, col_idx_case=col_idx_case,
+                                                  count_case=count_case, grouping_sets=grouping_sets)
+
+
+def key_ranges(conn, queries: dict, table_name: str, partition_column: str, partitions: int) -> list:
+
+    '''
+    Splits a table into ranges of equal width of a numeric column, plus one range for its nulls.
+
+    Returns:
+    list: The WHERE conditions of the ranges.
+    Raises ValueError if the column is not numeric.
+    '''
+
+    key_bounds_query = queries['key_bounds_query'].format(table_name=table_name, partition_column=partition_column)
+    logger.info(key_bounds_query)
+    low, high = conn.execute(text(key_bounds_query)).fetchone()
+    null_condition = f'{partition_column} IS NULL'
+    if low is None:
+        return [null_condition]
+    if not all(isinstance(bound, (int, float, Decimal)) for bound in (low, high)):
+        logger.error(f'Cannot split {table_name} by {partition_column}, its values are not numeric')
+        raise ValueError(f'{partition_column} is not a numeric column')
+
+    bounds = []
+    for i in range(1, partitions):
+        bound = low + (high-low)*i/partitions
+        bound = math.ceil(bound) if isinstance(low, int) else bound
+        if bound>low and (len(bounds)==0 or bound>bounds[-1]):
+            bounds.append(bound)
+    if len(bounds)==0:
+        return [f'{partition_column} IS NOT NULL', null_condition]
+
+    conditions = [f'{partition_column} < {bounds[0]}']
+    for lower, upper in zip(bounds, bounds[1:]):
+        conditions.append(f'{partition_column} >= {lower} AND {partition_column} < {upper}')
+    conditions.append(f'{partition_column} >= {bounds[-1]}')
+    conditions.append(null_condition)
+    return conditions
+
+
+def page_ranges(conn, queries: dict, table_name: str, partitions: int) -> list:
+
+    '''
+    Splits a table into ranges of its heap pages, which PostgreSQL 14+ scans with a TID range scan reading only those pages.
+
+    Returns:
+    list: The WHERE conditions of the ranges, empty if the table is too small to split.
+    '''
+
+    relation_pages_query = queries['relation_pages_query'].format(table_name=table_name)
+    logger.info(relation_pages_query)
+    pages = int(conn.execute(text(relation_pages_query)).scalar() or 0)
+    if pages<=1 or partitions<=1:
+        return []
+    step = math.ceil(pages/partitions)
+    starts = list(range(0, pages, step))
+    conditions = [f"ctid < '({step},0)'::tid"]
+    for start in starts[1:-1]:
+        conditions.append(f"ctid >= '({start},0)'::tid AND ctid < '({start+step},0)'::tid")
+    # The last range is left open so that pages added after pages were counted are not missed
+    conditions.append(f"ctid >= '({starts[-1]},0)'::tid")
+    return conditions
+
+
+def partition_ranges(conn, queries: dict, table_name: str, partitions: int, partition_column: str=None) -> list:
+
+    '''
+    Splits a table into independent ranges, using in order of preference:
+    - its partitions, or inheritance children, scanned with ONLY so that no row is read twice. When some partitions are partitioned
+      themselves, their leaves share the values of the table's partition key, so every partition of the table is one range instead,
+      a partitioned one scanning all its leaves,
+    - ranges of partition_column, if given,
+    - ranges of its heap pages by ctid.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to split
+    partitions (int): Number of ranges unpartitioned tables are split into
+    partition_column (str): Numeric column to split unpartitioned tables by instead of their pages (default is None).
+
+    Returns:
+    Tuple[list, list]:
+        - The table expressions of the ranges.
+        - The columns whose values cannot be shared by two ranges: a single column partition key or partition_column.
+    '''
+
+    inheritance_tree_query = queries['inheritance_tree_query'].format(table_name=table_name)
+    logger.info(inheritance_tree_query)
+    relations = conn.execute(text(inheritance_tree_query)).fetchall()
+    if len(relations)>1:
+        # Partitioned parents have no storage of their own, every other relation of the tree may hold rows
+        sources = [f'ONLY {relation}' for relation, relkind, _ in relations if relkind!='p']
+        logger.info(f'{table_name} has {len(sources)} partitions or inheritance children holding rows')
+        partition_key_query = queries['partition_key_query'].format(table_name=table_name)
+        logger.info(partition_key_query)
+        disjoint_columns = [row[0] for row in conn.execute(text(partition_key_query))]
+        if len(disjoint_columns)>0 and any(depth>1 for _, relkind, depth in relations if relkind!='p'):
+            sources = [relation if relkind=='p' else f'ONLY {relation}' for relation, relkind, depth in relations if depth==1]
+            logger.info(f'{table_name} has sub-partitioned partitions, profiling its {len(sources)} partitions as ranges')
+        return sources, disjoint_columns
+
+    if partition_column is not None:
+        conditions = key_ranges(conn, queries, table_name, partition_column, partitions)
+    else:
+        conditions = page_ranges(conn, queries, table_name, partitions)
+    if len(conditions)==0:
+        return [table_name], []
+    logger.info(f'{table_name} split into {len(conditions)} ranges')
+    sources = [queries['range_clause'].format(table_name=table_name, condition=condition) for condition in conditions]
+    return sources, [partition_column] if partition_column is not None else []
+
+
+def profile_range(url: str, queries: dict, source: str, col_names: list, datatypes: dict, disjoint_columns: list=(), top_k: int=1,
+                  snapshot: str=None, application_name: str=None, batch_size: int=100, exact_distinct: bool=True, spill_dir: str=None,
+                  spill_limit: int=1000000, hll_precision: int=12, sketch_capacity: int=1000, chunksize: int=100000) -> dict:
+
+    '''
+    Profiles one range of a table in a worker process over its own connection, returning mergeable partial results.
+    Every distinct value is fetched once per range with its count, and kept either exactly, spilling to disk beyond spill_limit values,
+    or in a Misra-Gries sketch along with a HyperLogLog sketch of the range.
+    The values of disjoint columns are never shared by two ranges, so they are counted and ranked in the database instead.
+
+    Parameters:
+    url (str): The URL of the engine, including its password
+    queries (dict): The query templates loaded from utils/queries.json
+    source (str): The table expression of the range
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    disjoint_columns (list): Columns whose values cannot be found in another range, see partition_ranges
+    top_k (int): Number of most occurring values ranked per disjoint column (default is 1).
+    snapshot (str): Snapshot exported by the coordinator, so that every range sees the same data (default is None).
+    application_name (str): Name the connection reports in pg_stat_activity, used to cancel the workers' queries (default is None).
+    batch_size (int): Maximum number of columns profiled by a single query (default is 100).
+    exact_distinct (bool): Count the distinct values exactly rather than with sketches (default is True).
+    spill_dir (str): Folder shared by the workers which exact counts are spilled to.
+    spill_limit (int): Number of values per column held in memory before spilling (default is 1000000).
+    hll_precision (int): Register index bits of the HyperLogLog sketches (default is 12).
+    sketch_capacity (int): Number of counters of the Misra-Gries sketches (default is 1000).
+    chunksize (int): Number of grouped rows fetched from the cursor at a time (default is 100000).
+
+    Returns:
+    dict: The range's num_rows, query_count and per column its non_null count and either its distinct counts or sketches,
+          or for disjoint columns its unique count and top (value, count) pairs.
+    '''
+
+    connect_args = {'application_name': application_name} if application_name is not None else {}
+    engine = create_engine(url, poolclass=NullPool, connect_args=connect_args)
+    counter = QueryCounter().attach(engine)
+    partial = {'num_rows': 0, 'columns': {}}
+    try:
+        with engine.connect() as conn:
+            if snapshot is not None:
+                conn.execute(text(queries['snapshot_transaction']))
+                conn.execute(text(queries['import_snapshot'].format(snapshot=snapshot)))
+            for start in range(0, len(col_names), batch_size):
+                batch = col_names[start:start+batch_size]
+                aggregates = []
+                for idx, col_name in enumerate(batch):
+                    aggregates.append(queries['non_null_agg'].format(col_name=col_name, idx=idx))
+                    if col_name in disjoint_columns:
+                        aggregates.append(queries['unique_agg'].format(col_name=col_name, idx=idx))
+                count_query = queries['profile_query'].format(table_name=source, aggregates=', '.join(aggregates))
+                logger.info(count_query)
+                counts = conn.execute(text(count_query)).mappings().first()
+                partial['num_rows'] = int(counts['num_rows'])
+
+                disjoint = {col_name: {'non_null': int(counts[f'non_null_{idx}']), 'unique': int(counts[f'unique_{idx}']), 'top': []}
+                            for idx, col_name in enumerate(batch) if col_name in disjoint_columns}
+                # When every value of the range is distinct its smallest one ranks first, as in most_occurring_values
+                unique_cols = [col_name for col_name, part in disjoint.items() if top_k==1 and 0<part['non_null']==part['unique']]
+                grouped_cols = [col_name for col_name, part in disjoint.items() if part['non_null']>0 and col_name not in unique_cols]
+                if len(unique_cols)>0:
+                    for col_name, value in min_values(conn, queries, source, unique_cols, datatypes).items():
+                        disjoint[col_name]['top'] = [(portable_value(value), 1)]
+                if len(grouped_cols)>0:
+                    for col_name, ranked in top_values(conn, queries, source, grouped_cols, datatypes, top_k).items():
+                        disjoint[col_name]['top'] = [(portable_value(value), count) for value, count in ranked]
+                partial['columns'].update(disjoint)
+
+                shared = [col_name for col_name in batch if col_name not in disjoint_columns]
+                if len(shared)==0:
+                    continue
+                sketches = {}
+                if exact_distinct:
+                    distinct = {col_name: DistinctCounts(spill_dir, spill_limit) for col_name in shared}
+                else:
+                    distinct = {col_name: MisraGries(sketch_capacity) for col_name in shared}
+                    sketches = hll_sketches(conn, queries, source, shared, hll_precision)
+
+                grouped_counts_query = build_grouped_counts_query(queries, source, shared)
+                logger.info(grouped_counts_query)
+                smallest = {col_name: None for col_name in shared}
+                result = conn.execution_options(stream_results=True, yield_per=chunksize).execute(text(grouped_counts_query))
+                for chunk in result.partitions():
+                    chunk_counts = {col_name: {} for col_name in shared}
+                    for row in chunk:
+                        col_idx = row[0]
+                        value = portable_value(as_report_value(row[col_idx+1]))
+                        if value is not None:
+                            chunk_counts[shared[col_idx]][value] = int(row[-1])
+                    for col_name, value_counts in chunk_counts.items():
+                        distinct[col_name].update_counts(value_counts)
+                        if not exact_distinct and len(value_counts)>0:
+                            chunk_min = min(value_counts)
+                            smallest[col_name] = chunk_min if smallest[col_name] is None else min(smallest[col_name], chunk_min)
+
+                for col_name in shared:
+                    idx = batch.index(col_name)
+                    partial['columns'][col_name] = {'non_null': int(counts[f'non_null_{idx}']), 'distinct': distinct[col_name],
+                                                    'hll': sketches.get(col_name), 'min': smallest[col_name]}
+            conn.rollback()
+    finally:
+        counter.detach(engine)
+        engine.dispose()
+    partial['query_count'] = counter.count
+    return partial
+
+
+def merge_partials(partials: list, col_names: list, datatypes: dict, exact_distinct: bool=True, top_k: int=1) -> dict:
+
+    '''
+    Merges the partial results of the ranges: counts are summed, exact distinct counts merged bucket by bucket,
+    and sketches merged, in which case the unique counts and most occurring values come with error bounds.
+    The unique counts of disjoint columns are summed and their most occurring values picked among the ranges' ones.
+
+    Returns:
+    dict: Mapping of column name to its num_rows, datatype, null, non_null, unique, duplicates, top and top_k values,
+          and with sketches, unique_error, duplicates_error and top_error.
+    '''
+
+    num_rows = sum(partial['num_rows'] for partial in partials)
+    stats = {}
+    for col_name in col_names:
+        parts = [partial['columns'][col_name] for partial in partials]
+        non_null_count = sum(part['non_null'] for part in parts)
+        col_stats = {}
+        if 'unique' in parts[0]:
+            unique_count = sum(part['unique'] for part in parts)
+            top = heapq.nsmallest(top_k, itertools.chain.from_iterable(part['top'] for part in parts), key=lambda item: (-item[1], item[0]))
+        elif exact_distinct:
+            distinct = functools.reduce(lambda merged, part: merged.merge(part['distinct']), parts[1:], parts[0]['distinct'])
+            unique_count, top = distinct.summarize(top_k)
+        else:
+            distinct = functools.reduce(lambda merged, part: merged.merge(part['distinct']), parts[1:], parts[0]['distinct'])
+            sketch = functools.reduce(lambda merged, part: merged.merge(part['hll']), parts[1:], parts[0]['hll'])
+            estimate = sketch.estimate()
+            unique_count = min(round(estimate), non_null_count)
+            top = distinct.top(top_k)
+            if len(top)==0 and non_null_count>0:
+                # Every tracked count was pruned, so no value stands out and exact mode would report the smallest one
+                top = [(min(part['min'] for part in parts if part['min'] is not None), 0)]
+            error = math.ceil(Z_SCORE*sketch.relative_error()*estimate)
+            col_stats = {'unique_error': error, 'duplicates_error': error, 'top_error': distinct.error}
+        top_vals = [val for val, _ in top] if len(top)>0 else [None]
+        stats[col_name] = {
+            'num_rows': num_rows,
+            'datatype': datatypes[col_name],
+            'null': num_rows-non_null_count,
+            'non_null': non_null_count,
+            'unique': unique_count,
+            'duplicates': non_null_count-unique_count,
+            'top': top_vals[0],
+            'top_k': top_vals,
+            **col_stats
+        }
+    return stats
+
+
+def partition_profile(db, queries: dict, table_name: str, col_names: list, datatypes: dict, workers: int=4, partitions: int=None,
+                      partition_column: str=None, batch_size: int=100, top_k: int=1, exact_distinct: bool=True, spill_dir: str=None,
+                      spill_limit: int=1000000, hll_precision: int=12, sketch_capacity: int=1000, counter: QueryCounter=None) -> dict:
+
+    '''
+    Profiles a table by splitting its scan into independent ranges, see partition_ranges, profiled in parallel by a pool of processes,
+    each over its own connection, and merging their partial results, see merge_partials.
+    Every worker imports the snapshot exported by the coordinator, so the ranges add up to one consistent view of the table.
+    If a worker fails, the pending ranges are cancelled along with the queries still running on the server before the error is raised.
+
+    Parameters:
+    db : The connection engine
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    workers (int): Number of worker processes (default is 4).
+    partitions (int): Number of ranges unpartitioned tables are split into (default is 4 per worker).
+    partition_column (str): Numeric column to split unpartitioned tables by instead of their heap pages (default is None).
+    batch_size (int): Maximum number of columns profiled by a single query (default is 100).
+    top_k (int): Number of most occurring values computed per column (default is 1).
+    exact_distinct (bool): Count the distinct values exactly, spilling them to disk when needed, rather than with sketches (default is True).
+    spill_dir (str): Folder the spill files are created in (default is the system's temporary folder).
+    spill_limit (int): Number of values per column a worker holds in memory before spilling (default is 1000000).
+    hll_precision (int): Register index bits of the HyperLogLog sketches (default is 12).
+    sketch_capacity (int): Number of counters of the Misra-Gries sketches (default is 1000).
+    counter (QueryCounter): Optional counter of the queries issued, including the workers' ones
+
+    Returns:
+    dict: Mapping of column name to its statistics, see merge_partials.
+    Raises the first exception encountered by a worker.
+    '''
+
+    partitions = partitions or 4*workers
+    url = db.url.render_as_string(hide_password=False)
+    application_name = f'veritas_{uuid.uuid4().hex[:12]}'
+    spill_root = tempfile.mkdtemp(prefix='veritas_spill_', dir=spill_dir)
+    try:
+        with db.connect() as snapshot_conn:
+            if counter is not None:
+                counter.attach(snapshot_conn)
+            try:
+                snapshot = None
+                try:
+                    snapshot_conn.execute(text(queries['snapshot_transaction']))
+                    snapshot = snapshot_conn.execute(text(queries['export_snapshot_query'])).scalar()
+                except Exception as e:
+                    # Standbys cannot export snapshots, every range then sees the data as of its own start
+                    logger.warning(f'Could not export a snapshot, the ranges of {table_name} will not share one: {e}')
+                    snapshot_conn.rollback()
+                sources, disjoint_columns = partition_ranges(snapshot_conn, queries, table_name, partitions, partition_column)
+                disjoint_columns = [col_name for col_name in disjoint_columns if col_name in col_names]
+
+                logger.info(f'Profiling {len(sources)} ranges of {table_name} with {workers} processes')
+                partials = []
+                # The workers' records are written to this run's log file, see worker_logging
+                context = multiprocessing.get_context('spawn')
+                with worker_logging(context) as worker_queue:
+                    executor = ProcessPoolExecutor(max_workers=min(workers, len(sources)), mp_context=context, initializer=log_to_queue,
+                                                   initargs=(worker_queue,))
+                    futures = [executor.submit(profile_range, url, queries, source, col_names, datatypes, disjoint_columns, top_k, snapshot,
+                                               application_name, batch_size, exact_distinct, spill_root, spill_limit, hll_precision,
+                                               sketch_capacity)
+                               for source in sources]
+                    try:
+                        for future in as_completed(futures):
+                            partial = future.result()
+                            if counter is not None:
+                                counter.add(partial['query_count'])
+                            partials.append(partial)
+                    except Exception as e:
+                        logger.error(f'A profiling process failed, cancelling the remaining ranges: {e}')
+                        for future in futures:
+                            future.cancel()
+                        try:
+                            snapshot_conn.execute(text(queries['cancel_backends_query'].format(application_name=application_name)))
+                        except Exception as cancel_error:
+                            logger.warning(f'Could not cancel the running queries: {cancel_error}')
+                        raise e
+                    finally:
+                        executor.shutdown(wait=True)
+            finally:
+                snapshot_conn.rollback()
+                if counter is not None:
+                    counter.detach(snapshot_conn)
+
+        return merge_partials(partials, col_names, datatypes, exact_distinct, top_k)
+    finally:
+        shutil.rmtree(spill_root, ignore_errors=True)
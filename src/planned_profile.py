@@ -0,0 +1,560 @@
+from utils.logging_config import logger
+from utils.query_profiler import query_label
+from src.catalog_profile import catalog_profile
+from src.sampled_profile import hll_sketches, sampled_bound, top_confident, Z_SCORE
+from src.top_values import top_values, most_occurring_values, TEXT_TYPES
+from sqlalchemy import text
+import heapq
+import math
+import random
+import time
+
+# Strategies of a statistic, from the most accurate and expensive to the cheapest
+STRATEGIES = ['exact', 'sampled', 'catalog']
+
+# Statistics planned separately for every column: the null and non null counts, the unique count and the most occurring values
+STATISTICS = ['counts', 'unique', 'top']
+
+# Report columns holding the strategy of every statistic of a column and the statistics which fell back to a cheaper strategy
+PLAN_COLUMN = 'Profile_Plan'
+DEGRADED_COLUMN = 'Degraded'
+
+# Queries computing the statistics of a strategy, run in this order so that a statistic degraded by a timeout is run again by a later one.
+# The exact unique counts share the aggregate query of the exact counts. The sampled unique counts are HyperLogLog estimates,
+# whose sketches are built from the whole table, not the sample, so sampled_unique pays a full scan as in the fast mode.
+PHASES = [('exact_counts', 'exact', ['counts', 'unique']), ('exact_top', 'exact', ['top']), ('sampled_counts', 'sampled', ['counts']),
+          ('sampled_unique', 'sampled', ['unique']), ('sampled_top', 'sampled', ['top'])]
+PHASE_OF = {(statistic, strategy): phase for phase, strategy, statistics in PHASES for statistic in statistics}
+
+# Cost model, in seconds, of a warm PostgreSQL scan. The estimates are rescaled during a run by the time the queries actually take.
+# Text values are sorted with their collation, which costs several times more than comparing fixed width values.
+SCAN_SECONDS_PER_BYTE = 2e-9
+COUNT_SECONDS_PER_VALUE = 1e-8
+DISTINCT_SECONDS_PER_VALUE = 1.5e-7
+TEXT_DISTINCT_SECONDS_PER_VALUE = 4.5e-7
+SORT_SECONDS_PER_BYTE = 1.3e-8
+GROUP_SECONDS_PER_VALUE = 1.5e-7
+RANK_SECONDS_PER_VALUE = 2.5e-6
+RANK_SECONDS_PER_BYTE = 2.5e-8
+HLL_SECONDS_PER_VALUE = 8e-7
+TUPLE_HEADER_BYTES = 24
+PAGE_BYTES = 8192
+
+# Width assumed for the columns pg_stats has no average width for
+DEFAULT_WIDTH = 32
+
+# Share of the remaining budget the plan fills, the rest absorbing the estimates' errors
+PLAN_MARGIN = 0.8
+
+# With a budget, a query is cancelled once it runs TIMEOUT_ALLOWANCE times longer than estimated, but never before MIN_TIMEOUT seconds,
+# so that one misestimated query cannot spend the budget of all the others
+TIMEOUT_ALLOWANCE = 3
+MIN_TIMEOUT = 1.0
+
+# SQLSTATE of the statements cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+def is_timeout(error: Exception) -> bool:
+
+    '''
+    Tells whether an error, or the error it was raised from, is a statement cancelled by statement_timeout.
+    '''
+
+    while error is not None:
+        if QUERY_CANCELED in (getattr(error, 'pgcode', None), getattr(getattr(error, 'orig', None), 'pgcode', None)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def table_estimates(conn, queries: dict, table_name: str, col_names: list, datatypes: dict) -> tuple:
+
+    '''
+    Reads what the planner knows about the table: the statistics of the catalog mode, which are also the fallback values of the
+    statistics that cannot be computed in time, and the average width of every column.
+
+    Returns:
+    Tuple[dict, float, dict]:
+        - Mapping of column name to its catalog statistics, see catalog_profile.
+        - The estimated number of rows, from pg_class or from the size of the table when it was never analyzed.
+        - Mapping of column name to its average width in bytes.
+    '''
+
+    catalog = catalog_profile(conn, queries, table_name, col_names, datatypes)
+    schema, table = table_name.split(".")
+    column_widths_query = queries['column_widths_query'].format(schema=schema, table=table)
+    logger.info(column_widths_query)
+    known = {row[0]: row[1] for row in conn.execute(text(column_widths_query))}
+    widths = {col_name: known.get(col_name) or DEFAULT_WIDTH for col_name in col_names}
+
+    row_counts = [col_stats['num_rows'] for col_stats in catalog.values() if col_stats['num_rows'] is not None]
+    if len(row_counts)>0:
+        rows = max(row_counts)
+    else:
+        relation_pages_query = queries['relation_pages_query'].format(table_name=table_name)
+        logger.info(relation_pages_query)
+        pages = conn.execute(text(relation_pages_query)).scalar() or 0
+        rows = pages*PAGE_BYTES/(sum(widths.values())+TUPLE_HEADER_BYTES)
+        logger.warning(f'{table_name} has no planner statistics, assuming about {round(rows)} rows from its {pages} pages')
+    return catalog, rows, widths
+
+
+def estimate_costs(catalog: dict, rows: float, widths: dict, col_names: list, datatypes: dict, fraction: float, sample_method: str='SYSTEM',
+                   top_k: int=1, exact_counts: dict=None) -> tuple:
+
+    '''
+    Estimates the time every strategy of every statistic of every column takes, from the number of rows, the width and the estimated
+    number of distinct values of the columns. COUNT(DISTINCT) sorts the values, so its cost grows with their width, and the GROUP BY
+    and ranking of the most occurring values grows with the number of groups. A column whose values all differ only needs its smallest value when top_k is 1,
+    which most_occurring_values can only tell from an exact unique count, so this is assumed from the catalog until exact_counts are known.
+
+    Parameters:
+    catalog (dict): Mapping of column name to its catalog statistics, see table_estimates
+    rows (float): Estimated number of rows of the table
+    widths (dict): Mapping of column name to its average width in bytes
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    fraction (float): Fraction of the table read by the sampled strategy
+    sample_method (str): TABLESAMPLE method, SYSTEM reads the sampled pages only while BERNOULLI reads them all (default is 'SYSTEM').
+    top_k (int): Number of most occurring values computed per column (default is 1).
+    exact_counts (dict): Mapping of column name to its exact (non null count, unique count), or to None when its unique count
+                         will not be exact, for the columns whose exact counts were already computed (default is None).
+
+    Returns:
+    Tuple[dict, dict]:
+        - Mapping of (column, statistic) to the seconds of every strategy.
+        - Mapping of phase (see PHASES) to the seconds of the scan every one of its queries pays once.
+    '''
+
+    exact_counts = exact_counts or {}
+    costs = {}
+    for col_name in col_names:
+        width = widths[col_name]
+        unique, non_null = catalog[col_name]['unique'], catalog[col_name]['non_null']
+        all_distinct = unique is not None and unique==non_null
+        if col_name in exact_counts:
+            non_null, unique = exact_counts[col_name] or (non_null, unique)
+            all_distinct = exact_counts[col_name] is not None and unique==non_null
+        distinct_ratio = 1.0 if unique is None or rows<=0 else min(1.0, unique/rows)
+        distinct = SORT_SECONDS_PER_BYTE*width
+        distinct += TEXT_DISTINCT_SECONDS_PER_VALUE if datatypes[col_name] in TEXT_TYPES else DISTINCT_SECONDS_PER_VALUE
+        if top_k==1 and all_distinct:
+            top = COUNT_SECONDS_PER_VALUE
+        else:
+            top = GROUP_SECONDS_PER_VALUE+(RANK_SECONDS_PER_VALUE+RANK_SECONDS_PER_BYTE*width)*distinct_ratio
+        costs[(col_name, 'counts')] = {'exact': rows*COUNT_SECONDS_PER_VALUE, 'sampled': rows*fraction*COUNT_SECONDS_PER_VALUE, 'catalog': 0.0}
+        costs[(col_name, 'unique')] = {'exact': rows*distinct, 'sampled': rows*HLL_SECONDS_PER_VALUE, 'catalog': 0.0}
+        costs[(col_name, 'top')] = {'exact': rows*top, 'sampled': rows*fraction*top, 'catalog': 0.0}
+
+    scan = rows*(sum(widths.values())+TUPLE_HEADER_BYTES)*SCAN_SECONDS_PER_BYTE
+    sampled_scan = scan*fraction if sample_method=='SYSTEM' else scan
+    scan_costs = {'exact_counts': scan, 'exact_top': scan, 'sampled_counts': sampled_scan, 'sampled_unique': scan, 'sampled_top': sampled_scan}
+    return costs, scan_costs
+
+
+def next_strategy(options: dict, strategy: str):
+
+    '''
+    Returns the first strategy after `strategy` which is cheaper than it, or None if there is none.
+    '''
+
+    for cheaper in STRATEGIES[STRATEGIES.index(strategy)+1:]:
+        if options[cheaper]<options[strategy]:
+            return cheaper
+    return None
+
+
+def plan_statistics(costs: dict, scan_costs: dict, ceilings: dict, budget: float=None, batch_size: int=100) -> dict:
+
+    '''
+    Picks the strategy of every statistic so that the estimated time of the profile fits the budget.
+    Every statistic starts at its ceiling, the most accurate strategy allowed, and the statistic saving the most time
+    is degraded to its next cheaper strategy until the estimate fits, so the expensive statistics of the wide columns go first
+    and the cheap ones stay exact. A statistic is charged its share of the scans of its strategy's queries,
+    so that the last statistics of a phase are credited with the scans they save.
+    The budget left is then given back, the cheapest upgrades first, each statistic being offered every strategy between its own
+    and its ceiling, so that a statistic too expensive to go back to exact can still be sampled rather than read from the catalog.
+
+    Parameters:
+    costs (dict): Mapping of (column, statistic) to the seconds of every strategy, see estimate_costs
+    scan_costs (dict): Mapping of phase to the seconds of the scan of every query of the phase
+    ceilings (dict): Mapping of the (column, statistic) to plan to their most accurate allowed strategy
+    budget (float): Seconds available, None for no budget (default is None).
+    batch_size (int): Maximum number of columns of a query, every query of a phase paying for its own scan (default is 100).
+
+    Returns:
+    dict: Mapping of (column, statistic) to its strategy.
+    '''
+
+    plan = dict(ceilings)
+    if budget is None:
+        return plan
+
+    phase_items = {phase: set() for phase, _, _ in PHASES}
+    for item, strategy in plan.items():
+        if (item[1], strategy) in PHASE_OF:
+            phase_items[PHASE_OF[(item[1], strategy)]].add(item)
+    members = {phase: len(items) for phase, items in phase_items.items()}
+    shared = lambda phase, count: 0.0 if phase is None or count==0 else scan_costs[phase]*math.ceil(count/batch_size)
+    total = sum(costs[item][strategy] for item, strategy in plan.items()) + sum(shared(phase, count) for phase, count in members.items())
+
+    def change(item, strategy):
+        # The time added by moving the item to strategy: its own queries plus the change of the scans of the two phases
+        before, after = PHASE_OF.get((item[1], plan[item])), PHASE_OF.get((item[1], strategy))
+        scans = shared(before, members.get(before, 0)-1)-shared(before, members.get(before, 0))
+        scans += shared(after, members.get(after, 0)+1)-shared(after, members.get(after, 0))
+        return costs[item][strategy]-costs[item][plan[item]]+scans
+
+    candidates = []
+    def push(item):
+        cheaper = next_strategy(costs[item], plan[item])
+        if cheaper is not None:
+            heapq.heappush(candidates, (change(item, cheaper), item, cheaper))
+
+    def move(item, strategy):
+        before, after = PHASE_OF.get((item[1], plan[item])), PHASE_OF.get((item[1], strategy))
+        plan[item] = strategy
+        for phase, count in ((before, -1), (after, 1)):
+            if phase is not None:
+                (phase_items[phase].discard if count<0 else phase_items[phase].add)(item)
+                members[phase] += count
+        push(item)
+        # The next statistic leaving the phase saves a query of it, which raises the saving of all its statistics
+        if before is not None and members[before]%batch_size==1:
+            for member in phase_items[before]:
+                push(member)
+
+    for item in plan:
+        push(item)
+    while total>budget and len(candidates)>0:
+        priority, item, cheaper = heapq.heappop(candidates)
+        if next_strategy(costs[item], plan[item])!=cheaper:
+            continue
+        # The savings change as the phases lose members, a stale candidate is pushed back with its current saving
+        current = change(item, cheaper)
+        if len(candidates)>0 and current>candidates[0][0] and current!=priority:
+            heapq.heappush(candidates, (current, item, cheaper))
+            continue
+        total += current
+        move(item, cheaper)
+
+    # Spending what is left of the budget, every statistic below its ceiling is offered each more accurate strategy up to it and
+    # the cheapest additions are made first, e.g. the exact counts of the columns scanned anyway for the exact unique counts of others.
+    # An addition that does not fit is offered again once another statistic joins its phase, whose scans are then paid for.
+    upgrades = []
+    waiting = {}
+    def offer(item):
+        for better in STRATEGIES[STRATEGIES.index(ceilings[item]):STRATEGIES.index(plan[item])]:
+            heapq.heappush(upgrades, (change(item, better), item, better))
+
+    for item in plan:
+        offer(item)
+    while len(upgrades)>0:
+        priority, item, better = heapq.heappop(upgrades)
+        if STRATEGIES.index(better)>=STRATEGIES.index(plan[item]):
+            continue
+        current = change(item, better)
+        if len(upgrades)>0 and current>upgrades[0][0] and current!=priority:
+            heapq.heappush(upgrades, (current, item, better))
+            continue
+        phase = PHASE_OF.get((item[1], better))
+        if total+current>budget:
+            waiting.setdefault(phase, []).append((item, better))
+            continue
+        total += current
+        move(item, better)
+        offer(item)
+        for waiting_item, waiting_better in waiting.pop(phase, []):
+            heapq.heappush(upgrades, (change(waiting_item, waiting_better), waiting_item, waiting_better))
+
+    if total>budget:
+        logger.warning(f'The profile is estimated to take {round(total, 3)}s even with the cheapest strategies, over the {round(budget, 3)}s budget')
+    return plan
+
+
+def planned_profile(conn, queries: dict, table_name: str, col_names: list, datatypes: dict, time_budget: float=None,
+                    statement_timeout: float=None, sample_pct: float=1.0, sample_method: str='SYSTEM', seed: int=None,
+                    batch_size: int=100, top_k: int=1) -> dict:
+
+    '''
+    Profiles the table within a time budget for the planned profile mode. The counts, the unique count and the most occurring values
+    of every column are each computed exactly, from a sample (except the unique counts, estimated with HyperLogLog sketches
+    of the whole table as in the fast mode, see hll_sketches) or read from the planner statistics, whichever the cost model (see estimate_costs and plan_statistics) can afford.
+    The plan is revised before every query with the remaining budget and with the ratio of the actual to the estimated time
+    of the queries already run, so a slower database than modelled degrades more statistics, and a faster one fewer.
+    Every query runs with a statement_timeout of at most the remaining budget. A query that times out, or fails, is rolled back
+    and its statistics fall back to the next cheaper strategy, down to the catalog estimates, instead of failing the profile.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    time_budget (float): Seconds the profile should take, None for no budget, i.e. exact statistics unless a query times out (default is None).
+    statement_timeout (float): Maximum seconds of any single query, None for no limit besides the budget (default is None).
+    sample_pct (float): Percentage of the table read by the sampled strategy (default is 1).
+    sample_method (str): TABLESAMPLE method of the sampled strategy, 'SYSTEM' or 'BERNOULLI' (default is 'SYSTEM').
+    seed (int): Seed of the sample. A random seed is used if None.
+    batch_size (int): Maximum number of columns profiled by a single query (default is 100).
+    top_k (int): Number of most occurring values computed per column (default is 1).
+
+    Returns:
+    dict: Mapping of column name to a dictionary with its num_rows, datatype, null, non_null, unique, duplicates, top and top_k values,
+          their error bounds num_rows_error, null_error, non_null_error, unique_error, duplicates_error and top_vals_error (0 when exact,
+          None when read from the catalog or when the sample cannot tell the most occurring value apart, see top_confident), plan, the strategy of every statistic, and degraded, the statistics which fell back after a timeout.
+    '''
+
+    start = time.perf_counter()
+    sample_method = sample_method.strip().upper()
+    if sample_method not in ('SYSTEM', 'BERNOULLI'):
+        logger.error(f'Unexpected sample method {sample_method}. Use SYSTEM or BERNOULLI.')
+        raise ValueError(f'Unexpected sample method {sample_method}')
+    if not 0<sample_pct<=100:
+        logger.error(f'The sample percentage must be between 0 and 100, got {sample_pct}')
+        raise ValueError(f'Invalid sample percentage {sample_pct}')
+    if seed is None:
+        seed = random.randint(0, 2**31-1)
+    fraction = sample_pct/100
+    sample = queries['sample_clause'].format(table_name=table_name, method=sample_method, pct=sample_pct, seed=seed)
+
+    with query_label(col_names, 'catalog'):
+        catalog, rows, widths = table_estimates(conn, queries, table_name, col_names, datatypes)
+    costs, scan_costs = estimate_costs(catalog, rows, widths, col_names, datatypes, fraction, sample_method, top_k)
+
+    ceilings = {item: 'exact' for item in costs}
+    results = {}
+    degraded = {}
+    table = {}
+    observed = {'estimated': 0.0, 'actual': 0.0}
+    batch_limits = {}
+
+    def remaining():
+        return None if time_budget is None else time_budget-(time.perf_counter()-start)
+
+    def replan():
+        # Rescaling the model by how much slower or faster than estimated the queries already run were
+        scale = observed['actual']/observed['estimated'] if observed['estimated']>0 else 1.0
+        pending = {item: ceiling for item, ceiling in ceilings.items() if item not in results}
+        scaled = {item: {strategy: seconds*scale for strategy, seconds in costs[item].items()} for item in pending}
+        budget = remaining()
+        return plan_statistics(scaled, {phase: seconds*scale for phase, seconds in scan_costs.items()}, pending,
+                               None if budget is None else max(budget*PLAN_MARGIN, 0.0), batch_size)
+
+    def degrade(items: list, reason: str):
+        for item in items:
+            if item in results:
+                continue
+            cheaper = next_strategy(costs[item], ceilings[item]) or 'catalog'
+            logger.warning(f'The {item[1]} of {item[0]} fall back from {ceilings[item]} to {cheaper}: {reason}')
+            degraded.setdefault(item[0], []).append(item[1])
+            ceilings[item] = cheaper
+
+    def run(items: list, label: str, phase: str, function):
+        '''
+        Runs one query of a phase under the statement timeout. If it times out, the costliest half of its statistics are degraded
+        and the others are left to the next query. If it fails for another reason, e.g. a datatype the query cannot handle,
+        the phase's next queries take half as many columns, until the failing column is alone and its statistics are degraded.
+        Returns the function's result, or None if it timed out or failed.
+        '''
+        estimated = sum(costs[item][ceilings[item]] for item in items) + scan_costs[phase]
+        timeout = statement_timeout
+        budget = remaining()
+        if budget is not None:
+            if budget<=0:
+                degrade(items, 'the time budget is spent')
+                return None
+            scale = observed['actual']/observed['estimated'] if observed['estimated']>0 else 1.0
+            allowance = max(estimated*scale*TIMEOUT_ALLOWANCE, MIN_TIMEOUT)
+            # The queries still planned after this one, and those of the next cheaper strategy of its statistics should it time out,
+            # are kept the time they would be allowed, so that one slow query cannot leave the statistics after it to the catalog
+            later = {item: strategy for item, strategy in plan.items() if item not in results and item not in items}
+            later.update({item: next_strategy(costs[item], ceilings[item]) or 'catalog' for item in items})
+            later_phases = {PHASE_OF.get((item[1], strategy)) for item, strategy in later.items()} - {None}
+            if len(later_phases)>0:
+                reserve = sum(costs[item][strategy] for item, strategy in later.items()) + sum(scan_costs[phase] for phase in later_phases)
+                reserve = max(reserve*scale*TIMEOUT_ALLOWANCE, MIN_TIMEOUT*len(later_phases))
+                allowance = min(allowance, max(budget-reserve, MIN_TIMEOUT))
+            timeout = min(budget, allowance) if timeout is None else min(timeout, budget, allowance)
+        query_start = time.perf_counter()
+        try:
+            if timeout is not None:
+                # Local to the transaction, so it is reset by the rollback of a timed out query and when the connection is returned
+                conn.execute(text(queries['statement_timeout_query'].format(timeout_ms=max(1, math.ceil(timeout*1000)))))
+            with query_label(sorted({col_name for col_name, _ in items}), label):
+                return function()
+        except Exception as e:
+            conn.rollback()
+            if not is_timeout(e):
+                columns = sorted({col_name for col_name, _ in items})
+                if len(columns)>1:
+                    logger.warning(f'The {label} query of {columns} failed, retrying with half as many columns: {e}')
+                    batch_limits[phase] = math.ceil(len(columns)/2)
+                    return None
+                logger.exception(f'The {label} query of {columns} failed')
+                degrade(items, f'the query failed: {e}')
+                return None
+            costliest = sorted(items, key=lambda item: costs[item][ceilings[item]], reverse=True)[:math.ceil(len(items)/2)]
+            degrade(costliest, f'timed out after {round(timeout, 3)}s')
+            return None
+        finally:
+            observed['estimated'] += estimated
+            observed['actual'] += time.perf_counter()-query_start
+
+    for phase, strategy, statistics in PHASES:
+        if phase=='exact_top':
+            # The exact unique counts tell which columns only need their smallest value, the others are ranked
+            exact_counts = {col_name: (results[(col_name, 'counts')][1], results[(col_name, 'unique')][1])
+                            if results.get((col_name, 'unique'), ('',))[0]=='exact' else None for col_name in col_names}
+            costs, scan_costs = estimate_costs(catalog, rows, widths, col_names, datatypes, fraction, sample_method, top_k, exact_counts)
+
+        # Every query either computes its statistics or degrades some of them, until none is left to this phase
+        while True:
+            plan = replan()
+            pending = [(col_name, statistic) for col_name in col_names for statistic in statistics if plan.get((col_name, statistic))==strategy]
+            if len(pending)==0:
+                break
+            batch = list(dict.fromkeys(col_name for col_name, _ in pending))[:batch_limits.get(phase, batch_size)]
+            items = [item for item in pending if item[0] in batch]
+            logger.info(f'Computing the {strategy} {statistics} of {batch}')
+
+            if phase=='exact_counts':
+                # The non null counts are almost free in the scan of the unique counts, so they are always computed
+                distinct = {col_name for col_name, statistic in items if statistic=='unique'}
+                aggregates = []
+                for idx, col_name in enumerate(batch):
+                    aggregates.append(queries['non_null_agg'].format(col_name=col_name, idx=idx))
+                    if col_name in distinct:
+                        aggregates.append(queries['unique_agg'].format(col_name=col_name, idx=idx))
+                profile_query = queries['profile_query'].format(table_name=table_name, aggregates=', '.join(aggregates))
+                logger.info(profile_query)
+                counts = run(items, 'counts', phase, lambda: conn.execute(text(profile_query)).mappings().first())
+                if counts is None:
+                    continue
+                table['num_rows'] = int(counts['num_rows'])
+                for idx, col_name in enumerate(batch):
+                    results[(col_name, 'counts')] = ('exact', int(counts[f'non_null_{idx}']))
+                    if col_name in distinct:
+                        results[(col_name, 'unique')] = ('exact', int(counts[f'unique_{idx}']))
+
+            elif phase=='exact_top':
+                # Only an exact unique count tells that every value differs, anything else ranks the values
+                col_counts = {}
+                for col_name in batch:
+                    non_null = results.get((col_name, 'counts'), (None, catalog[col_name]['non_null']))[1]
+                    unique = results[(col_name, 'unique')][1] if results.get((col_name, 'unique'), ('',))[0]=='exact' else -1
+                    col_counts[col_name] = (1 if non_null is None else non_null, unique)
+                top = run(items, 'top_values', phase, lambda: most_occurring_values(conn, queries, table_name, col_counts, datatypes, top_k)[0])
+                if top is None:
+                    continue
+                for col_name in batch:
+                    results[(col_name, 'top')] = ('exact', top[col_name])
+
+            elif phase=='sampled_counts':
+                aggregates = ', '.join(queries['non_null_agg'].format(col_name=col_name, idx=idx) for idx, col_name in enumerate(batch))
+                sample_query = queries['profile_query'].format(table_name=sample, aggregates=aggregates)
+                logger.info(sample_query)
+                counts = run(items, 'sample', phase, lambda: conn.execute(text(sample_query)).mappings().first())
+                if counts is None:
+                    continue
+                if int(counts['num_rows'])==0:
+                    degrade(items, 'the sample is empty')
+                    continue
+                table['sample_rows'] = int(counts['num_rows'])
+                for idx, col_name in enumerate(batch):
+                    results[(col_name, 'counts')] = ('sampled', int(counts[f'non_null_{idx}']))
+
+            elif phase=='sampled_unique':
+                sketches = run(items, 'sketch_full_scan', phase, lambda: hll_sketches(conn, queries, table_name, batch))
+                if sketches is None:
+                    continue
+                for col_name in batch:
+                    results[(col_name, 'unique')] = ('sampled', sketches[col_name])
+
+            else:
+                # The runner-up of every column tells whether the sample's most occurring value can be trusted
+                top = run(items, 'sample', phase, lambda: top_values(conn, queries, sample, batch, datatypes, max(top_k, 2)))
+                if top is None:
+                    continue
+                for col_name in batch:
+                    results[(col_name, 'top')] = ('sampled', top[col_name])
+
+        # The statistics the plan left to a cheaper strategy can no longer use this phase's strategy
+        for item, ceiling in ceilings.items():
+            if item[1] in statistics and ceiling==strategy and item not in results:
+                ceilings[item] = next_strategy(costs[item], ceiling) or 'catalog'
+
+    # The row count of the whole table comes from the best strategy any query reached
+    if 'num_rows' in table:
+        num_rows, num_rows_error = table['num_rows'], 0
+    elif 'sample_rows' in table:
+        num_rows, num_rows_error = round(table['sample_rows']/fraction), math.ceil(sampled_bound(table['sample_rows'], fraction))
+    else:
+        num_rows = None if all(col_stats['num_rows'] is None for col_stats in catalog.values()) else round(rows)
+        num_rows_error = None
+
+    stats = {}
+    for col_name in col_names:
+        cat = catalog[col_name]
+        strategies = {}
+
+        strategy, value = results.get((col_name, 'counts'), ('catalog', None))
+        strategies['counts'] = strategy
+        if strategy=='exact':
+            non_null, non_null_error, null_error = value, 0, num_rows_error
+        elif strategy=='sampled':
+            non_null = round(value/fraction)
+            non_null_error = math.ceil(sampled_bound(value, fraction))
+            null_error = math.ceil(sampled_bound(table['sample_rows']-value, fraction))
+        else:
+            non_null, non_null_error, null_error = None, None, None
+            if cat['non_null'] is not None and num_rows is not None:
+                non_null = round(cat['non_null']/cat['num_rows']*num_rows) if cat['num_rows']>0 else 0
+        if non_null is not None and num_rows is not None:
+            non_null = min(non_null, num_rows)
+
+        strategy, value = results.get((col_name, 'unique'), ('catalog', None))
+        strategies['unique'] = strategy
+        if strategy=='exact':
+            unique, unique_error = value, 0
+        elif strategy=='sampled':
+            unique, unique_error = round(value.estimate()), math.ceil(Z_SCORE*value.relative_error()*value.estimate())
+        else:
+            unique, unique_error = cat['unique'], None
+        if unique is not None and non_null is not None:
+            unique = min(unique, non_null)
+
+        strategy, value = results.get((col_name, 'top'), ('catalog', [cat['top']]))
+        strategies['top'] = strategy
+        if strategy=='exact':
+            top_vals, top_vals_error = value, 0
+        elif strategy=='sampled':
+            top_vals, top_vals_error = [val for val, _ in value[:top_k]], 0 if top_confident(value) else None
+        else:
+            top_vals, top_vals_error = value, None
+
+        stats[col_name] = {
+            'num_rows': num_rows,
+            'datatype': datatypes[col_name],
+            'null': None if num_rows is None or non_null is None else num_rows-non_null,
+            'non_null': non_null,
+            'unique': unique,
+            'duplicates': None if non_null is None or unique is None else non_null-unique,
+            'top': top_vals[0] if len(top_vals)>0 else None,
+            'top_k': top_vals,
+            'num_rows_error': num_rows_error,
+            'null_error': null_error,
+            'non_null_error': non_null_error,
+            'unique_error': unique_error,
+            'duplicates_error': None if non_null_error is None or unique_error is None else non_null_error+unique_error,
+            'top_vals_error': top_vals_error,
+            'plan': ', '.join(f'{statistic}={strategies[statistic]}' for statistic in STATISTICS),
+            'degraded': ', '.join(degraded.get(col_name, []))
+        }
+        logger.info(f"Done for {col_name}")
+
+    elapsed = round(time.perf_counter()-start, 3)
+    planned = {strategy: sum(1 for col_stats in stats.values() for part in col_stats['plan'].split(', ') if part.endswith('='+strategy))
+               for strategy in STRATEGIES}
+    logger.info(f'Profiled {table_name} in {elapsed}s with {planned} statistics per strategy, {len(degraded)} columns degraded')
+    return stats
@@ -1,5 +1,13 @@
 import pandas as pd
 from utils.logging_config import logger
+from src.sampled_profile import ERROR_SUFFIX
+from src.catalog_profile import FRESHNESS_COLUMN
+from src.planned_profile import PLAN_COLUMN, DEGRADED_COLUMN
+from src.top_values import TOP_K_COLUMN
+from src.file_profile import datatype_family
+
+# Parameters of the generated report compared with the owner's report, besides the Column key
+REPORT_PARAMETERS = ['Num_Of_Rows', 'Datatype', 'Num_Of_Nulls', 'Num_Of_Non_Nulls', 'Num_Unique_Vals', 'Num_Of_Duplicates', 'Most_Occurring_Vals']
 
 def compare_columns(user_cols: list, owner_cols: list, match_for: str):
 
@@ -55,24 +63,50 @@ def compare_columns(user_cols: list, owner_cols: list, match_for: str):
     return common, missing, extra
 
 
-def compare_dataframes(generated_report:pd.DataFrame, original_report:pd.DataFrame) -> pd.DataFrame:
+def align_reports(generated_report: pd.DataFrame, original_report: pd.DataFrame, tolerances: dict=None):
 
     '''
-    Function to compare user generated report and the data owner's report, flag mismatches if any and returns it.
+    Helper function joining the user generated report and the data owner's report on Column and comparing every common parameter.
+    Numeric values are compared as numbers, with an optional per parameter tolerance, other values as strings.
 
     Parameters:
     generated_report (pd.DataFrame): Pandas DataFrame containing the report generated from the user's table.
     original_report (pd.DataFrame): Pandas DataFrame containing the extracted data owner's report.
+    tolerances (dict): Optional mapping of parameter to the absolute difference allowed between the two reports, e.g. {'Num_Of_Rows': 10}.
+                       A <parameter>_Error column in either report widens the tolerance of its parameter row by row,
+                       by the sum of both bounds when both reports carry one, e.g. a sketched file_summary report on the owner's side.
+                       An empty error bound marks an estimate that has none, e.g. a sampled most occurring value too close to the runner-up
+                       or a catalog fallback of a planned profile, its differences are unverified rather than mismatches.
+                       When either report profiles a file (see file_summary), the datatypes are compared by family, see datatype_family.
 
     Returns:
-    combined (pd.DataFrame): Pandas DataFrame with mismatches flagged after comparing user generated report with the data owner's report.
-    Returns None if any error is encountered.
+    Optional[dict]:
+        - merged: The inner join of the two reports on Column, owner values under the parameter name and user values under <parameter>_user.
+        - matches: Mapping of common parameter to a boolean Series over merged, True where the values match.
+        - unverified: Mapping of common parameter to a boolean Series over merged, True where the values differ but the estimate has no error bound.
+        - missing_cols, extra_cols: The columns found only in the owner's report and only in the user's report.
+        - common_params, missing_params, extra_params: The parameters found in both reports, only the owner's and only the user's.
+        - freshness: Mapping of column to its Last_Analyzed value for catalog mode reports, else None.
+        - plan: Mapping of column to its Profile_Plan and Degraded values for planned mode reports, else None.
+    Returns None if the reports cannot be compared.
     '''
 
-    owner_cols = original_report.columns.tolist()
-    user_cols = generated_report.columns.tolist()
+    tolerances = tolerances or {}
+    error_cols = [x for x in generated_report.columns if str(x).endswith(ERROR_SUFFIX)]
+    owner_error_cols = [x for x in original_report.columns if str(x).endswith(ERROR_SUFFIX)]
+    freshness = None
+    if FRESHNESS_COLUMN in generated_report.columns:
+        freshness = dict(zip(generated_report['Column'], generated_report[FRESHNESS_COLUMN]))
+    plan = None
+    if PLAN_COLUMN in generated_report.columns:
+        plan = generated_report.drop_duplicates(subset='Column').set_index('Column')[[PLAN_COLUMN, DEGRADED_COLUMN]].to_dict('index')
+    annotations = [FRESHNESS_COLUMN, TOP_K_COLUMN, PLAN_COLUMN, DEGRADED_COLUMN]
 
-    result = compare_columns(user_cols,owner_cols,'params')
+    # The error bounds and annotations of either report are not parameters to compare
+    owner_cols = [x for x in original_report.columns.tolist() if x not in owner_error_cols+annotations]
+    user_cols = [x for x in generated_report.columns.tolist() if x not in error_cols+annotations]
+
+    result = compare_columns(list(user_cols),list(owner_cols),'params')
 
     if result is None:
         logger.error("Error: Report comparison failed due to invalid parameters or missing columns.")
@@ -86,62 +120,180 @@ def compare_dataframes(generated_report:pd.DataFrame, original_report:pd.DataFra
         logger.warning(f'Field with columns not found in {common_params}. Aborting...')
         print('Field with columns not found. Aborting...')
         return None
-    else:
-        original_report = original_report[common_params]
-        generated_report = generated_report[common_params]
 
-    # Matching columns
-    owner_cols = list(original_report['Column'])
-    user_cols = list(generated_report['Column'])
-    
-    result = compare_columns(user_cols, owner_cols, 'columns')
+    # Keeping the owner's order of the parameters
+    common_params = [x for x in owner_cols if x in common_params and x!='Column']
+    missing_params = [x for x in owner_cols if x in missing_params]
+    extra_params = [x for x in generated_report.columns if x in extra_params]
 
-    if result is None:
-        logger.error("Error: Report comparison failed due to invalid parameters or missing columns.")
-        print("Aborting report generation.")
-        return None
-    else:
-        common_cols, missing_cols, extra_cols = result
-        logger.info(f'Common cols: {common_cols}, Missing cols: {missing_cols}, Extra cols: {extra_cols}')
+    owner_side = original_report[['Column']+common_params+owner_error_cols]
+    user_side = generated_report[['Column']+common_params+error_cols]
+    for side, name in [(owner_side, "owner's"), (user_side, "user's")]:
+        duplicated = side['Column'].duplicated()
+        if duplicated.any():
+            logger.warning(f"Duplicate columns found in the {name} report, keeping their first row: {list(side.loc[duplicated, 'Column'])}")
+    owner_side = owner_side.drop_duplicates(subset='Column')
+    user_side = user_side.drop_duplicates(subset='Column')
 
-    if len(common_cols)==0:
+    merged = owner_side.merge(user_side, on='Column', how='inner', suffixes=('', '_user'), sort=False)
+    missing_cols = owner_side.loc[~owner_side['Column'].isin(user_side['Column']), 'Column'].tolist()
+    extra_cols = user_side.loc[~user_side['Column'].isin(owner_side['Column']), 'Column'].tolist()
+    logger.info(f'Common cols: {merged.shape[0]}, Missing cols: {missing_cols}, Extra cols: {extra_cols}')
+    if merged.shape[0]==0:
         logger.warning(f'No common columns found!')
-    else:
-        original_report = original_report[original_report['Column'].isin(common_cols)]
-        generated_report = generated_report[generated_report['Column'].isin(common_cols)]
-    
-    logger.info(f'Checking for mismatches if any from common columns {common_cols}')
-    for col in common_params:
-        original_report[col] = original_report[col].astype(str)
-        generated_report[col] = generated_report[col].astype(str)
 
-        mask = original_report[col] != generated_report[col]
+    file_report = 'file' in (generated_report.attrs.get('mode'), original_report.attrs.get('mode'))
+    matches = {}
+    unverified = {}
+    for param in common_params:
+        expected = merged[param]
+        actual = merged[param+'_user']
+        if param=='Datatype' and file_report:
+            expected, actual = expected.map(datatype_family), actual.map(datatype_family)
+        tolerance = pd.Series(float(tolerances.get(param, 0)), index=merged.index)
+        unbounded = pd.Series(False, index=merged.index)
+        bounds = []
+        if param+ERROR_SUFFIX in owner_error_cols:
+            bounds.append(pd.to_numeric(merged[param+ERROR_SUFFIX], errors='coerce'))
+        if param+ERROR_SUFFIX in error_cols:
+            user_error = param+ERROR_SUFFIX+('_user' if param+ERROR_SUFFIX in owner_error_cols else '')
+            bounds.append(pd.to_numeric(merged[user_error], errors='coerce'))
+        if len(bounds)>0:
+            # A difference of two estimates is bounded by the sum of their bounds, and has none if either has none
+            error = sum(bounds[1:], bounds[0])
+            tolerance = tolerance.where(error.isna() | (tolerance>=error), error)
+            unbounded = error.isna()
 
-        original_report.loc[mask, col] = 'MISMATCH' 
-    combined = original_report.copy()
+        if pd.api.types.is_numeric_dtype(expected) and not pd.api.types.is_bool_dtype(expected):
+            expected_num = expected
+        else:
+            expected_num = pd.to_numeric(expected, errors='coerce')
+        if pd.api.types.is_numeric_dtype(actual) and not pd.api.types.is_bool_dtype(actual):
+            actual_num = actual
+        else:
+            actual_num = pd.to_numeric(actual, errors='coerce')
 
-    if len(missing_cols)>0:
-        logger.info("Adding missing columns in the report if any")
-        new_row = pd.DataFrame({'Column': missing_cols})
-        combined = pd.concat([combined, new_row], ignore_index=True)
-        combined = combined.fillna('MISSING COLUMN')
+        numeric = expected_num.notna() & actual_num.notna()
+        match = numeric & ((expected_num-actual_num).abs() <= tolerance)
+        other = ~numeric
+        if other.any():
+            both_null = expected[other].isna() & actual[other].isna()
+            match[other] = (expected[other].astype(str) == actual[other].astype(str)) | both_null
+        matches[param] = match
+        unverified[param] = ~match & unbounded
+
+    return {'merged': merged, 'matches': matches, 'unverified': unverified, 'missing_cols': missing_cols, 'extra_cols': extra_cols, 'common_params': common_params,
+            'missing_params': missing_params, 'extra_params': extra_params, 'freshness': freshness,
+            'plan': plan}
+
+
+def compare_dataframes(generated_report:pd.DataFrame, original_report:pd.DataFrame, tolerances: dict=None) -> pd.DataFrame:
+
+    '''
+    Function to compare user generated report and the data owner's report, flag mismatches if any and returns it.
+    The reports are joined on Column, so their rows do not need to be in the same order.
+
+    Parameters:
+    generated_report (pd.DataFrame): Pandas DataFrame containing the report generated from the user's table.
+    original_report (pd.DataFrame): Pandas DataFrame containing the extracted data owner's report.
+    tolerances (dict): Optional mapping of parameter to the absolute difference allowed between the two reports, e.g. {'Num_Of_Rows': 10}.
+
+    Returns:
+    combined (pd.DataFrame): Pandas DataFrame with mismatches flagged after comparing user generated report with the data owner's report.
+    Returns None if any error is encountered.
+
+    Estimated parameters of a fast mode report come with a <parameter>_Error column. Their owner values are matches when they fall
+    within the error bound of the estimate instead of being flagged as MISMATCH, and differences from an estimate without a bound
+    are flagged as UNVERIFIED.
+    The Last_Analyzed column of a catalog mode report and the Profile_Plan and Degraded columns of a planned mode report
+    are not compared and are carried over to the result, the Top_K_Vals column is not compared.
+    '''
+
+    aligned = align_reports(generated_report, original_report, tolerances)
+    if aligned is None:
+        return None
+    merged = aligned['merged']
 
-    if len(extra_cols)>0:
+    logger.info('Checking for mismatches if any from common columns')
+    combined = pd.DataFrame({'Column': merged['Column']})
+    for param in aligned['common_params']:
+        flagged = merged[param].astype(object).where(aligned['matches'][param], 'MISMATCH')
+        combined[param] = flagged.mask(aligned['unverified'][param], 'UNVERIFIED')
+
+    parts = [combined]
+    if len(aligned['missing_cols'])>0:
+        logger.info("Adding missing columns in the report if any")
+        parts.append(pd.DataFrame({'Column': aligned['missing_cols'], **{param: 'MISSING COLUMN' for param in aligned['common_params']}}))
+    if len(aligned['extra_cols'])>0:
         logger.info("Adding extra columns to the report if any")
-        new_row = pd.DataFrame({'Column': extra_cols})
-        combined = pd.concat([combined, new_row], ignore_index=True)
-        combined = combined.fillna('EXTRA COLUMN')          
+        parts.append(pd.DataFrame({'Column': aligned['extra_cols'], **{param: 'EXTRA COLUMN' for param in aligned['common_params']}}))
+    if len(parts)>1:
+        combined = pd.concat(parts, ignore_index=True)
 
     logger.info("Adding missing parameters in the report if any")
-    for param in missing_params:
+    for param in aligned['missing_params']:
         combined[param] = 'MISSING PARAMETER'
 
     logger.info("Adding extra parameters in the report if any")
-    for param in extra_params:
+    for param in aligned['extra_params']:
         combined[param] = 'EXTRA PARAMETER'
-        
-    report_cols = ['Column'] + [x for x in combined.columns.tolist() if x!='Column']
-    combined = combined[report_cols]
+
+    if aligned['freshness'] is not None:
+        logger.info("Adding the freshness of the catalog statistics to the report")
+        combined[FRESHNESS_COLUMN] = combined['Column'].map(aligned['freshness'])
+
+    if aligned['plan'] is not None:
+        logger.info("Adding the strategy of every statistic of the planned profile to the report")
+        for annotation in (PLAN_COLUMN, DEGRADED_COLUMN):
+            combined[annotation] = combined['Column'].map({col_name: values[annotation] for col_name, values in aligned['plan'].items()})
+
     logger.info(f'Report generation complete! Shape {combined.shape}')
     
     return combined
+
+
+def diff_reports(generated_report: pd.DataFrame, original_report: pd.DataFrame, tolerances: dict=None) -> pd.DataFrame:
+
+    '''
+    Function to list the differences between the user generated report and the data owner's report in long format, one row per difference.
+
+    Parameters:
+    generated_report (pd.DataFrame): Pandas DataFrame containing the report generated from the user's table.
+    original_report (pd.DataFrame): Pandas DataFrame containing the extracted data owner's report.
+    tolerances (dict): Optional mapping of parameter to the absolute difference allowed between the two reports.
+
+    Returns:
+    diff (pd.DataFrame): Pandas DataFrame with the columns Column, Parameter, Expected (owner's value), Actual (user's value) and Status,
+                         which is MISMATCH, UNVERIFIED (a difference from an estimate without an error bound), MISSING COLUMN,
+                         EXTRA COLUMN, MISSING PARAMETER or EXTRA PARAMETER.
+                         Missing and extra columns have no Parameter, missing and extra parameters no Column.
+    Returns None if any error is encountered.
+    '''
+
+    aligned = align_reports(generated_report, original_report, tolerances)
+    if aligned is None:
+        return None
+    merged = aligned['merged']
+
+    parts = []
+    for param in aligned['common_params']:
+        mismatch = ~aligned['matches'][param]
+        if mismatch.any():
+            status = pd.Series('MISMATCH', index=merged.index).mask(aligned['unverified'][param], 'UNVERIFIED')
+            parts.append(pd.DataFrame({'Column': merged.loc[mismatch, 'Column'], 'Parameter': param,
+                                       'Expected': merged.loc[mismatch, param].astype(object),
+                                       'Actual': merged.loc[mismatch, param+'_user'].astype(object), 'Status': status[mismatch]}))
+    for cols, label in [(aligned['missing_cols'], 'MISSING COLUMN'), (aligned['extra_cols'], 'EXTRA COLUMN')]:
+        if len(cols)>0:
+            parts.append(pd.DataFrame({'Column': cols, 'Parameter': None, 'Expected': None, 'Actual': None, 'Status': label}))
+    for params, label in [(aligned['missing_params'], 'MISSING PARAMETER'), (aligned['extra_params'], 'EXTRA PARAMETER')]:
+        if len(params)>0:
+            parts.append(pd.DataFrame({'Column': None, 'Parameter': params, 'Expected': None, 'Actual': None, 'Status': label}))
+
+    diff_cols = ['Column', 'Parameter', 'Expected', 'Actual', 'Status']
+    if len(parts)==0:
+        logger.info('No differences found between the reports')
+        return pd.DataFrame(columns=diff_cols)
+    diff = pd.concat(parts, ignore_index=True)[diff_cols]
+    logger.info(f'{diff.shape[0]} differences found between the reports')
+    return diff
@@ -0,0 +1,182 @@
+from utils.logging_config import logger
+from utils.query_counter import QueryCounter
+from utils.queries import QUERIES
+from utils.schema_cache import get_columns
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+import pandas as pd
+import math
+
+# Integer keys are split into ranges of their values, any other key into ranges of its hash
+INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+
+# Column of the row level diff telling whether a key was added, removed or changed in the user table
+ROW_STATUS_COLUMN = 'Status'
+
+def table_columns(conn, queries: dict, table_name: str) -> dict:
+
+    '''
+    Returns the mapping of column name to datatype of a table, from the schema cache while the table is unchanged.
+    '''
+
+    return get_columns(conn, table_name)
+
+
+def key_bounds(conn, queries: dict, table_name: str, key_expr: str) -> tuple:
+
+    '''
+    Returns the (smallest key, largest key, number of null keys) of a table.
+    '''
+
+    bounds_query = queries['row_diff_bounds_query'].format(table_name=table_name, key_expr=key_expr)
+    logger.info(bounds_query)
+    return tuple(conn.execute(text(bounds_query)).fetchone())
+
+
+def bucket_checksums(conn, queries: dict, table_name: str, key_expr: str, col_list: str, ranges: list) -> dict:
+
+    '''
+    Hashes every row of the key ranges in the database and aggregates the hashes into buckets of `width` keys of every range,
+    with one query whatever the number of ranges. Every row's key and hash are computed once, and its range picked with width_bucket.
+    The checksum of a bucket is its row count and the sum of its rows' 64 bit hashes, so it does not depend on the order of the rows.
+
+    Parameters:
+    ranges (list): The disjoint (low, high, width) key ranges sorted by low, high excluded
+
+    Returns:
+    dict: Mapping of (range index, bucket number) to its (count, checksum). Empty buckets are left out.
+    '''
+
+    lows, highs, widths = [', '.join(str(bound) for bound in bounds) for bounds in zip(*ranges)]
+    bucket_query = queries['row_diff_bucket_query'].format(table_name=table_name, key_expr=key_expr, col_list=col_list, lows=lows, highs=highs,
+                                                           widths=widths, low=ranges[0][0], high=ranges[-1][1])
+    logger.info(bucket_query)
+    # width_bucket numbers the ranges from 1
+    return {(int(idx)-1, int(bucket)): (int(cnt), int(checksum)) for idx, bucket, cnt, checksum in conn.execute(text(bucket_query))}
+
+
+def row_hashes(conn, queries: dict, table_name: str, key_columns: list, key_expr: str, col_list: str, ranges: list) -> dict:
+
+    '''
+    Fetches the key and the hash of every row of the disjoint (low, high) key ranges sorted by low, high excluded, with one query.
+
+    Returns:
+    dict: Mapping of key tuple to the sorted list of the hashes of its rows, more than one if the key is not unique.
+    '''
+
+    lows, highs = [', '.join(str(bound) for bound in bounds) for bounds in zip(*ranges)]
+    rows_query = queries['row_diff_rows_query'].format(table_name=table_name, key_list=', '.join(key_columns), key_expr=key_expr,
+                                                       col_list=col_list, lows=lows, highs=highs, low=ranges[0][0], high=ranges[-1][1])
+    logger.info(rows_query)
+    hashes = {}
+    for row in conn.execute(text(rows_query)):
+        hashes.setdefault(tuple(row[:-1]), []).append(row[-1])
+    return {key: sorted(values) for key, values in hashes.items()}
+
+
+def row_level_diff(user_conn, user_table: str, ref_conn, ref_table: str, key_columns: list, fanout: int=64,
+                   leaf_rows: int=10000) -> pd.DataFrame:
+
+    '''
+    Finds the rows which differ between the user's table and a reference table, without exporting either of them.
+    Every row is hashed in the database (hashtextextended of the row of their common columns) and the hashes are summed per key range bucket on both sides.
+    Only the buckets whose checksums differ are split again, level by level with one query per table and level,
+    until they hold at most leaf_rows rows, whose keys and hashes are then fetched and compared.
+    A few differences in two large tables therefore cost a few aggregate scans.
+    Integer keys are bucketed by value, other and multi column keys by their hashtext.
+
+    Parameters:
+    user_conn (connection object): The connection object to the user's database
+    user_table (schema_name.table_name): The user's table
+    ref_conn (connection object): The connection object to the reference database
+    ref_table (schema_name.table_name): The reference table
+    key_columns (list): The columns identifying a row in both tables
+    fanout (int): Number of buckets a mismatching range is split into (default is 64).
+    leaf_rows (int): Maximum number of rows of a range whose keys are fetched instead of split (default is 10000).
+
+    Returns:
+    pd.DataFrame: One row per differing key with the key columns and a Status column:
+                  ADDED if the key is only in the user's table, REMOVED if it is only in the reference table, CHANGED if its rows differ.
+                  The number of queries issued, buckets compared and rows fetched are stored in attrs.
+    Raises ValueError if a key column is missing from either table.
+    '''
+
+    queries = QUERIES
+
+    counter = QueryCounter().attach(user_conn).attach(ref_conn)
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='row_diff')
+    def on_both(function, *args):
+        # Both tables are queried at the same time, each on its own connection
+        user_future = executor.submit(function, user_conn, queries, user_table, *args)
+        ref_future = executor.submit(function, ref_conn, queries, ref_table, *args)
+        return user_future.result(), ref_future.result()
+
+    try:
+        user_types, ref_types = on_both(table_columns)
+        missing_keys = [col_name for col_name in key_columns if col_name not in user_types or col_name not in ref_types]
+        if len(missing_keys)>0:
+            logger.error(f'The key columns {missing_keys} are missing from {user_table} or {ref_table}')
+            raise ValueError(f'The key columns {missing_keys} are missing from {user_table} or {ref_table}')
+        common = sorted(set(user_types) & set(ref_types))
+        skipped = sorted(set(user_types) ^ set(ref_types))
+        if len(skipped)>0:
+            logger.warning(f'The columns {skipped} are not in both tables, rows are compared on {common}')
+        col_list = ', '.join(common)
+
+        if len(key_columns)==1 and user_types[key_columns[0]] in INTEGER_TYPES:
+            key_expr = key_columns[0]
+        else:
+            key_expr = f"hashtext(ROW({', '.join(key_columns)})::text)"
+        logger.info(f'Comparing {user_table} with {ref_table} by ranges of {key_expr}')
+
+        user_bounds, ref_bounds = on_both(key_bounds, key_expr)
+        for table_name, (_, _, null_keys) in [(user_table, user_bounds), (ref_table, ref_bounds)]:
+            if null_keys>0:
+                logger.warning(f'{null_keys} rows of {table_name} have a null key and are not compared')
+        lows = [bounds[0] for bounds in (user_bounds, ref_bounds) if bounds[0] is not None]
+        highs = [bounds[1] for bounds in (user_bounds, ref_bounds) if bounds[1] is not None]
+
+        differences = []
+        buckets_compared = 0
+        rows_fetched = 0
+        pending = [(min(lows), max(highs)+1, None)] if len(lows)>0 else []
+        while len(pending)>0:
+            pending.sort()
+            leaves = [(low, high) for low, high, num_rows in pending if (num_rows is not None and num_rows<=leaf_rows) or high-low<=1]
+            splits = [(low, high, math.ceil((high-low)/fanout)) for low, high, num_rows in pending
+                      if not ((num_rows is not None and num_rows<=leaf_rows) or high-low<=1)]
+            pending = []
+
+            if len(leaves)>0:
+                user_hashes, ref_hashes = on_both(row_hashes, key_columns, key_expr, col_list, leaves)
+                rows_fetched += sum(len(hashes) for hashes in user_hashes.values()) + sum(len(hashes) for hashes in ref_hashes.values())
+                for key in user_hashes.keys() | ref_hashes.keys():
+                    if key not in ref_hashes:
+                        differences.append((*key, 'ADDED'))
+                    elif key not in user_hashes:
+                        differences.append((*key, 'REMOVED'))
+                    elif user_hashes[key]!=ref_hashes[key]:
+                        differences.append((*key, 'CHANGED'))
+
+            if len(splits)>0:
+                user_buckets, ref_buckets = on_both(bucket_checksums, key_expr, col_list, splits)
+                for idx, bucket in user_buckets.keys() | ref_buckets.keys():
+                    buckets_compared += 1
+                    user_checksum, ref_checksum = user_buckets.get((idx, bucket)), ref_buckets.get((idx, bucket))
+                    if user_checksum!=ref_checksum:
+                        low, high, width = splits[idx]
+                        bucket_rows = max(checksum[0] for checksum in (user_checksum, ref_checksum) if checksum is not None)
+                        pending.append((low+bucket*width, min(low+(bucket+1)*width, high), bucket_rows))
+    finally:
+        executor.shutdown(wait=True)
+        counter.detach(user_conn)
+        counter.detach(ref_conn)
+
+    diff = pd.DataFrame(differences, columns=key_columns+[ROW_STATUS_COLUMN])
+    diff = diff.sort_values(key_columns, ignore_index=True)
+    diff.attrs['query_count'] = counter.count
+    diff.attrs['buckets_compared'] = buckets_compared
+    diff.attrs['rows_fetched'] = rows_fetched
+    logger.info(f'{diff.shape[0]} rows differ between {user_table} and {ref_table}, found with {counter.count} queries, '
+                f'{buckets_compared} bucket checksums and {rows_fetched} fetched rows')
+    return diff
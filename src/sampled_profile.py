@@ -0,0 +1,175 @@
+from utils.logging_config import logger
+from src.sketches import HyperLogLog
+from src.top_values import top_values
+import math
+import random
+import pandas as pd
+
+# Suffix of the report columns holding the error bound of an estimated parameter
+ERROR_SUFFIX = '_Error'
+
+# z-score of the two sided 95% confidence interval used for the error bounds
+Z_SCORE = 1.96
+
+def hll_sketches(conn, queries: dict, table_name: str, col_names: list, p: int=10) -> dict:
+
+    '''
+    Builds a HyperLogLog sketch of every column in col_names with a single query.
+    The values are hashed with hashtext in the database and only the 2**p registers per column are sent back,
+    so the query needs neither a sort nor memory proportional to the number of distinct values.
+    It still reads every row of table_name and aggregates one hash per row and column, so on a whole table it costs a full scan
+    and can take as long as the exact COUNT(DISTINCT) of narrow columns, see hll_query in utils/queries.json.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (str): The table, or table expression, to read the values from
+    col_names (list): The columns to sketch
+    p (int): Register index bits of the sketches (default is 10, i.e. 1024 registers and a ~3.3% standard error).
+
+    Returns:
+    dict: Mapping of column name to its HyperLogLog sketch.
+    '''
+
+    hash_bits = 32
+    values = ', '.join(queries['hll_value'].format(idx=idx, col_name=col_name) for idx, col_name in enumerate(col_names))
+    hll_query = queries['hll_query'].format(table_name=table_name, values=values, register_mask=(1<<p)-1,
+                                            p=p, rest_bits=hash_bits-p, max_rank=hash_bits-p+1)
+    logger.info(hll_query)
+    registers = pd.read_sql_query(hll_query, conn)
+
+    sketches = {col_name: HyperLogLog(p=p, hash_bits=hash_bits) for col_name in col_names}
+    for col_idx, group in registers.groupby('col_idx'):
+        sketches[col_names[int(col_idx)]].update_registers(group['register'], group['rank'])
+    return sketches
+
+
+def sampled_bound(sample_count: int, fraction: float) -> float:
+
+    '''
+    Returns the half width of the 95% confidence interval of a count scaled up from a sample,
+    assuming every row was kept independently with probability fraction (BERNOULLI sampling).
+    SYSTEM sampling keeps whole pages, so the bound is optimistic when the values are clustered on disk.
+
+    Parameters:
+    sample_count (int): Number of sampled rows matching the count
+    fraction (float): Fraction of the rows kept by the sample, between 0 and 1
+
+    Returns:
+    float: The error bound of sample_count/fraction.
+    '''
+
+    if fraction>=1:
+        return 0.0
+    return Z_SCORE*math.sqrt(sample_count*(1-fraction))/fraction
+
+
+def top_confident(ranked: list) -> bool:
+
+    '''
+    Tells whether the most occurring value of a sample is also the table's at 95% confidence: its sample count must lead
+    the runner-up's by more than the bound of the difference of two sampled counts, Z_SCORE*sqrt(count+runner_up).
+
+    Parameters:
+    ranked (list): The (value, sample count) pairs of the column, most occurring first, with at least the runner-up if there is one
+
+    Returns:
+    bool: True if the sample tells the most occurring value apart from the runner-up.
+    '''
+
+    if len(ranked)==0:
+        return True
+    count = ranked[0][1]
+    runner_up = ranked[1][1] if len(ranked)>1 else 0
+    return count-runner_up > Z_SCORE*math.sqrt(count+runner_up)
+
+
+def sampled_profile(conn, queries: dict, table_name: str, col_names: list, datatypes: dict, sample_pct: float=1.0,
+                    sample_method: str='SYSTEM', seed: int=None, hll_precision: int=10, top_k: int=1) -> dict:
+
+    '''
+    Estimates the statistics of every column in col_names for the fast profile mode.
+    The row, null and non null counts and the most occurring value are computed on a TABLESAMPLE of the table and scaled up,
+    while the unique counts are estimated with HyperLogLog sketches of the whole table, the one full scan of the mode, see hll_sketches.
+    Every estimated count comes with the half width of its 95% confidence interval. The most occurring value's error is 0
+    when the sample tells it apart from the runner-up (see top_confident) and None when it does not, as its value has no numeric bound.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (schema_name.table_name): The schema and table name to profile
+    col_names (list): The columns to profile
+    datatypes (dict): Mapping of column name to its datatype
+    sample_pct (float): Percentage of the table read by the sample, between 0 and 100 (default is 1).
+    sample_method (str): 'SYSTEM' samples pages and is the fastest, 'BERNOULLI' samples rows and gives tighter bounds (default is 'SYSTEM').
+    seed (int): Seed of the sample, so that every query of the run reads the same sample. A random seed is used if None.
+    hll_precision (int): Register index bits of the HyperLogLog sketches (default is 10).
+    top_k (int): Number of most occurring values computed per column from the sample (default is 1).
+
+    Returns:
+    dict: Mapping of column name to a dictionary with its num_rows, datatype, null, non_null, unique, duplicates and top values
+          the top_k values and the error bounds num_rows_error, null_error, non_null_error, unique_error, duplicates_error and top_vals_error.
+    '''
+
+    sample_method = sample_method.strip().upper()
+    if sample_method not in ('SYSTEM', 'BERNOULLI'):
+        logger.error(f'Unexpected sample method {sample_method}. Use SYSTEM or BERNOULLI.')
+        raise ValueError(f'Unexpected sample method {sample_method}')
+    if not 0<sample_pct<=100:
+        logger.error(f'The sample percentage must be between 0 and 100, got {sample_pct}')
+        raise ValueError(f'Invalid sample percentage {sample_pct}')
+    if seed is None:
+        seed = random.randint(0, 2**31-1)
+    fraction = sample_pct/100
+    sample = queries['sample_clause'].format(table_name=table_name, method=sample_method, pct=sample_pct, seed=seed)
+    logger.info(f'Sampling {sample_pct}% of {table_name} with {sample_method} and seed {seed}')
+
+    aggregates = ', '.join(queries['non_null_agg'].format(col_name=col_name, idx=idx) for idx, col_name in enumerate(col_names))
+    sample_query = queries['profile_query'].format(table_name=sample, aggregates=aggregates)
+    logger.info(sample_query)
+    counts = pd.read_sql_query(sample_query, conn).iloc[0]
+    sample_rows = int(counts['num_rows'])
+    if sample_rows==0:
+        logger.warning(f'The sample of {table_name} is empty, the estimates will be 0. Use a larger sample or BERNOULLI for small tables.')
+    row_count = round(sample_rows/fraction)
+    row_error = math.ceil(sampled_bound(sample_rows, fraction))
+
+    logger.info(f'Estimating the unique counts of {col_names} with HyperLogLog')
+    sketches = hll_sketches(conn, queries, table_name, col_names, hll_precision)
+
+    logger.info(f'Computing the most occurring values of {col_names} from the sample')
+    # The runner-up of every column tells whether the sample's most occurring value can be trusted
+    sample_top = top_values(conn, queries, sample, col_names, datatypes, max(top_k, 2))
+
+    stats = {}
+    for idx, col_name in enumerate(col_names):
+        sample_non_null = int(counts[f'non_null_{idx}'])
+        non_null_count = round(sample_non_null/fraction)
+        null_count = row_count-non_null_count
+        non_null_error = math.ceil(sampled_bound(sample_non_null, fraction))
+        null_error = math.ceil(sampled_bound(sample_rows-sample_non_null, fraction))
+
+        sketch = sketches[col_name]
+        unique_count = min(round(sketch.estimate()), non_null_count)
+        unique_error = math.ceil(Z_SCORE*sketch.relative_error()*sketch.estimate())
+
+        top_vals = [val for val, _ in sample_top[col_name][:top_k]]
+
+        stats[col_name] = {
+            'num_rows': row_count,
+            'datatype': datatypes[col_name],
+            'null': null_count,
+            'non_null': non_null_count,
+            'unique': unique_count,
+            'duplicates': non_null_count-unique_count,
+            'top': top_vals[0] if len(top_vals)>0 else None,
+            'top_k': top_vals,
+            'num_rows_error': row_error,
+            'null_error': null_error,
+            'non_null_error': non_null_error,
+            'unique_error': unique_error,
+            'duplicates_error': non_null_error+unique_error,
+            'top_vals_error': 0 if top_confident(sample_top[col_name]) else None
+        }
+        logger.info(f"Done for {col_name}")
+    return stats
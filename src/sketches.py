@@ -0,0 +1,206 @@
+import math
+import numpy as np
+import os
+import heapq
+import itertools
+import pickle
+import uuid
+import zlib
+
+class HyperLogLog:
+    '''
+    HyperLogLog distinct count sketch.
+    The registers are filled either from the database (see hll_query in utils/queries.json) or by merging other sketches,
+    and the estimate carries a standard error of about 1.04/sqrt(2**p).
+
+    Parameters:
+    p (int): Number of hash bits used to pick a register, the sketch keeps 2**p registers (default is 10).
+    hash_bits (int): Width of the hash the registers were built from (default is 32, the width of PostgreSQL's hashtext).
+    '''
+
+    def __init__(self, p: int=10, hash_bits: int=32):
+        self.p = p
+        self.hash_bits = hash_bits
+        self.num_registers = 1 << p
+        self.registers = np.zeros(self.num_registers, dtype=np.uint8)
+
+    def update_registers(self, indexes, ranks):
+        '''
+        Keeps the maximum rank seen for every register index.
+
+        Parameters:
+        indexes (array-like): Register indexes between 0 and 2**p - 1
+        ranks (array-like): Position of the first set bit of the remaining hash bits for each index
+        '''
+        np.maximum.at(self.registers, np.asarray(indexes, dtype=np.int64), np.asarray(ranks, dtype=np.uint8))
+
+    def merge(self, other):
+        '''
+        Merges another sketch built with the same parameters into this one and returns it.
+        '''
+        if (self.p, self.hash_bits)!=(other.p, other.hash_bits):
+            raise ValueError('Cannot merge HyperLogLog sketches with different parameters')
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self) -> float:
+        '''
+        Returns the estimated number of distinct values, with the usual small and large range corrections.
+        '''
+        m = self.num_registers
+        alpha = 0.7213/(1+1.079/m)
+        raw = alpha*m*m/np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers==0))
+        if raw<=2.5*m and zeros>0:
+            return m*math.log(m/zeros)
+        hash_space = 2.0**self.hash_bits
+        if raw>hash_space/30:
+            return -hash_space*math.log(1-raw/hash_space)
+        return raw
+
+    def relative_error(self) -> float:
+        '''
+        Returns the relative standard error of the estimate.
+        '''
+        return 1.04/math.sqrt(self.num_registers)
+
+
+class MisraGries:
+    '''
+    Misra-Gries heavy hitters sketch keeping at most `capacity` counters.
+    Every value occurring more than error times is guaranteed to be kept, and its count is underestimated by at most error,
+    which never exceeds N/(capacity+1) for N counted values. Sketches can be merged with the same guarantee.
+
+    Parameters:
+    capacity (int): Maximum number of values tracked (default is 1000).
+    '''
+
+    def __init__(self, capacity: int=1000):
+        self.capacity = capacity
+        self.counters = {}
+        self.error = 0
+        self.total = 0
+
+    def update_counts(self, counts: dict):
+        '''
+        Adds pre-aggregated counts, e.g. the value counts of a chunk of rows, to the sketch.
+
+        Parameters:
+        counts (dict): Mapping of value to the number of times it was seen
+        '''
+        for value, count in counts.items():
+            self.counters[value] = self.counters.get(value, 0) + int(count)
+            self.total += int(count)
+        self._prune()
+
+    def merge(self, other):
+        '''
+        Merges another sketch into this one and returns it.
+        '''
+        for value, count in other.counters.items():
+            self.counters[value] = self.counters.get(value, 0) + count
+        self.total += other.total
+        self.error += other.error
+        self._prune()
+        return self
+
+    def _prune(self):
+        if len(self.counters)<=self.capacity:
+            return
+        # Subtracting the (capacity+1)-th largest count keeps at most capacity positive counters
+        cut = sorted(self.counters.values(), reverse=True)[self.capacity]
+        self.counters = {value: count-cut for value, count in self.counters.items() if count>cut}
+        self.error += cut
+
+    def top(self, k: int=1) -> list:
+        '''
+        Returns up to k (value, count) pairs with the largest counts, ties broken by the sorted order of the values.
+        '''
+        return sorted(self.counters.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+class DistinctCounts:
+    '''
+    Exact counts of the distinct values of a column, mergeable like the sketches above.
+    Once more than `limit` values are held in memory they are spilled to disk, split into hash buckets,
+    so that merged counts can later be summed one bucket at a time.
+
+    Parameters:
+    spill_dir (str): Folder the buckets are spilled to. It must be shared by every process whose counts are merged.
+    limit (int): Maximum number of values held in memory before spilling (default is 1000000).
+    num_buckets (int): Number of hash buckets the spilled values are split into (default is 64).
+    '''
+
+    def __init__(self, spill_dir: str, limit: int=1000000, num_buckets: int=64):
+        self.spill_dir = spill_dir
+        self.limit = limit
+        self.num_buckets = num_buckets
+        self.counts = {}
+        self.bucket_files = [[] for _ in range(num_buckets)]
+
+    @property
+    def spilled(self) -> bool:
+        return any(len(files)>0 for files in self.bucket_files)
+
+    def update_counts(self, counts: dict):
+        '''
+        Adds pre-aggregated counts, e.g. the grouped counts of a range of rows, spilling them to disk beyond the limit.
+
+        Parameters:
+        counts (dict): Mapping of value to the number of times it was seen
+        '''
+        for value, count in counts.items():
+            self.counts[value] = self.counts.get(value, 0) + int(count)
+        if len(self.counts)>self.limit:
+            self._spill()
+
+    def merge(self, other):
+        '''
+        Merges other counts into these ones and returns them. The spilled buckets are not read, only their files are collected.
+        '''
+        self.update_counts(other.counts)
+        for bucket, files in enumerate(other.bucket_files):
+            self.bucket_files[bucket].extend(files)
+        return self
+
+    def _bucket(self, value) -> int:
+        # hash() is salted per process, crc32 buckets the same value the same way in every worker
+        return zlib.crc32(repr(value).encode()) % self.num_buckets
+
+    def _spill(self):
+        buckets = [{} for _ in range(self.num_buckets)]
+        for value, count in self.counts.items():
+            buckets[self._bucket(value)][value] = count
+        for bucket, counts in enumerate(buckets):
+            if len(counts)==0:
+                continue
+            path = os.path.join(self.spill_dir, f'{uuid.uuid4().hex}_{bucket}.pkl')
+            with open(path, 'wb') as f:
+                pickle.dump(counts, f)
+            self.bucket_files[bucket].append(path)
+        self.counts = {}
+
+    def _bucket_counts(self):
+        if not self.spilled:
+            yield self.counts
+            return
+        self._spill()
+        for files in self.bucket_files:
+            counts = {}
+            for path in files:
+                with open(path, 'rb') as f:
+                    for value, count in pickle.load(f).items():
+                        counts[value] = counts.get(value, 0) + count
+            yield counts
+
+    def summarize(self, k: int=1) -> tuple:
+        '''
+        Returns the number of distinct values and up to k (value, count) pairs with the largest counts,
+        ties broken by the sorted order of the values. Spilled values are read back one bucket at a time.
+        '''
+        unique_count = 0
+        top = []
+        for counts in self._bucket_counts():
+            unique_count += len(counts)
+            top = heapq.nsmallest(k, itertools.chain(top, counts.items()), key=lambda item: (-item[1], item[0]))
+        return unique_count, top
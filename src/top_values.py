@@ -0,0 +1,210 @@
+from utils.logging_config import logger
+from utils.query_profiler import query_label
+from src.sketches import MisraGries
+from decimal import Decimal
+from sqlalchemy import text
+
+# Report column listing the top k values of every column when more than one is requested
+TOP_K_COLUMN = 'Top_K_Vals'
+
+# Text columns are ordered by code point, the order Python sorts strings in, whatever the database's collation
+TEXT_TYPES = ('text', 'character varying', 'character')
+
+# Datatypes, as information_schema reports them, that PostgreSQL has a MIN aggregate for. Others, e.g. uuid, boolean, bytea, jsonb
+# or user defined types such as enums, which information_schema cannot tell apart, are only ordered by their btree operators
+MIN_TYPES = TEXT_TYPES + ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision', 'money', 'oid', 'date',
+                          'time without time zone', 'time with time zone', 'timestamp without time zone', 'timestamp with time zone',
+                          'interval', 'inet')
+
+def collation(datatype: str) -> str:
+
+    '''
+    Returns the COLLATE clause which makes the database order the values of a column the way Python sorts them.
+    '''
+
+    return ' COLLATE "C"' if datatype in TEXT_TYPES else ''
+
+
+def as_report_value(value):
+
+    '''
+    Converts a value fetched through the DBAPI cursor to the value pandas would have returned for it,
+    so that the most occurring values are written to the report the same way whichever query produced them.
+    '''
+
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def portable_value(value):
+
+    '''
+    Returns a value in a form that can be pickled, to send it to another process or store it: bytea values are fetched as memoryviews,
+    which are returned as bytes.
+    '''
+
+    return bytes(value) if isinstance(value, memoryview) else value
+
+
+def build_top_values_query(queries: dict, table_name: str, col_names: list, datatypes: dict, k: int=1) -> str:
+
+    '''
+    Builds a single GROUPING SETS query returning the k most occurring values of every column in col_names.
+    Values are ranked by count and ties are broken by the sorted order of the values inside the database, so no tied values are sent back.
+
+    Parameters:
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (str): The table, or table expression, to read the values from
+    col_names (list): The columns to rank the values of
+    datatypes (dict): Mapping of column name to its datatype
+    k (int): Number of values returned per column (default is 1).
+
+    Returns:
+    str: The query. Its rows are (col_idx, one column per col_name, cnt) ordered by col_idx and rank.
+    '''
+
+    col_list = ', '.join(col_names)
+    order_list = ', '.join(col_name+collation(datatypes[col_name]) for col_name in col_names)
+    col_idx_case = ' '.join(queries['grouping_col_idx'].format(col_name=col_name, idx=idx) for idx, col_name in enumerate(col_names))
+    count_case = ' '.join(queries['grouping_count'].format(col_name=col_name) for col_name in col_names)
+    grouping_sets = ', '.join(f'({col_name})' for col_name in col_names)
+    return queries['top_values_query'].format(table_name=table_name, col_list=col_list, order_list=order_list, col_idx_case=col_idx_case,
+                                              count_case=count_case, grouping_sets=grouping_sets, k=k)
+
+
+def top_values(conn, queries: dict, table_name: str, col_names: list, datatypes: dict, k: int=1) -> dict:
+
+    '''
+    Computes the k most occurring values of every column in col_names with one query, see build_top_values_query.
+
+    Returns:
+    dict: Mapping of column name to its list of (value, count) pairs, most occurring first.
+          Nulls are counted as 0, so a column only returns None when all its values are null.
+    '''
+
+    top_values_query = build_top_values_query(queries, table_name, col_names, datatypes, k)
+    logger.info(top_values_query)
+    values = {col_name: [] for col_name in col_names}
+    for row in conn.execute(text(top_values_query)):
+        col_idx = row[0]
+        values[col_names[col_idx]].append((as_report_value(row[col_idx+1]), int(row[-1])))
+    return values
+
+
+def min_values(conn, queries: dict, table_name: str, col_names: list, datatypes: dict) -> dict:
+
+    '''
+    Computes the smallest value of every column in col_names, with one aggregate query for the columns whose datatype has
+    a MIN aggregate (see MIN_TYPES) and one ORDER BY ... LIMIT 1 query for each of the others.
+    When every value of a column is distinct they are all tied, and the smallest one is its most occurring value.
+
+    Returns:
+    dict: Mapping of column name to its smallest value.
+    '''
+
+    smallest = {}
+    aggregated = [col_name for col_name in col_names if datatypes[col_name] in MIN_TYPES]
+    if len(aggregated)>0:
+        aggregates = ', '.join(queries['min_agg'].format(col_name=col_name, idx=idx, collation=collation(datatypes[col_name]))
+                               for idx, col_name in enumerate(aggregated))
+        min_query = queries['aggregate_query'].format(table_name=table_name, aggregates=aggregates)
+        logger.info(min_query)
+        row = conn.execute(text(min_query)).fetchone()
+        smallest.update({col_name: as_report_value(row[idx]) for idx, col_name in enumerate(aggregated)})
+    for col_name in col_names:
+        if col_name not in smallest:
+            first_value_query = queries['first_value_query'].format(table_name=table_name, col_name=col_name,
+                                                                    collation=collation(datatypes[col_name]))
+            logger.info(first_value_query)
+            smallest[col_name] = as_report_value(conn.execute(text(first_value_query)).scalar())
+    return {col_name: smallest[col_name] for col_name in col_names}
+
+
+def heavy_hitters(conn, queries: dict, table_name: str, col_name: str, capacity: int=1000, chunksize: int=100000) -> MisraGries:
+
+    '''
+    Finds the most occurring values of a high cardinality column with a Misra-Gries sketch, without a GROUP BY over all its distinct values.
+    The values are streamed through a server side cursor and counted chunk by chunk, so memory stays bounded by capacity and chunksize.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (str): The table, or table expression, to read the values from
+    col_name (str): The column to sketch
+    capacity (int): Maximum number of values tracked by the sketch (default is 1000).
+    chunksize (int): Number of rows fetched from the cursor at a time (default is 100000).
+
+    Returns:
+    MisraGries: The sketch. Its counts are underestimated by at most sketch.error.
+    '''
+
+    stream_query = queries['stream_column_query'].format(table_name=table_name, col_name=col_name)
+    logger.info(stream_query)
+    sketch = MisraGries(capacity)
+    result = conn.execution_options(stream_results=True, yield_per=chunksize).execute(text(stream_query))
+    for chunk in result.partitions():
+        counts = {}
+        for (value,) in chunk:
+            value = as_report_value(value)
+            counts[value] = counts.get(value, 0) + 1
+        sketch.update_counts(counts)
+    logger.info(f'Sketched {sketch.total} values of {col_name}, counts are exact within {sketch.error}')
+    return sketch
+
+
+def most_occurring_values(conn, queries: dict, table_name: str, col_counts: dict, datatypes: dict, k: int=1,
+                          sketch_threshold: int=None, sketch_capacity: int=1000) -> tuple:
+
+    '''
+    Computes the k most occurring values of the columns, picking the cheapest exact method for each of them:
+    - columns with only nulls need no query,
+    - columns whose values are all distinct only need their smallest value when k is 1, computed for all of them in one query,
+    - the other columns are ranked together by one GROUPING SETS query,
+    - columns with more than sketch_threshold distinct values use a bounded memory Misra-Gries sketch instead, if a threshold is set.
+
+    Parameters:
+    conn (connection object): The connection object to a database
+    queries (dict): The query templates loaded from utils/queries.json
+    table_name (str): The table, or table expression, to read the values from
+    col_counts (dict): Mapping of column name to its (non null count, unique count)
+    datatypes (dict): Mapping of column name to its datatype
+    k (int): Number of values returned per column (default is 1).
+    sketch_threshold (int): Unique count above which a column is sketched instead of grouped (default is None, never sketch).
+    sketch_capacity (int): Number of counters of the sketches (default is 1000).
+
+    Returns:
+    Tuple[dict, dict]:
+        - Mapping of column name to its list of up to k most occurring values, most occurring first. All null columns map to [None].
+        - Mapping of sketched column name to the error bound of its counts.
+    '''
+
+    values = {}
+    sketch_errors = {}
+    unique_cols = []
+    grouped_cols = []
+    for col_name, (non_null_count, unique_count) in col_counts.items():
+        if non_null_count==0:
+            values[col_name] = [None]
+        elif sketch_threshold is not None and unique_count>sketch_threshold and not (k==1 and unique_count==non_null_count):
+            with query_label([col_name], 'top_values_sketch'):
+                sketch = heavy_hitters(conn, queries, table_name, col_name, sketch_capacity)
+            values[col_name] = [val for val, _ in sketch.top(k)]
+            sketch_errors[col_name] = sketch.error
+        elif k==1 and unique_count==non_null_count:
+            unique_cols.append(col_name)
+        else:
+            grouped_cols.append(col_name)
+
+    if len(unique_cols)>0:
+        logger.info(f'Every value of {unique_cols} is distinct, using their smallest value')
+        with query_label(unique_cols, 'top_values_min'):
+            unique_values = min_values(conn, queries, table_name, unique_cols, datatypes)
+        for col_name, val in unique_values.items():
+            values[col_name] = [val]
+    if len(grouped_cols)>0:
+        with query_label(grouped_cols, 'top_values'):
+            ranked_values = top_values(conn, queries, table_name, grouped_cols, datatypes, k)
+        for col_name, ranked in ranked_values.items():
+            values[col_name] = [val for val, _ in ranked]
+    return values, sketch_errors
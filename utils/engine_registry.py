@@ -0,0 +1,41 @@
+import threading
+from sqlalchemy import create_engine
+from utils.logging_config import logger
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine(dsn: str, pool_size: int=5):
+    '''
+    Returns the engine of a DSN, creating it on first use, so that every run and table of the process using that database
+    shares one connection pool. Connections are pinged when checked out, so pooled connections closed by the server are replaced.
+
+    Parameters:
+    dsn (str): The SQLAlchemy URL of the database
+    pool_size (int): Number of connections kept in the pool when the engine is created (default is 5).
+
+    Returns:
+    Engine: The shared engine.
+    '''
+    with _engines_lock:
+        if dsn not in _engines:
+            _engines[dsn] = create_engine(dsn, pool_size=pool_size, pool_pre_ping=True)
+        elif _engines[dsn].pool.size()<pool_size:
+            logger.warning(f'The engine of {database_key(_engines[dsn])} keeps {_engines[dsn].pool.size()} connections, '
+                           f'fewer than the {pool_size} requested')
+        return _engines[dsn]
+
+def database_key(db) -> str:
+    '''
+    Returns the host, port and database of an engine, which identify the database whatever the credentials used.
+    '''
+    return f"{db.url.host or db.url.query.get('host')}:{db.url.port}/{db.url.database}"
+
+def dispose_engines():
+    '''
+    Closes the pooled connections of every engine and forgets them.
+    '''
+    with _engines_lock:
+        for db in _engines.values():
+            db.dispose()
+        _engines.clear()
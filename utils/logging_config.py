@@ -1,20 +1,126 @@
+import os
+import copy
+import glob
+import json
+import queue
+import atexit
 import logging
+import multiprocessing
+from contextlib import contextmanager
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Every run writes its own log file, so that concurrent runs never rotate a file another process writes to.
+# A file is rotated once it reaches LOG_MAX_BYTES, keeping LOG_BACKUP_COUNT older files, and only the files of the last LOG_MAX_RUNS runs are kept.
+# Worker processes put their records on a queue of the run instead, see worker_logging.
+LOG_DIR = './logs'
+LOG_FILE = os.path.join(LOG_DIR, f'veritas_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{os.getpid()}.log')
+LOG_MAX_BYTES = 10*1024*1024
+LOG_BACKUP_COUNT = 5
+LOG_MAX_RUNS = 20
+
+# Level of the shared logger, e.g. VERITAS_LOG_LEVEL=DEBUG also logs the full reports
+LOG_LEVEL = os.environ.get('VERITAS_LOG_LEVEL', 'INFO').upper()
+
+# Attributes every LogRecord has, any other one was passed in extra and is written as a field of the JSON record
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a record as one JSON object per line with its time, level, logger, process, thread and message,
+    along with the fields passed in extra, e.g. logger.info('Profiled', extra={'table': table_name}).
+    '''
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    '''
+    Puts the records on the queue of the background writer. The message is only rendered here, when the record's level is enabled,
+    and the JSON formatting and the write happen on the writer's thread, off the caller's path.
+    Pass expensive payloads as arguments, e.g. logger.debug('Report:\n%s', report), so that they cost nothing when the level is off.
+    '''
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def prune_logs(log_dir: str=LOG_DIR, keep: int=LOG_MAX_RUNS):
+    '''
+    Deletes the log files of all the runs but the `keep` latest ones, along with their rotated files.
+    '''
+    runs = sorted(glob.glob(os.path.join(log_dir, 'veritas_*.log')), key=os.path.getmtime, reverse=True)
+    for path in runs[keep:]:
+        for filename in [path]+glob.glob(f'{glob.escape(path)}.*'):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+@contextmanager
+def worker_logging(context=multiprocessing):
+    '''
+    Yields a queue for the records of worker processes, which the workers' initializer passes to log_to_queue,
+    e.g. ProcessPoolExecutor(mp_context=context, initializer=log_to_queue, initargs=(worker_queue,)).
+    A background listener hands the records to the shared logger's handlers, which write them to this process' log file, until the block exits.
+
+    Parameters:
+    context : The multiprocessing context the workers are started with (default is the multiprocessing module's default one).
+    '''
+    worker_queue = context.Queue()
+    listener = QueueListener(worker_queue, *logger.handlers)
+    listener.start()
+    try:
+        yield worker_queue
+    finally:
+        listener.stop()
+
+
+def log_to_queue(worker_queue):
+    '''
+    Initializer of worker processes sending the records of the shared logger to the queue of their parent, see worker_logging.
+    '''
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(LazyQueueHandler(worker_queue))
+
 
 # Create or get the logger
 logger = logging.getLogger('shared_logger')
-logger.setLevel(logging.DEBUG)  # Log everything (DEBUG level or higher)
+logger.setLevel(LOG_LEVEL)
 
-# Prevent multiple handlers if the logger is configured multiple times
-if not logger.handlers:
-    # Create a file handler to log to a file
-    log_file_name = './logs/shared_log_file_' + (datetime.now().strftime("%Y%m%d_%H%M%S")) + '.log'
-    file_handler = logging.FileHandler(log_file_name)
-    file_handler.setLevel(logging.DEBUG)
+# Prevent multiple handlers if the logger is configured multiple times.
+# Worker processes get no file of their own, their initializer routes their records to their parent, see log_to_queue
+if not logger.handlers and multiprocessing.parent_process() is None:
+    os.makedirs(LOG_DIR, exist_ok=True)
+    prune_logs(LOG_DIR, LOG_MAX_RUNS-1)
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+    file_handler.setFormatter(JsonFormatter())
 
-    # Define log format
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
 
-    # Add file handler to logger
-    logger.addHandler(file_handler)
\ No newline at end of file
+    logger.addHandler(LazyQueueHandler(log_queue))
@@ -0,0 +1,30 @@
+import os
+import json
+import string
+
+# The templates are read from the queries.json file next to this module, whatever the working directory
+QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'queries.json')
+
+def load_queries(path: str=QUERIES_PATH) -> dict:
+    '''
+    Reads the query templates and checks that every one of them parses as a str.format template,
+    so that a broken template fails at import instead of in the middle of a run.
+
+    Parameters:
+    path (str): Path of the JSON file of templates (default is utils/queries.json).
+
+    Returns:
+    dict: Mapping of template name to template.
+    '''
+    with open(path, 'r') as f:
+        queries = json.load(f)
+    formatter = string.Formatter()
+    for name, template in queries.items():
+        try:
+            list(formatter.parse(template))
+        except ValueError as e:
+            raise ValueError(f'The query template {name} of {path} is invalid: {e}')
+    return queries
+
+# Loaded once per process, on first import
+QUERIES = load_queries()
@@ -0,0 +1,38 @@
+import threading
+from sqlalchemy import event
+
+class QueryCounter:
+    '''
+    Counts the SQL statements sent to the database through engines or connections.
+    Listening on an engine includes the statements of every connection checked out from it,
+    listening on connections only counts theirs, which keeps the count right when an engine is shared by concurrent runs.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def attach(self, db):
+        '''
+        Starts counting the statements executed through db, an engine or a connection, and returns the counter.
+        '''
+        event.listen(db, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def detach(self, db):
+        '''
+        Stops counting the statements executed through db.
+        '''
+        if event.contains(db, 'before_cursor_execute', self._on_execute):
+            event.remove(db, 'before_cursor_execute', self._on_execute)
+
+    def add(self, count: int):
+        '''
+        Adds the statements counted elsewhere, e.g. by the counter of a worker process.
+        '''
+        with self._lock:
+            self.count += count
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
@@ -0,0 +1,159 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+import pandas as pd
+
+# Columns and statistic the statements issued by the current thread are computing, see query_label
+_labels = threading.local()
+
+@contextmanager
+def query_label(columns: list, statistic: str):
+    '''
+    Labels the statements issued by the current thread inside the block with the columns and the statistic they compute,
+    e.g. with query_label(batch, 'counts'): ..., so that a QueryProfiler can tell which columns the time was spent on.
+    Labels nest, the innermost one applies.
+    '''
+    previous = getattr(_labels, 'label', None)
+    _labels.label = (list(columns), statistic)
+    try:
+        yield
+    finally:
+        _labels.label = previous
+
+
+class QueryProfiler:
+    '''
+    Records the wall time, the number of rows and the label (see query_label) of every SQL statement sent to the database
+    through engines or connections, with the same attach and detach as QueryCounter.
+    The time of a statement computing several columns at once cannot be told apart between them: it is shared evenly
+    in the per column summary, which tells how much of every column's time was measured on statements of its own.
+    '''
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._key = f'query_profiler_{id(self)}'
+
+    def attach(self, db):
+        '''
+        Starts recording the statements executed through db, an engine or a connection, and returns the profiler.
+        '''
+        event.listen(db, 'before_cursor_execute', self._before_execute)
+        event.listen(db, 'after_cursor_execute', self._after_execute)
+        return self
+
+    def detach(self, db):
+        '''
+        Stops recording the statements executed through db.
+        '''
+        for name, listener in (('before_cursor_execute', self._before_execute), ('after_cursor_execute', self._after_execute)):
+            if event.contains(db, name, listener):
+                event.remove(db, name, listener)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(self._key, []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        end = time.perf_counter()
+        starts = conn.info.get(self._key)
+        if not starts:
+            return
+        start = starts.pop()
+        columns, statistic = getattr(_labels, 'label', None) or ([], None)
+        record = {
+            'statement': statement,
+            'parameters': parameters if isinstance(parameters, dict) else list(parameters) if isinstance(parameters, (tuple, list)) and not executemany else None,
+            'seconds': round(end-start, 6),
+            'started_at': round(start-self._start, 6),
+            'rows': cursor.rowcount if cursor.rowcount>=0 else None,
+            'columns': columns,
+            'statistic': statistic,
+            'thread': threading.current_thread().name
+        }
+        with self._lock:
+            self.records.append(record)
+
+    def slowest_queries(self, n: int=10) -> list:
+        '''
+        Returns the records of the n slowest statements, slowest first.
+        '''
+        with self._lock:
+            return sorted(self.records, key=lambda record: record['seconds'], reverse=True)[:n]
+
+    def column_timings(self) -> pd.DataFrame:
+        '''
+        Returns the time spent per column and statistic, a labelled statement's time being shared evenly between its columns.
+
+        Returns:
+        pd.DataFrame: One row per column and statistic with the Column, Statistic, Seconds and Queries columns, slowest first,
+                      and the Shared_Seconds of the statements computing other columns too, which are an even split, not a measure.
+                      Statements without a label are grouped under an empty Column.
+        '''
+        rows = []
+        with self._lock:
+            for record in self.records:
+                columns = record['columns'] or ['']
+                for col_name in columns:
+                    seconds = record['seconds']/len(columns)
+                    rows.append((col_name, record['statistic'] or '', seconds, seconds if len(columns)>1 else 0.0))
+        timings = pd.DataFrame(rows, columns=['Column', 'Statistic', 'Seconds', 'Shared_Seconds'])
+        timings = timings.groupby(['Column', 'Statistic'], as_index=False).agg(Seconds=('Seconds', 'sum'), Queries=('Seconds', 'size'),
+                                                                               Shared_Seconds=('Shared_Seconds', 'sum'))
+        timings[['Seconds', 'Shared_Seconds']] = timings[['Seconds', 'Shared_Seconds']].round(6)
+        return timings.sort_values('Seconds', ascending=False, ignore_index=True)
+
+    def slowest_columns(self, n: int=10) -> pd.DataFrame:
+        '''
+        Returns the n columns the most time was spent on, with their total Seconds, the Seconds of every statistic and the Measured share
+        of their Seconds spent on statements of their own. The rest is an even split of statements computing a batch of columns,
+        so columns with a low Measured share are only told apart by their statistics, not by their own cost.
+        These are the columns worth switching to the fast or the catalog mode.
+        '''
+        timings = self.column_timings()
+        timings = timings[timings['Column']!='']
+        by_statistic = timings.pivot_table(index='Column', columns='Statistic', values='Seconds', aggfunc='sum', fill_value=0)
+        by_statistic.insert(0, 'Seconds', by_statistic.sum(axis=1))
+        shared = timings.groupby('Column')['Shared_Seconds'].sum()
+        by_statistic.insert(1, 'Measured', (1-shared/by_statistic['Seconds'].where(by_statistic['Seconds']>0)).fillna(1).round(3))
+        by_statistic.columns.name = None
+        return by_statistic.sort_values('Seconds', ascending=False).head(n).round(6).reset_index()
+
+    def explain_slowest(self, db, n: int=5):
+        '''
+        Runs EXPLAIN (ANALYZE, BUFFERS) on the n slowest SELECT statements, on a new connection from db which is not profiled,
+        and stores the plans in the 'explain' field of their records. The statements are executed again, so this costs their time twice.
+        They are run with their named or positional parameters as recorded.
+        '''
+        slowest = [record for record in self.slowest_queries(len(self.records))
+                   if record['statement'].lstrip().upper().startswith(('SELECT', 'WITH'))][:n]
+        with db.connect() as conn:
+            for record in slowest:
+                parameters = record['parameters']
+                parameters = tuple(parameters) if isinstance(parameters, list) else parameters or {}
+                result = conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {record['statement']}", parameters)
+                plan = result.scalar()
+                record['explain'] = json.loads(plan) if isinstance(plan, str) else plan
+                conn.rollback()
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the timing profile: the total time and number of statements, the per column timings and every statement's record.
+        '''
+        with self._lock:
+            records = list(self.records)
+        return {
+            'queries': len(records),
+            'seconds': round(sum(record['seconds'] for record in records), 6),
+            'columns': self.column_timings().to_dict('records'),
+            'statements': records
+        }
+
+    def write(self, path: str):
+        '''
+        Writes the timing profile as JSON to path, see to_dict.
+        '''
+        with open(path, 'x') as f:
+            json.dump(self.to_dict(), f, indent=4, default=str)
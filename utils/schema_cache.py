@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import threading
+from sqlalchemy import text
+from utils.logging_config import logger
+from utils.queries import QUERIES
+from utils.engine_registry import database_key
+
+# Folder of the cached column lists, one JSON file per database and table OID
+SCHEMA_CACHE_DIR = './state/schema'
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+def table_markers(conn, table_name: str):
+    '''
+    Returns the OID of a table, the connection's role and the markers which change with its columns: its relfilenode, which changes when it is rewritten,
+    and the transaction IDs which last wrote its pg_class row and its pg_attribute rows, which change when a column is added,
+    dropped, renamed or retyped, or its privileges are granted or revoked, but not on ANALYZE or VACUUM, which update pg_class in place.
+    Returns None if the table does not exist.
+    '''
+    row = conn.execute(text(QUERIES['schema_markers_query']), {'table_name': table_name}).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1], [str(marker) for marker in row[2:]]
+
+def cache_path(cache_dir: str, db_key: str, role: str, oid: int) -> str:
+    '''
+    Returns the path of the cached columns of a table as seen by a role.
+    '''
+    return os.path.join(cache_dir, f"{hashlib.sha1(f'{db_key}/{role}'.encode()).hexdigest()[:16]}_{oid}.json")
+
+def get_columns(conn, table_name: str, cache_dir: str=SCHEMA_CACHE_DIR) -> dict:
+    '''
+    Returns the columns of a table and their datatypes, as information_schema.columns reports them.
+    They are cached in memory and on disk, keyed by the table's database and OID and by the connection's role, since information_schema
+    only lists the columns the role has privileges on, along with the table's markers (see table_markers).
+    While the markers are unchanged the columns are read from the cache, which costs one lookup of the table's pg_class row
+    instead of a query on information_schema, whose views are slow on databases with many tables and columns.
+
+    Parameters:
+    conn (connection object): The connection object to the table's database
+    table_name (schema_name.table_name): The table
+    cache_dir (str): Folder of the on-disk cache (default is ./state/schema). None only caches the columns in memory.
+
+    Returns:
+    dict: Mapping of column name to datatype, empty if the table does not exist.
+    '''
+    db_key = database_key(conn.engine)
+    markers = table_markers(conn, table_name)
+    if markers is not None:
+        oid, role, values = markers
+        key = (db_key, role, oid)
+        with _memo_lock:
+            cached = _memo.get(key)
+        if cached is not None and cached['markers']==values:
+            return dict(cached['columns'])
+        path = cache_path(cache_dir, db_key, role, oid) if cache_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    cached = json.load(f)
+            except Exception as e:
+                logger.warning(f'Ignoring the unreadable schema cache {path}: {e}')
+                cached = None
+            if cached is not None and cached['markers']==values:
+                logger.info(f'Columns of {table_name} read from the schema cache')
+                with _memo_lock:
+                    _memo[key] = cached
+                return dict(cached['columns'])
+
+    logger.info(f'Reading the columns of {table_name} from information_schema')
+    schema, table = table_name.split(".")
+    col_info_query = QUERIES['col_info_query'].format(schema=schema, table=table)
+    logger.info(col_info_query)
+    columns = [[col_name, datatype] for col_name, datatype in conn.execute(text(col_info_query))]
+    if markers is not None:
+        cached = {'table_name': table_name, 'role': role, 'markers': values, 'columns': columns}
+        with _memo_lock:
+            _memo[key] = cached
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written to a temporary file first, so that concurrent runs never read a partial file
+            temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(cached, f)
+            os.replace(temporary, path)
+    return dict(columns)